@@ -0,0 +1,172 @@
+from f1_racer import F1Racer
+from race_state import RaceState, num_trajectories
+from instrumentation import instrumentation
+
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+@instrumentation.timed('batch.lap')
+def simulate_lap_batch(
+    racers: List[F1Racer],
+    lap_number: int,
+    times: np.ndarray,
+    laps_since_pit: np.ndarray,
+    time_since_stop: np.ndarray,
+    rng: np.random.Generator,
+    trajectories: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Simulates one lap of `n_sims` independent races at once. Follows the
+    same steps as `simulation.simulate_lap`, but every racer's lap time,
+    overtake and pit stop is drawn for all simulations in one array operation
+    and the overtakes are resolved position by position across the whole
+    batch, a car passing as many of the cars it crossed as it can.
+
+    Args:
+        racers (List[F1Racer]): The racers, whose order fixes the columns of
+            the state arrays
+        lap_number (int): The lap being simulated
+        times (np.ndarray): `[n_sims, n_racers]` race time in milliseconds at
+            the start of the lap
+        laps_since_pit (np.ndarray): `[n_sims, n_racers]` laps since each
+            racer's last pit stop
+        time_since_stop (np.ndarray): `[n_sims, n_racers]` milliseconds since
+            each racer's last pit stop
+        rng (np.random.Generator): The source of all random draws, or
+            anything with its `standard_normal`, `normal`, `random` and
+            `geometric` methods, see `odds.DrawSource`
+        trajectories (Optional[np.ndarray]): `[n_sims]` pre-drawn lap time
+            trajectory each simulation follows, for racers that have them
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: The updated times, laps
+            since pit and time since stop arrays
+    """
+    n_sims, n_racers = times.shape
+    sims = np.arange(n_sims)
+
+    # racer index at each position, and each racer's position
+    order = np.argsort(times, axis=1, kind='stable')
+    positions = np.empty_like(order)
+    np.put_along_axis(positions, order, np.broadcast_to(np.arange(n_racers), order.shape), axis=1)
+
+    # gaps to the surrounding cars at the start of the lap
+    gaps = np.diff(np.take_along_axis(times, order, axis=1), axis=1)
+    no_car = np.full((n_sims, 1), 1e9)
+    car_before = np.take_along_axis(np.hstack([no_car, gaps]), positions, axis=1)
+    car_after = np.take_along_axis(np.hstack([gaps, no_car]), positions, axis=1)
+
+    lap_times = np.empty((n_sims, n_racers))
+    overtake_probability = np.empty((n_sims, n_racers))
+    pit_probability = np.empty((n_sims, n_racers))
+    pit_duration = np.empty((n_sims, n_racers))
+    time_since_stop = time_since_stop.copy()
+    for j, racer in enumerate(racers):
+        mean, std = racer.batched_lap_time(lap_number, laps_since_pit[:, j], trajectories)
+        lap_times[:, j] = mean + std * rng.standard_normal(n_sims)
+
+        mean, std = racer.batched_overtake_process(lap_times[:, j] / 1000)
+        overtake_probability[:, j] = mean + std * rng.standard_normal(n_sims)
+
+        time_since_stop[:, j] += lap_times[:, j]
+        pit_probability[:, j] = racer.batched_pit_stop_process(car_before[:, j], car_after[:, j], time_since_stop[:, j])
+
+        loc, scale = racer.batched_pit_stop_duration_process(lap_number)
+        pit_duration[:, j] = rng.normal(loc, scale, n_sims)
+
+    # the number of cars in a row each racer gets past, see `simulation.sample_passes`
+    failure = np.clip(1 - overtake_probability, 1e-12, 1)
+    passes = rng.geometric(failure) - 1
+    pits = rng.random((n_sims, n_racers)) < pit_probability
+
+    # Resolve overtakes from the front, as in `simulation.resolve_overtakes`:
+    # a car that crossed cars ahead gets past `passes` of them, from the one
+    # finishing just ahead, and otherwise finishes at the time of the first
+    # it fails to pass
+    new_times = times + lap_times
+    finished = np.empty((n_sims, n_racers))  # finishing times by position
+    for pos in range(n_racers):
+        idx = order[:, pos]
+        current = new_times[sims, idx]
+        if pos:
+            ahead = -np.sort(-finished[:, :pos], axis=1)  # latest first
+            crossed = (ahead > current[:, None]).sum(axis=1)
+            passed = passes[sims, idx]
+            stuck = passed < crossed
+            current = np.where(stuck, ahead[sims, np.minimum(passed, pos - 1)], current)
+        current = current + np.where(pits[sims, idx], pit_duration[sims, idx], 0)
+        finished[:, pos] = current
+        new_times[sims, idx] = current
+
+    laps_since_pit = np.where(pits, 0, laps_since_pit + 1)
+    time_since_stop = np.where(pits, 0, time_since_stop)
+    return new_times, laps_since_pit, time_since_stop
+
+
+@instrumentation.timed('batch.race')
+def simulate_races(
+    racers: List[F1Racer],
+    num_laps: int,
+    n_sims: int,
+    rng: Optional[np.random.Generator] = None,
+    state: Optional[RaceState] = None,
+    first_lap: int = 0,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Simulates `n_sims` independent runs of a race with the state of every
+    run held in `[n_sims, n_racers]` arrays. Statistically equivalent to
+    calling `simulation.simulate_race` `n_sims` times, without the
+    per-racer, per-lap Python overhead. Neither the racers nor `state` are
+    modified. As in `RaceState.from_racers`, each run follows a pre-drawn lap
+    time trajectory drawn from `rng` for racers that have them, chosen once
+    for the whole run.
+
+    Args:
+        racers (List[F1Racer]): A list of F1Racer objects at the start of the race
+        num_laps (int): The number of laps that the race lasts for
+        n_sims (int): The number of races to simulate
+        rng (Optional[np.random.Generator]): Source of randomness, a fresh
+            default generator if not given, see `simulate_lap_batch`, with an
+            `integers` method if any racer has pre-drawn trajectories
+        state (Optional[RaceState]): The state every run starts from, the
+            racers' starting times if not given
+        first_lap (int): The lap the runs start on, with `state` the state
+            at its start, to simulate the rest of a race under way
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: `[n_sims, n_racers]` finishing orders,
+            each row holding indices into `racers` from winner to last, and
+            `[n_sims, n_racers]` finishing times in milliseconds indexed by racer
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    n_racers = len(racers)
+
+    state = state if state is not None else RaceState.from_racers(racers)
+    times = np.tile(state.current_time, (n_sims, 1))
+    laps_since_pit = np.tile(state.laps_since_pit_stop, (n_sims, 1))
+    time_since_stop = np.tile(state.time_since_stop, (n_sims, 1))
+    drawn = num_trajectories(racers)
+    trajectories = rng.integers(drawn, size=n_sims) if drawn else None
+
+    for lap in range(first_lap, num_laps):
+        times, laps_since_pit, time_since_stop = simulate_lap_batch(
+            racers, lap, times, laps_since_pit, time_since_stop, rng, trajectories)
+
+    return np.argsort(times, axis=1, kind='stable'), times
+
+
+def finishing_position_probabilities(finishing_orders: np.ndarray) -> np.ndarray:
+    """Turns the finishing orders from `simulate_races` into an
+    `[n_racers, n_racers]` matrix whose `[i, p]` entry is the fraction of
+    simulations in which racer `i` finished in position `p` (0 being the win)
+
+    Args:
+        finishing_orders (np.ndarray): `[n_sims, n_racers]` finishing orders
+
+    Returns:
+        np.ndarray: The finishing position probabilities of each racer
+    """
+    n_sims, n_racers = finishing_orders.shape
+    counts = np.zeros((n_racers, n_racers))
+    np.add.at(counts, (finishing_orders, np.broadcast_to(np.arange(n_racers), finishing_orders.shape)), 1)
+    return counts / n_sims
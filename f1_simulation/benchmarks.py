@@ -0,0 +1,309 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from dataprocessing import F1Dataset
+from synthetic_data import SCALES, generate_dataset
+
+BENCHMARK_VERSION = 1
+# Grid points per input of the tabulated pit stop samplers
+TABLE_RESOLUTION = 256
+# The modules whose import in a fresh interpreter is timed as the startup
+STARTUP_MODULES = ('run_simulations', 'batch_simulation', 'odds', 'live', 'fitting', 'ingestion')
+
+
+def measure(func: Callable[[], Any], repeats: int = 5, number: int = 1,
+            setup: Optional[Callable[[], Any]] = None) -> Dict[str, Any]:
+    """Times `func`, `number` calls at a time, `repeats` times.
+
+    Args:
+        func (Callable[[], Any]): The code to time
+        repeats (int): The number of timings taken
+        number (int): The number of calls per timing, for code too fast to
+            time one call at a time
+        setup (Optional[Callable[[], Any]]): Called untimed before each timing
+
+    Returns:
+        Dict[str, Any]: The seconds per call of the fastest, median, mean and
+            slowest timing, with `repeats` and `number`
+    """
+    timings = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    return dict(repeats=repeats, number=number, min=min(timings), median=statistics.median(timings),
+                mean=statistics.mean(timings), max=max(timings))
+
+
+def benchmark_race(data: F1Dataset) -> Tuple[int, int]:
+    """The race and driver the single race benchmarks use: the first driver
+    of the first race of the latest season, so every model has a season of
+    history to fit on"""
+    races = data.races
+    race_id = int(races.loc[races['year'] == races['year'].max(), 'raceId'].min())
+    results = data.results
+    return race_id, int(results.loc[results['raceId'] == race_id, 'driverId'].iloc[0])
+
+
+def reset_process():
+    """Drops what the process holds from earlier runs, so each run of the
+    simulation starts as it would in a new process"""
+    import run_simulations
+    from context import contexts
+    run_simulations.context = None
+    run_simulations.race_table = None
+    contexts.clear()
+
+
+def import_simulation():
+    """Imports `STARTUP_MODULES` in a fresh interpreter, from an empty
+    working directory as importing them reads no data"""
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as cwd:
+        subprocess.run([sys.executable, '-c', 'import ' + ', '.join(STARTUP_MODULES)], cwd=cwd, env=env, check=True)
+
+
+def run_benchmarks(dirpath: str, workdir: str, repeats: int = 5, fit_repeats: int = 3,
+                   samples: int = 200, seed: int = 0) -> Dict[str, Dict[str, Any]]:
+    """Times each stage of the simulation on the dataset in `dirpath`:
+    importing the simulation in a new interpreter,
+    loading the datasets from CSV and from the binary cache, building the
+    feature tables, fitting each model (a driver's own and the pooled ones),
+    each single lap sample, the pit stop samples from tabulated models with
+    the tables' `max_error`, each sample and a whole race on the NumPy
+    inference backend, a lap and a
+    whole race of `simulate_race`, and the `run_simulations` loop over every
+    race with an empty and with a filled model store.
+
+    Args:
+        dirpath (str): The directory with the F1 data files in
+        workdir (str): A directory for the model store and simulation
+            results, which are deleted as the benchmarks run
+        repeats (int): The number of timings of each stage
+        fit_repeats (int): The number of timings of each model fit and of
+            the `run_simulations` loop, which are much slower
+        samples (int): The number of calls per timing of the samplers
+        seed (int): Seed of NumPy's global generator, which the samplers use
+
+    Returns:
+        Dict[str, Dict[str, Any]]: The timings of each stage by name, see `measure`
+    """
+    import lap_times
+    import overtaking
+    import pit_stopping
+    import run_simulations
+    from context import SimulationContext
+    from features import FeatureStore
+    from pit_stopping import pit_stop_model
+    from race_state import RaceState
+    from simulation import simulate_lap, simulate_race
+    from utils import load_lazy_imports
+
+    np.random.seed(seed)
+    models_dirpath = os.path.join(workdir, 'models')
+    output = os.path.join(workdir, 'results.csv')
+    results = {}
+
+    results['startup.import'] = measure(import_simulation, repeats)
+    load_lazy_imports()  # so the first fit isn't timed with GPy's import
+
+    def load_all(cache: bool) -> F1Dataset:
+        data = F1Dataset(dirpath, cache=cache)
+        for dataset in data.datasets:
+            getattr(data, dataset)
+        return data
+
+    results['dataset.load_csv'] = measure(lambda: load_all(cache=False), repeats)
+    load_all(cache=True)  # writes the cache
+    results['dataset.load_cached'] = measure(lambda: load_all(cache=True), repeats)
+
+    data = load_all(cache=True)
+    race_id, driver_id = benchmark_race(data)
+    race = data.races.loc[data.races['raceId'] == race_id].iloc[0]
+    year, course_id = int(race['year']), int(race['circuitId'])
+    constructor_id = int(data.results.loc[(data.results['raceId'] == race_id) &
+                                          (data.results['driverId'] == driver_id), 'constructorId'].iloc[0])
+
+    def build_features() -> FeatureStore:
+        run_simulations.context = SimulationContext(dirpath, data=data)
+        run_simulations.warm_features([year])
+        return run_simulations.context.features
+
+    results['features.build'] = measure(build_features, repeats)
+    build_features()
+    context = run_simulations.context
+
+    results['model.lap_time'] = measure(
+        lambda: lap_times.fit_lap_time_model(driver_id, year, context=context), fit_repeats)
+    results['model.overtaking'] = measure(
+        lambda: overtaking.fit_overtaking_model(driver_id, context=context), fit_repeats)
+    results['model.lap_time_pooled'] = measure(
+        lambda: lap_times.fit_pooled_lap_time_model(year, context=context), fit_repeats,
+        setup=context.clear_models)
+    results['model.overtaking_pooled'] = measure(
+        lambda: overtaking.fit_pooled_overtaking_model(year, context=context), fit_repeats,
+        setup=context.clear_models)
+    results['model.pit_stop'] = measure(
+        lambda: pit_stop_model.get_pit_stop_model(course_id, year, context=context), fit_repeats,
+        setup=context.clear_models)
+    results['model.pit_stop_duration'] = measure(
+        lambda: pit_stopping.fit_pit_stop_duration_model(constructor_id, year, context=context), fit_repeats)
+
+    reset_process()
+    run_simulations.load(dirpath, models_dirpath)
+    racers, num_laps = run_simulations.make_racers(race_id)
+    racer = racers[0]
+    lap_time = racer.sample_lap_time(num_laps // 2, 5)
+    results['sample.lap_time'] = measure(lambda: racer.sample_lap_time(num_laps // 2, 5), repeats, samples)
+    results['sample.overtake'] = measure(lambda: racer.sample_overtake(lap_time / 1000), repeats, samples)
+    results['sample.pit_stop'] = measure(lambda: racer.sample_pit_stop(1000., 1000., lap_time), repeats, samples)
+    results['sample.pit_stop_duration'] = measure(lambda: racer.sample_pit_stop_duration(num_laps // 2), repeats,
+                                                  samples)
+    pit_stop_table = pit_stop_model.get_pit_stop_table(course_id, year, table_resolution=TABLE_RESOLUTION,
+                                                       context=run_simulations.context)
+    if pit_stop_table is not None:
+        pit_stop_process = pit_stop_model.make_pit_stop_process(
+            driver_id, constructor_id, course_id, year, table_resolution=TABLE_RESOLUTION,
+            context=run_simulations.context)
+        results['sample.pit_stop_tabulated'] = measure(lambda: pit_stop_process(1000., 1000., lap_time), repeats,
+                                                       samples)
+        results['sample.pit_stop_tabulated']['max_error'] = pit_stop_table.max_error
+    if racer.pit_stop_duration_model is not None:
+        duration_table = pit_stop_model.get_pit_stop_duration_table(
+            constructor_id, year, racer.pit_stop_duration_model, TABLE_RESOLUTION, run_simulations.context)
+        duration_process = pit_stop_model.make_pit_stop_duration_process(
+            driver_id, constructor_id, course_id, year, model=duration_table)
+        results['sample.pit_stop_duration_tabulated'] = measure(lambda: duration_process(num_laps // 2), repeats,
+                                                                samples)
+        results['sample.pit_stop_duration_tabulated']['max_error'] = duration_table.max_error
+
+    numpy_racers, _ = run_simulations.make_racers(race_id, inference='numpy')
+    numpy_racer = numpy_racers[0]
+    results['sample.lap_time_numpy'] = measure(lambda: numpy_racer.sample_lap_time(num_laps // 2, 5), repeats,
+                                               samples)
+    results['sample.overtake_numpy'] = measure(lambda: numpy_racer.sample_overtake(lap_time / 1000), repeats, samples)
+    results['sample.pit_stop_numpy'] = measure(lambda: numpy_racer.sample_pit_stop(1000., 1000., lap_time), repeats,
+                                               samples)
+    results['sample.pit_stop_duration_numpy'] = measure(lambda: numpy_racer.sample_pit_stop_duration(num_laps // 2),
+                                                        repeats, samples)
+    results['simulation.race_numpy'] = measure(lambda: simulate_race(numpy_racers, num_laps), repeats)
+
+    state = RaceState.from_racers(racers)
+    results['simulation.lap'] = measure(lambda: simulate_lap(racers, state, num_laps // 2), repeats, samples // 10)
+    results['simulation.race'] = measure(lambda: simulate_race(racers, num_laps), repeats)
+
+    race_ids = data.races['raceId'].tolist()
+
+    def run_all():
+        reset_process()
+        run_simulations.run_simulations(race_ids, workers=1, output=output, dirpath=dirpath,
+                                        models_dirpath=models_dirpath)
+
+    results['run_simulations.cold'] = measure(
+        run_all, fit_repeats,
+        setup=lambda: shutil.rmtree(models_dirpath, ignore_errors=True))
+    results['run_simulations.warm'] = measure(run_all, fit_repeats)
+    results['run_simulations.warm']['races'] = results['run_simulations.cold']['races'] = len(race_ids)
+    reset_process()
+    return results
+
+
+def environment() -> Dict[str, str]:
+    """The versions the benchmarks ran under"""
+    import GPy
+    return dict(python=platform.python_version(), platform=platform.platform(), numpy=np.__version__,
+                pandas=pd.__version__, GPy=GPy.__version__, cpus=str(os.cpu_count()))
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.25) -> List[Dict[str, Any]]:
+    """Returns the stages whose median time is more than `tolerance` slower
+    than in `baseline`, both as written by this module. Stages missing from
+    either are skipped.
+
+    Args:
+        results (Dict[str, Any]): The benchmark results to check
+        baseline (Dict[str, Any]): The results to compare against
+        tolerance (float): The fraction slower than the baseline allowed
+
+    Returns:
+        List[Dict[str, Any]]: One dict per regression with the stage's name,
+            baseline and current median and their ratio
+    """
+    regressions = []
+    for name, timing in results['benchmarks'].items():
+        before = baseline['benchmarks'].get(name)
+        if before is None:
+            continue
+        ratio = timing['median'] / before['median']
+        if ratio > 1 + tolerance:
+            regressions.append(dict(name=name, baseline=before['median'], current=timing['median'], ratio=ratio))
+    return regressions
+
+
+def report(results: Dict[str, Any]) -> str:
+    """Returns a table of the median and fastest time of each stage"""
+    lines = [f'{"stage":<36}{"median ms":>14}{"min ms":>14}']
+    for name, timing in results['benchmarks'].items():
+        lines.append(f'{name:<36}{1000 * timing["median"]:>14.3f}{1000 * timing["min"]:>14.3f}')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time each stage of the simulation on a synthetic or given dataset')
+    parser.add_argument('--scale', choices=list(SCALES), default='tiny', help='named size of the synthetic dataset')
+    parser.add_argument('--data', default=None, help='directory with F1 data files to use instead of synthetic data')
+    parser.add_argument('--output', default='benchmarks.json', help='JSON file to write the results to')
+    parser.add_argument('--repeats', type=int, default=5, help='timings of each stage')
+    parser.add_argument('--fit-repeats', type=int, default=3, help='timings of each model fit and simulation run')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data and the samplers')
+    parser.add_argument('--baseline', default=None, help='results to compare against, exiting with 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='fraction slower than the baseline allowed')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.baseline) if args.baseline is not None else None
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if args.data is None:
+            generate_dataset(os.path.join(tmpdir, 'data'), **SCALES[args.scale]._asdict(), seed=args.seed)
+        else:
+            shutil.copytree(args.data, os.path.join(tmpdir, 'data'), ignore=shutil.ignore_patterns('.cache'))
+        cwd = os.getcwd()
+        os.chdir(tmpdir)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                benchmarks = run_benchmarks('data', tmpdir, args.repeats, args.fit_repeats, seed=args.seed)
+        finally:
+            os.chdir(cwd)
+
+    results = dict(version=BENCHMARK_VERSION, created=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   dataset=args.data if args.data is not None else dict(scale=args.scale, **SCALES[args.scale]._asdict(),
+                                                                        seed=args.seed),
+                   environment=environment(), benchmarks=benchmarks)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(report(results))
+
+    if baseline is not None:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"{regression['name']} regressed: {1000 * regression['baseline']:.3f} ms -> "
+                  f"{1000 * regression['current']:.3f} ms ({regression['ratio']:.2f}x)")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,160 @@
+import json
+import os
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from sinks import ChunkedFileSink
+
+CHECKPOINT_VERSION = 1
+RACE_DONE = 'done'
+RACE_FAILED = 'failed'
+
+
+def _plain(value: Any) -> Any:
+    """Converts the numpy scalars in results and model keys to plain python
+    values for JSON"""
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} can't be written to a checkpoint")
+
+
+def write_json(path: str, value: Any):
+    """Writes `value` to `path` through a temporary file renamed into place,
+    so an interrupted write leaves the previous file as it was"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(value, f, default=_plain)
+    os.replace(tmp_path, path)
+
+
+class RunCheckpoint:
+    """Records the progress of a run over many races in a directory, so a
+    run that crashed, was interrupted or had races fail can be resumed,
+    simulating only the races that haven't finished.
+
+    `manifest.json` holds the settings of the run and, for every race
+    attempted, whether it finished or failed, the number of attempts, the
+    error it last failed with and the keys of the models its racers fit or
+    loaded, see `F1Racer.model_key`, which are kept in the run's
+    `ModelStore`. The results of each finished race are kept in
+    `races/<race_id>.json`. Every file is written to a temporary file and
+    renamed into place, and a race's results are written before the
+    manifest records it as finished, so the run can be stopped at any point:
+    a race is either recorded with its results on disk or simulated again.
+
+        Args:
+            dirpath (str): The directory of the checkpoint, created if needed
+            settings (Dict[str, Any]): Everything the results depend on, e.g.
+                the model options and a fingerprint of the data. A checkpoint
+                made with other settings raises a ValueError rather than
+                mixing their results.
+
+        Attributes:
+            races (Dict[int, Dict[str, Any]]): The manifest entry of every
+                race attempted, by race ID
+    """
+    def __init__(self, dirpath: str, settings: Dict[str, Any]):
+        self.dirpath = dirpath
+        # as they compare once read back from the manifest
+        self.settings = json.loads(json.dumps(settings, default=_plain))
+        os.makedirs(os.path.join(dirpath, 'races'), exist_ok=True)
+        manifest = self._read()
+        if manifest is None:
+            self.races = {}
+            self._write()
+        elif manifest['settings'] != self.settings:
+            raise ValueError(f"The checkpoint in '{dirpath}' was made with other settings or data, "
+                             f"resume with those or use a new checkpoint directory")
+        else:
+            self.races = {int(race_id): entry for race_id, entry in manifest['races'].items()}
+
+    def __repr__(self) -> str:
+        return f'RunCheckpoint({self.dirpath!r}, {len(self.done)} done, {len(self.failed)} failed)'
+
+    @property
+    def _manifest_path(self) -> str:
+        return os.path.join(self.dirpath, 'manifest.json')
+
+    def _results_path(self, race_id: int) -> str:
+        return os.path.join(self.dirpath, 'races', f'{race_id}.json')
+
+    def _read(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._manifest_path) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        if manifest.get('version') != CHECKPOINT_VERSION:
+            raise ValueError(f"The checkpoint in '{self.dirpath}' is from another version, use a new checkpoint directory")
+        return manifest
+
+    def _write(self):
+        write_json(self._manifest_path, dict(version=CHECKPOINT_VERSION, settings=self.settings,
+                                             races={str(race_id): entry for race_id, entry in self.races.items()}))
+
+    @property
+    def done(self) -> List[int]:
+        """The races that finished"""
+        return [race_id for race_id, entry in self.races.items() if entry['status'] == RACE_DONE]
+
+    @property
+    def failed(self) -> List[int]:
+        """The races whose last attempt failed"""
+        return [race_id for race_id, entry in self.races.items() if entry['status'] == RACE_FAILED]
+
+    def pending(self, races: Sequence[int]) -> List[int]:
+        """The races of `races` left to simulate: those not attempted and
+        those that failed, in the order given"""
+        done = set(self.done)
+        return [race_id for race_id in races if race_id not in done]
+
+    def record(self, race_id: int, columns: Optional[Dict[str, list]], models: Sequence[Tuple],
+               error: Optional[str] = None):
+        """Records an attempt at a race, keeping its results if it finished
+
+        Args:
+            race_id (int): The race
+            columns (Optional[Dict[str, list]]): Its results, one list per
+                column of `sinks.RESULT_COLUMNS`
+            models (Sequence[Tuple]): The keys of the models its racers used
+            error (Optional[str]): The error it failed with, None if it finished
+        """
+        attempts = self.races.get(race_id, {}).get('attempts', 0) + 1
+        entry = dict(attempts=attempts, models=[list(key) for key in models],
+                     finished=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        if error is None:
+            write_json(self._results_path(race_id), columns)
+            entry.update(status=RACE_DONE, results=os.path.join('races', f'{race_id}.json'),
+                         rows=len(columns['race_id']))
+        else:
+            entry.update(status=RACE_FAILED, error=error)
+        self.races[race_id] = entry
+        self._write()
+
+    def results(self, race_id: int) -> Dict[str, list]:
+        """The results of a finished race, one list per column of `sinks.RESULT_COLUMNS`"""
+        with open(self._results_path(race_id)) as f:
+            return json.load(f)
+
+    def write_results(self, races: Sequence[int], output: str) -> int:
+        """Writes the results of the finished races of `races`, in that
+        order, to `output` as a CSV or, with a `.parquet` extension, Parquet
+        file, replacing it only once it is complete
+
+        Returns:
+            int: The number of races written
+        """
+        root, extension = os.path.splitext(output)
+        partial = f'{root}.partial{extension}'
+        done = set(self.done)
+        written = 0
+        with ChunkedFileSink(partial) as sink:
+            for race_id in races:
+                if race_id in done:
+                    sink.write_columns(self.results(race_id))
+                    written += 1
+        os.replace(partial, output)
+        return written
@@ -0,0 +1,113 @@
+from typing import Dict, Optional
+
+from dataprocessing import F1Dataset
+from features import FeatureStore
+from model_store import ModelStore
+
+
+class SimulationContext:
+    """What the models and racers of a simulation share: the dataset, the
+    features built from it, the store of fitted models and the models fitted
+    so far in this process. The model factories and `F1Racer` are given one,
+    falling back on the context of the 'data' directory, see `get_context`.
+
+    Nothing is read when a context is made, the dataset and the model store
+    being opened on first use, so importing the simulation does no I/O. As
+    the fitted models are kept by the context rather than the modules,
+    contexts on different datasets don't share them.
+
+        Args:
+            dirpath (str): The directory with the F1 data files in
+            models_dirpath (Optional[str]): The directory of the fitted model
+                store, the models being fit rather than loaded if not given
+            memory_budget (Optional[int]): The bytes the raw datasets may take
+                up, see `F1Dataset`
+            cache (bool): Whether to read the datasets from their binary cache
+            data (Optional[F1Dataset]): The dataset of `dirpath`, if it is
+                loaded already
+
+        Attributes:
+            pit_stop_models (Dict[Tuple, GPy.core.GP]): The pit decision models
+                by course, year and training mode, see
+                `pit_stop_model.get_pit_stop_model`
+            pit_stop_tables (Dict[Tuple, TabulatedModel]): Their tables, by the
+                model's key and the table resolution
+            pit_stop_duration_tables (Dict[Tuple, TabulatedModel]): The tables
+                of the pit stop duration models by constructor, year and table
+                resolution, see `pit_stop_model.get_pit_stop_duration_table`
+            pooled_models (Dict[Tuple, PooledModel]): The pooled models by their
+                `ModelStore` key, see `pooling.get_pooled_model`
+    """
+    __slots__ = ('dirpath', 'models_dirpath', 'memory_budget', 'cache', '_data', '_features', '_model_store',
+                 'pit_stop_models', 'pit_stop_tables', 'pit_stop_duration_tables', 'pooled_models')
+
+    def __init__(self, dirpath: str = 'data', models_dirpath: Optional[str] = None,
+                 memory_budget: Optional[int] = None, cache: bool = True, data: Optional[F1Dataset] = None):
+        self.dirpath = dirpath
+        self.models_dirpath = models_dirpath
+        self.memory_budget = memory_budget
+        self.cache = cache
+        self._data = data
+        self._features = None
+        self._model_store = None
+        self.pit_stop_models = {}
+        self.pit_stop_tables = {}
+        self.pit_stop_duration_tables = {}
+        self.pooled_models = {}
+
+    def __repr__(self) -> str:
+        return (f'SimulationContext(dirpath={self.dirpath!r}, models_dirpath={self.models_dirpath!r}, '
+                f'loaded={self._data is not None}, models={self.num_models})')
+
+    @property
+    def data(self) -> F1Dataset:
+        """The dataset, opened on first use"""
+        if self._data is None:
+            self._data = F1Dataset(self.dirpath, self.cache, self.memory_budget)
+        return self._data
+
+    @property
+    def features(self) -> FeatureStore:
+        """The features of `data`, built on first use"""
+        if self._features is None:
+            self._features = FeatureStore(self.data)
+        return self._features
+
+    @property
+    def model_store(self) -> Optional[ModelStore]:
+        """The store of fitted models, None without `models_dirpath`"""
+        if self._model_store is None and self.models_dirpath is not None:
+            self._model_store = ModelStore(self.models_dirpath)
+        return self._model_store
+
+    @property
+    def num_models(self) -> int:
+        """The number of models and tables held"""
+        return (len(self.pit_stop_models) + len(self.pit_stop_tables) + len(self.pit_stop_duration_tables) +
+                len(self.pooled_models))
+
+    def clear_models(self):
+        """Drops the models fitted in this process, to be fit or loaded again"""
+        self.pit_stop_models.clear()
+        self.pit_stop_tables.clear()
+        self.pit_stop_duration_tables.clear()
+        self.pooled_models.clear()
+
+
+# The contexts of the data directories used without one being given
+contexts: Dict[str, SimulationContext] = {}
+
+
+def get_context(dirpath: str = 'data', data: Optional[F1Dataset] = None) -> SimulationContext:
+    """Return the shared context of a data directory, creating it on first use
+
+    Args:
+        dirpath (str): The directory with the F1 data files in
+        data (Optional[F1Dataset]): The directory's dataset, if it is loaded already
+
+    Returns:
+        SimulationContext: The context, without a model store
+    """
+    if dirpath not in contexts:
+        contexts[dirpath] = SimulationContext(dirpath, data=data)
+    return contexts[dirpath]
@@ -1,7 +1,128 @@
 import pandas as pd
+import numpy as np
+import io
 import os
 import glob
-from typing import List, Optional, Any, Union
+import json
+from collections import OrderedDict
+from typing import Dict, List, Optional, Any, Sequence, Union
+
+from instrumentation import instrumentation
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:  # the binary cache is skipped without pyarrow
+    pa = None
+    feather = None
+
+CACHE_VERSION = 3
+CACHE_DIRNAME = '.cache'
+
+# Lap and qualifying times stored as 'M:SS.fff' strings
+TIME_COLUMNS = {
+    'qualifying': ['q1', 'q2', 'q3'],
+    'lap_times': ['time'],
+    'results': ['fastestLapTime'],
+}
+DATE_COLUMNS = {
+    'races': ['date'],
+    'drivers': ['dob'],
+}
+# The compact dtype of each numeric column of the datasets, sized for every
+# value the column can take rather than those loaded so far, so that appended
+# rows and arithmetic on a column don't overflow it or change its type.
+# Integer columns with missing values are left as the float64 they are read as.
+COLUMN_DTYPES = {
+    **dict.fromkeys(['resultId', 'qualifyId', 'milliseconds'], np.int32),
+    **dict.fromkeys(['raceId', 'driverId', 'constructorId', 'circuitId', 'statusId', 'year', 'lap', 'laps',
+                     'fastestLap', 'number'], np.int16),
+    **dict.fromkeys(['round', 'stop', 'grid', 'position', 'positionOrder', 'rank'], np.int8),
+    'points': np.float32,
+}
+
+
+def parse_lap_time(times: pd.Series) -> pd.Series:
+    """Parse 'M:SS.fff' time strings into timedeltas, NaT where missing"""
+    return pd.to_datetime(times, format='%M:%S.%f', errors='coerce') - pd.Timestamp('1900-01-01')
+
+
+def format_lap_time(times: pd.Series) -> pd.Series:
+    """Format timedeltas as the 'M:SS.fff' time strings `parse_lap_time`
+    reads, NaN where missing"""
+    milliseconds = (times / pd.Timedelta(milliseconds=1)).round()
+    present = milliseconds.notna()
+    text = pd.Series(np.nan, index=times.index, dtype=object)
+    text[present] = [f'{ms // 60000}:{(ms // 1000) % 60:02d}.{ms % 1000:03d}'
+                     for ms in milliseconds[present].astype(np.int64).tolist()]
+    return text
+
+
+def format_typed_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Turn the timedelta and datetime columns of a typed dataframe back into
+    the time and date strings of the CSVs, so that writing it out gives rows
+    `read_typed_csv` parses as they were"""
+    df = df.copy()
+    for column in df.columns:
+        if pd.api.types.is_timedelta64_dtype(df[column]):
+            df[column] = format_lap_time(df[column])
+        elif pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = df[column].dt.strftime('%Y-%m-%d')
+    return df
+
+
+def compact_dtypes(df: pd.DataFrame, categorical_threshold: float = 0.5) -> pd.DataFrame:
+    """Cast the numeric columns of `COLUMN_DTYPES` to their dtype and turn
+    repetitive string columns into categoricals. Other numeric columns are
+    left as they are.
+
+    Args:
+        df (pd.DataFrame): The dataframe to compact
+        categorical_threshold (float): String columns with fewer unique values
+            than this fraction of their length become categorical
+
+    Returns:
+        pd.DataFrame: The compacted dataframe
+
+    Raises:
+        ValueError: If an integer column has values its dtype can't hold
+    """
+    for column in df.columns:
+        values = df[column]
+        dtype = COLUMN_DTYPES.get(column)
+        if dtype is not None and pd.api.types.is_integer_dtype(dtype) and pd.api.types.is_integer_dtype(values):
+            info = np.iinfo(dtype)
+            if len(values) and not (info.min <= values.min() and values.max() <= info.max):
+                raise ValueError(f"Column {column} has values outside the range of {np.dtype(dtype)}")
+            df[column] = values.astype(dtype)
+        elif dtype is not None and pd.api.types.is_float_dtype(dtype) and pd.api.types.is_numeric_dtype(values):
+            df[column] = values.astype(dtype)
+        elif (pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values)) \
+                and values.nunique() < categorical_threshold * len(values):
+            df[column] = values.astype('category')
+    return df
+
+
+def read_typed_csv(path: Union[str, io.StringIO], name: str, columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+    """Read a dataset's CSV with `\\N` as nulls, its time and date columns
+    parsed and compact dtypes
+
+    Args:
+        path (Union[str, io.StringIO]): The CSV file path, or a buffer of CSV text
+        name (str): The dataset name, which picks the columns to parse
+        columns (Optional[Sequence[str]]): The columns to read, all if not given
+
+    Returns:
+        pd.DataFrame: The typed dataframe
+    """
+    df = pd.read_csv(path, na_values=['\\N', ''], keep_default_na=False, usecols=columns)
+    for column in TIME_COLUMNS.get(name, []):
+        if column in df.columns:
+            df[column] = parse_lap_time(df[column])
+    for column in DATE_COLUMNS.get(name, []):
+        if column in df.columns:
+            df[column] = pd.to_datetime(df[column], errors='coerce')
+    return compact_dtypes(df)
 
 
 class F1Dataset:
@@ -11,30 +132,161 @@ class F1Dataset:
 
         Args:
             dirpath (str): The directory with the F1 data files in
+            cache (bool): Whether to keep a Feather copy of each typed dataset
+                in `dirpath/.cache`, so later loads skip parsing the CSV. The
+                files are memory mapped rather than read into a buffer, but
+                each process still converts them into its own dataframes.
+            memory_budget (Optional[int]): The bytes the loaded datasets may
+                take up. Past it, the least recently used datasets are dropped,
+                to be loaded again the next time they are used, though the
+                dataset just used is always kept. Unbounded if not given.
     """
-    def __init__(self, dirpath: str):
-        self.__loaded = []
+    def __init__(self, dirpath: str, cache: bool = True, memory_budget: Optional[int] = None):
         self.dirpath = dirpath
+        self.cache = cache and feather is not None
+        self.memory_budget = memory_budget
         self.datasets = [os.path.basename(fp).removesuffix('.csv') 
                          for fp in glob.glob(f'{dirpath}/*.csv')]
-        self._data = {}
+        # the loaded datasets from least to most recently used, with the
+        # columns loaded of each (None for all of them) and their bytes
+        self._data: 'OrderedDict[str, pd.DataFrame]' = OrderedDict()
+        self._columns: Dict[str, Optional[List[str]]] = {}
+        self._sizes: Dict[str, int] = {}
         if not self.datasets:
             raise FileNotFoundError(f"'{dirpath}' is empty or does not exist")
 
     def __getattr__(self, __name: str) -> pd.DataFrame:
-        if __name not in self.datasets:
+        # read datasets from __dict__ so copying or unpickling, which look up
+        # attributes before __init__ has run, doesn't recurse
+        if __name not in self.__dict__.get('datasets', ()):
             raise AttributeError(f"F1Dataset has no attribute {__name}")
-        else:  # Lazy load dataset
-            if __name in self.__loaded:
-                return self._data[__name]
-            else:
-                self._data[__name] = pd.read_csv(os.path.join(self.dirpath, __name + '.csv'))
-                self.__loaded.append(__name)
-                return self._data[__name]
+        return self.table(__name)
+
+    def table(self, dataset: str, columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+        """Return a dataset, or just some of its columns, loading it if it
+        isn't loaded. Only the columns asked for are loaded, alongside any
+        loaded for earlier calls, so a consumer of a few columns of a wide
+        dataset doesn't keep the rest in memory. Reading the attribute of the
+        same name returns every column.
+
+        Args:
+            dataset (str): The name of the dataset
+            columns (Optional[Sequence[str]]): The columns to return, in order,
+                all of them if not given
+
+        Returns:
+            pd.DataFrame: The typed dataset
+        """
+        if dataset not in self.datasets:
+            raise FileNotFoundError(f"'{dataset}.csv' is not in '{self.dirpath}'")
+        loaded = self._columns.get(dataset, []) if dataset in self._data else []
+        if dataset in self._data and (loaded is None or columns is not None and set(columns) <= set(loaded)):
+            self._data.move_to_end(dataset)
+            df = self._data[dataset]
+        else:
+            wanted = None if columns is None or loaded is None else loaded + [c for c in columns if c not in loaded]
+            df = self._store(dataset, self._load(dataset, wanted), wanted)
+        return df if columns is None or list(df.columns) == list(columns) else df[list(columns)]
+
+    def _store(self, dataset: str, df: pd.DataFrame, columns: Optional[List[str]]) -> pd.DataFrame:
+        """Keep a loaded dataset as the most recently used, dropping the least
+        recently used others while the loaded datasets are over the budget"""
+        self._data[dataset] = df
+        self._data.move_to_end(dataset)
+        self._columns[dataset] = columns
+        self._sizes[dataset] = int(df.memory_usage(index=True, deep=True).sum())
+        while self.memory_budget is not None and self.memory_used > self.memory_budget and len(self._data) > 1:
+            evicted = next(iter(self._data))
+            del self._data[evicted], self._columns[evicted], self._sizes[evicted]
+            instrumentation.count('dataset.evict')
+        return df
+
+    @property
+    def memory_used(self) -> int:
+        """The bytes taken up by the loaded datasets"""
+        return sum(self._sizes.values())
+
+    def memory_usage(self) -> pd.DataFrame:
+        """Report the loaded datasets, from least to most recently used, with
+        their rows, the columns loaded of each and the bytes they take up
+
+        Returns:
+            pd.DataFrame: One row per loaded dataset, indexed by name
+        """
+        return pd.DataFrame([dict(dataset=dataset, rows=len(df), columns=len(df.columns), bytes=self._sizes[dataset])
+                             for dataset, df in self._data.items()],
+                            columns=['dataset', 'rows', 'columns', 'bytes']).set_index('dataset')
+
+    def _cache_path(self, dataset: str) -> str:
+        return os.path.join(self.dirpath, CACHE_DIRNAME, dataset + '.feather')
+
+    @instrumentation.timed('dataset.load')
+    def _load(self, dataset: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Load a typed dataset, or some of its columns, from the binary cache
+        if it is up to date with the CSV, otherwise parse the CSV and refresh
+        the cache"""
+        if not self.cache:
+            return read_typed_csv(os.path.join(self.dirpath, dataset + '.csv'), dataset, columns)
+
+        stamp = json.dumps([CACHE_VERSION, self.fingerprint([dataset])]).encode()
+        try:
+            table = feather.read_table(self._cache_path(dataset), columns=columns, memory_map=True)
+            if (table.schema.metadata or {}).get(b'f1_source') == stamp:
+                instrumentation.count('dataset.cache_hit')
+                return table.to_pandas()
+        except (OSError, pa.ArrowInvalid):
+            pass
+
+        instrumentation.count('dataset.cache_miss')
+        df = read_typed_csv(os.path.join(self.dirpath, dataset + '.csv'), dataset)
+        self._write_cache(dataset, df, stamp)
+        return df if columns is None else df[columns]
+
+    def _write_cache(self, dataset: str, df: pd.DataFrame, stamp: bytes):
+        cache_path = self._cache_path(dataset)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'f1_source': stamp})
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        feather.write_feather(table, tmp_path, compression='uncompressed')  # uncompressed so it can be memory mapped
+        os.replace(tmp_path, cache_path)
+
+    def append(self, dataset: str, rows: pd.DataFrame) -> pd.DataFrame:
+        """Append rows to a dataset's CSV and bring the loaded dataframe and
+        the binary cache up to date with them, without re-parsing the rows
+        already on disk
+
+        Args:
+            dataset (str): The name of the dataset
+            rows (pd.DataFrame): The rows to add, either as read from another
+                copy of the CSV or already typed, their time and date columns
+                being written in the CSV's format, see `format_typed_columns`.
+                Columns missing from the CSV are dropped and missing values
+                are written as `\\N`
+
+        Returns:
+            pd.DataFrame: The typed dataset with the rows added
+        """
+        if dataset not in self.datasets:
+            raise FileNotFoundError(f"'{dataset}.csv' is not in '{self.dirpath}'")
+        current = self.table(dataset)  # loaded while the cache still matches the CSV
+        path = os.path.join(self.dirpath, dataset + '.csv')
+        header = pd.read_csv(path, nrows=0).columns
+        text = format_typed_columns(rows.reindex(columns=header)).to_csv(index=False, na_rep='\\N')
+        with open(path, 'rb') as f:
+            ends_with_newline = f.seek(0, os.SEEK_END) == 0 or (f.seek(-1, os.SEEK_END), f.read(1))[1] == b'\n'
+        with open(path, 'a', newline='') as f:
+            f.write(('' if ends_with_newline else '\n') + text.split('\n', 1)[1])
+
+        added = read_typed_csv(io.StringIO(text), dataset)
+        df = self._store(dataset, compact_dtypes(pd.concat([current, added], ignore_index=True)), None)
+        if self.cache:
+            self._write_cache(dataset, df, json.dumps([CACHE_VERSION, self.fingerprint([dataset])]).encode())
+        return df
 
     def __repr__(self) -> str:
         repr_str = 'F1Dataset with the following dataframes loaded:\n'
-        for dataset in self.__loaded:
+        for dataset in self._data:
             repr_str += dataset + ':\n  ' 
             repr_str += '\n  '.join(self._data[dataset].columns)
             repr_str += '\n\n'
@@ -43,6 +295,23 @@ class F1Dataset:
         repr_str += str(self.datasets)
         return repr_str
         
+    def fingerprint(self, datasets: List[str]) -> Dict[str, List[int]]:
+        """Return the size and modification time of each dataset's file, so
+        that anything derived from them can tell when they have changed
+
+        Args:
+            datasets (List[str]): The names of the datasets
+
+        Returns:
+            Dict[str, List[int]]: The size in bytes and modification time in
+                nanoseconds of each dataset's file
+        """
+        fingerprint = {}
+        for dataset in sorted(datasets):
+            stat = os.stat(os.path.join(self.dirpath, dataset + '.csv'))
+            fingerprint[dataset] = [stat.st_size, stat.st_mtime_ns]
+        return fingerprint
+
     def driver_id_to_name(self, driver_id: int) -> str:
         """Return a driver name from the driverId number in the dataset
 
@@ -1,18 +1,20 @@
-import pandas as pd
-from dataprocessing import F1Dataset
+import argparse
 import itertools
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+import numpy as np
+import pandas as pd
 from tqdm import tqdm
 
-data = F1Dataset('data')
-results = data.results
-results = results.join(data.races.set_index(['raceId']), on='raceId', rsuffix='_race')
-results['date'] = pd.to_datetime(results['date'])
-results = results.sort_values(by=['date', 'position'], ascending=True)
+from dataprocessing import F1Dataset
 
 mean_elo = 1500
 elo_width = 400
 k_factor = 64
 
+RaceUpdate = Callable[[np.ndarray, np.ndarray], np.ndarray]
+
 def update_elo(winner_elo, loser_elo, num_players):
     """
     From: https://www.kaggle.com/kplauritzen/elo-ratings-in-python
@@ -32,31 +34,174 @@ def expected_result(elo_a, elo_b):
     expect_a = 1.0/(1+10**((elo_b - elo_a)/elo_width))
     return expect_a
 
-races = results.raceId.unique().tolist()
-drivers = results.driverId.unique().tolist()
+def win_matrix(positions: np.ndarray) -> np.ndarray:
+    """Returns the `[n, n]` matrix whose `[i, j]` entry is whether driver `i`
+    beat driver `j`. As in the pairwise comparison, of two drivers the one
+    listed first wins only with a strictly better position, so ties and
+    missing positions go to the one listed later.
+
+    Args:
+        positions (np.ndarray): `[n]` finishing positions, NaN where missing
 
-elos = {driver: mean_elo for driver in drivers}
+    Returns:
+        np.ndarray: The boolean win matrix
+    """
+    better = positions[:, None] < positions[None, :]
+    return np.triu(better, 1) | np.tril(~better.T, -1)
+
+def race_elo_update(elos: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """Returns the ratings after one race, scored as a win or loss against
+    every other driver in it. Every pair is scored from the ratings at the
+    start of the race.
 
-results['finishingElo'] = 0
-print("Calculating elo ratings")
-for race in tqdm(races):
-    race_df = results.loc[results['raceId'] == race]
-    num_racers = len(race_df.driverId.unique())
-    for driver_1, driver_2 in itertools.combinations(race_df.driverId.unique(), 2):
-        driver_1_pos = race_df.loc[race_df['driverId'] == driver_1, 'position'].values[0]
-        driver_2_pos = race_df.loc[race_df['driverId'] == driver_2, 'position'].values[0]
+    Args:
+        elos (np.ndarray): `[n]` ratings of the drivers at the start of the race
+        positions (np.ndarray): `[n]` finishing positions, NaN where missing
 
-        winner = driver_1 if driver_1_pos < driver_2_pos else driver_2
+    Returns:
+        np.ndarray: `[n]` ratings at the end of the race
+    """
+    wins = win_matrix(positions)
+    expected = expected_result(elos[:, None], elos[None, :])
+    # the winner of each pair gains, and the loser loses, k * (1 - the winner's expected result) / n
+    change = (wins * expected.T).sum(axis=1) - (wins.T * expected).sum(axis=1)
+    return elos + k_factor * change / len(elos)
 
-        if winner == driver_1:
-            driver_1_elo, driver_2_elo = update_elo(elos[driver_1], elos[driver_2], num_racers)
+def race_elo_update_pairwise(elos: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """Reference implementation of `race_elo_update` updating the ratings
+    one pair at a time, as the original script did. Later pairs in a race are
+    scored from ratings already moved by earlier ones, so results differ
+    slightly from `race_elo_update`.
+    """
+    elos = elos.astype(float)
+    for i, j in itertools.combinations(range(len(elos)), 2):
+        if positions[i] < positions[j]:
+            elos[i], elos[j] = update_elo(elos[i], elos[j], len(elos))
         else:
-            driver_2_elo, driver_1_elo = update_elo(elos[driver_2], elos[driver_1], num_racers)
+            elos[j], elos[i] = update_elo(elos[j], elos[i], len(elos))
+    return elos
+
+def race_results(data: F1Dataset) -> pd.DataFrame:
+    """Returns the race results joined with the race details, in the order
+    the ratings are computed: by date, then finishing position"""
+    results = data.results
+    results = results.join(data.races.set_index(['raceId']), on='raceId', rsuffix='_race')
+    results['date'] = pd.to_datetime(results['date'])
+    return results.sort_values(by=['date', 'position'], ascending=True)
+
+def update_race_elos(race_df: pd.DataFrame, elos: Dict[int, float], race_update: RaceUpdate = race_elo_update):
+    """Updates `elos` in place with the result of one race. Drivers not yet
+    in `elos` start from `mean_elo`, and only each driver's first row counts.
+    """
+    race_df = race_df.drop_duplicates('driverId')
+    drivers = race_df['driverId'].tolist()
+    new_elos = race_update(np.array([elos.get(driver, mean_elo) for driver in drivers], dtype=float),
+                           pd.to_numeric(race_df['position'], errors='coerce').to_numpy(dtype=float))
+    elos.update(zip(drivers, new_elos.tolist()))
+
+def compute_elo_ratings(results: pd.DataFrame, elos: Optional[Dict[int, float]] = None,
+                        race_update: RaceUpdate = race_elo_update, progress: bool = False) -> pd.DataFrame:
+    """Computes every driver's Elo rating before and after each race. The
+    ratings are held in one array indexed by driver and each race updates
+    its drivers' entries with `race_update`.
+
+    Args:
+        results (pd.DataFrame): Race results in the order from `race_results`
+        elos (Optional[Dict[int, float]]): The ratings to start from, see
+            `elo_state`. Drivers without one start from `mean_elo`
+        race_update (RaceUpdate): Maps the drivers' ratings and finishing
+            positions in a race to their new ratings
+        progress (bool): Whether to show a progress bar of the races rated
+
+    Returns:
+        pd.DataFrame: `results` with the `startingElo` and `finishingElo` columns
+    """
+    elos = elos if elos is not None else {}
+    driver_codes, drivers = pd.factorize(results['driverId'])
+    ratings = np.array([elos.get(driver, mean_elo) for driver in drivers], dtype=float)
+    positions = pd.to_numeric(results['position'], errors='coerce').to_numpy(dtype=float)
+
+    # rows of each race, races in order of first appearance
+    race_codes, _ = pd.factorize(results['raceId'])
+    by_race = np.argsort(race_codes, kind='stable')
+    finishing = np.empty(len(results))
+    races = np.split(by_race, np.flatnonzero(np.diff(race_codes[by_race])) + 1)
+    for rows in tqdm(races, desc='calculating elo ratings', disable=not progress):
+        _, first = np.unique(driver_codes[rows], return_index=True)
+        race_rows = rows[np.sort(first)]
+        players = driver_codes[race_rows]
+        ratings[players] = race_update(ratings[players], positions[race_rows])
+        finishing[rows] = ratings[driver_codes[rows]]
+
+    results = results.assign(finishingElo=finishing)
+    results['startingElo'] = results.groupby(['driverId'])['finishingElo'].shift(1) \
+        .fillna(results['driverId'].map(elos)).fillna(mean_elo)
+    return results
+
+def elo_state(ratings: pd.DataFrame) -> Dict[int, float]:
+    """Returns each driver's latest rating from the computed ratings, the
+    state to continue rating later races from"""
+    return ratings.groupby('driverId')['finishingElo'].last().to_dict()
+
+def update_elo_ratings(data: F1Dataset, race_ids: Iterable[int]) -> pd.DataFrame:
+    """Rates races added to the dataset since `elo_ratings.csv` was written,
+    starting from its last stored ratings rather than from the first race,
+    and appends them to it
+
+    Args:
+        data (F1Dataset): The dataset, holding `elo_ratings`
+        race_ids (Iterable[int]): The races to rate, which must come after
+            the races already rated
+
+    Returns:
+        pd.DataFrame: The ratings of the new races
+    """
+    if 'elo_ratings' not in data.datasets:
+        raise FileNotFoundError(f"'{data.dirpath}/elo_ratings.csv' does not exist, run elo.py to create it")
+    results = race_results(data)
+    ratings = compute_elo_ratings(results.loc[results['raceId'].isin(list(race_ids))], elo_state(data.elo_ratings))
+    data.append('elo_ratings', ratings)
+    return ratings
+
+def benchmark(results: pd.DataFrame):
+    """Times `compute_elo_ratings` against the original script's algorithm,
+    one pair at a time with a dataframe lookup per driver, and prints how far
+    the ratings differ"""
+    start = time.perf_counter()
+    ratings = compute_elo_ratings(results)
+    vectorised_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    elos = {}
+    reference = results.assign(finishingElo=0.0)
+    for race in tqdm(results.raceId.unique()):
+        race_df = results.loc[results['raceId'] == race]
+        for driver_1, driver_2 in itertools.combinations(race_df.driverId.unique(), 2):
+            driver_1_pos = race_df.loc[race_df['driverId'] == driver_1, 'position'].values[0]
+            driver_2_pos = race_df.loc[race_df['driverId'] == driver_2, 'position'].values[0]
+            if driver_1_pos < driver_2_pos:
+                elos[driver_1], elos[driver_2] = update_elo(elos.get(driver_1, mean_elo), elos.get(driver_2, mean_elo), race_df.driverId.nunique())
+            else:
+                elos[driver_2], elos[driver_1] = update_elo(elos.get(driver_2, mean_elo), elos.get(driver_1, mean_elo), race_df.driverId.nunique())
+        reference.loc[results['raceId'] == race, 'finishingElo'] = race_df['driverId'].map(elos)
+    script_time = time.perf_counter() - start
 
-        elos[driver_1] = driver_1_elo
-        elos[driver_2] = driver_2_elo
+    difference = np.abs(ratings['finishingElo'] - reference['finishingElo'])
+    print(f"{results.raceId.nunique()} races, {len(results)} results")
+    print(f"original script: {script_time:.2f}s, vectorised: {vectorised_time:.2f}s "
+          f"({script_time / vectorised_time:.0f}x faster)")
+    print(f"rating difference from scoring every pair from the starting ratings: "
+          f"mean {difference.mean():.2f}, max {difference.max():.2f}")
 
-    results.loc[results['raceId'] == race, 'finishingElo'] = race_df['driverId'].map(elos)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the Elo ratings of every driver into data/elo_ratings.csv')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='time the computation against the original script instead of writing the ratings')
+    args = parser.parse_args()
 
-results['startingElo'] = results.groupby(['driverId'])['finishingElo'].shift(1).fillna(1500)
-results.to_csv('data/elo_ratings.csv', index=False)
+    data = F1Dataset('data')
+    if args.benchmark:
+        benchmark(race_results(data))
+    else:
+        results = compute_elo_ratings(race_results(data), progress=True)
+        results.to_csv('data/elo_ratings.csv', index=False)
@@ -3,35 +3,81 @@ from __future__ import annotations
 import lap_times
 import pit_stopping
 import overtaking
+from model_store import ModelStore
+from gp_inference import with_backend
+from context import SimulationContext, get_context
+from features import FeatureStore
+from instrumentation import instrumentation
 
 import datetime
-from timeit import default_timer as timer
+from typing import Optional, Tuple
 import pandas as pd
 import numpy as np
 
-def time_call(func, *args, **kwargs):
-    before = timer()
-    result = func(*args, **kwargs)
-    after = timer()
-    print(f"Function {func.__name__} took {after - before} seconds")
-    return result
-
-def get_seconds_from_timedelta(time):
-    return time / np.timedelta64(1, 's')
+# The parts of a racer fitted separately, and the attributes each sets
+RACER_COMPONENTS = ('lap_time', 'overtaking', 'pit_stop', 'pit_stop_duration')
+COMPONENT_ATTRIBUTES = {
+    'lap_time': ('lap_time_model', 'lap_time_process', 'batched_lap_time_process'),
+    'overtaking': ('overtake_model', 'overtake_process', 'batched_overtake_process'),
+    'pit_stop': ('pit_stop_process', 'batched_pit_stop_process'),
+    'pit_stop_duration': ('pit_stop_duration_model', 'pit_stop_duration_process', 'batched_pit_stop_duration_process'),
+}
+ATTRIBUTE_COMPONENTS = {attribute: component for component, attributes in COMPONENT_ATTRIBUTES.items()
+                        for attribute in attributes}
+# The components every racer uses on every lap, the others only being used
+# when it catches a car or pits
+EVERY_LAP_COMPONENTS = ('lap_time', 'pit_stop')
 
 class F1Racer:
     """The F1Racer class is the functioning heart of this simulation. It
     represents a single driver, constructor, car combination and stores the
     models for each of the different subproblems for the system. Upon
     initialisation it fits models to each subproblem. These systems are used to
-    govern how long the racer takes to finish each lap.
+    govern how long the racer takes to finish each lap. The state of the
+    racer during a race is kept apart from it in a `RaceState`.
     Args:
         driver_id (str): the name of the driver
         constructor_id (str): the name of the constructor
         course_id (str): The name of the course
         year (int): The year the race is occuring
-        start_time (float): The time penalty incurred from starting in a later position
+        starting_time (np.timedelta64): The time penalty incurred from starting in a later position
+        features (Optional[FeatureStore]): The precomputed features the
+            models are fit on, `context`'s if not given
+        lap_time_trajectories (Optional[int]): If given, pre-draw this many
+            whole-race lap time trajectories and sample lap times from them
+        model_store (Optional[ModelStore]): Store to load fitted models from
+            rather than refitting them, `context`'s if not given
+        lap_time_num_inducing (Optional[int]): Number of inducing points for a
+            sparse lap time model, exact unless the driver has many laps
+        pooled (bool): Whether to use the season's lap time and overtaking
+            models shared by every driver, fitted once per season, rather than
+            fitting the driver's own. Drivers without data in the season fall
+            back to their own models.
+        pit_table_resolution (Optional[int]): If given, the pit stop decision
+            and duration models are tabulated on grids of up to this many
+            points per input and interpolated, see `tabulation.TabulatedModel`
+        inference (str): The backend the models are predicted and sampled
+            on, one of `gp_inference.INFERENCE_BACKENDS`: GPy itself, or
+            NumPy from the fitted posterior's cached factors
+        lazy (bool): Whether to defer fitting each of `RACER_COMPONENTS`
+            until its models are first used, so a racer that never catches a
+            car or never pits doesn't fit those models. The lap time models
+            are still fit up front when drawing trajectories. The components
+            yet to be fit are kept in `deferred`, see `fitting.fit_racers` to
+            fit them for a whole grid at once.
+        context (Optional[SimulationContext]): The dataset and fitted models
+            the racers of a simulation share, the 'data' directory's if not given
     """
+    __slots__ = (
+        'race_id', 'driver', 'constructor', 'course', 'year', 'starting_time', 'total_laps', 'top_quali',
+        'context', 'features', 'model_store', 'lap_time_num_inducing', 'lap_time_trajectories', 'pooled',
+        'pit_table_resolution', 'inference', 'deferred',
+        'lap_time_model', 'lap_time_process', 'batched_lap_time_process',
+        'overtake_model', 'overtake_process', 'batched_overtake_process',
+        'pit_stop_process', 'batched_pit_stop_process',
+        'pit_stop_duration_model', 'pit_stop_duration_process', 'batched_pit_stop_duration_process',
+    )
+
     def __init__(
         self, 
         race_id: str,
@@ -42,78 +88,214 @@ class F1Racer:
         starting_time: float,
         total_laps: int,
         top_quali: datetime.timedelta,
-        overtaking_data: pd.DataFrame
+        features: Optional[FeatureStore] = None,
+        lap_time_trajectories: Optional[int] = None,
+        model_store: Optional[ModelStore] = None,
+        lap_time_num_inducing: Optional[int] = None,
+        pooled: bool = False,
+        pit_table_resolution: Optional[int] = None,
+        lazy: bool = False,
+        inference: str = 'gpy',
+        context: Optional[SimulationContext] = None
     ):
         self.race_id = race_id
         self.driver = driver_id
         self.constructor = constructor_id
         self.course = course_id
-        self.current_time = starting_time
+        self.starting_time = starting_time
         self.year = year
-        self.laps_since_pit_stop = 0
-        self.overtaking_data = overtaking_data
-        time_call(self.initialise_lap_time_params, driver_id, year, total_laps, top_quali)
-        time_call(self.initialise_overtake_params)
-        time_call(self.initialise_pit_stop_params)
+        self.context = context if context is not None else get_context()
+        self.features = features if features is not None else self.context.features
+        self.model_store = model_store if model_store is not None else self.context.model_store
+        self.lap_time_num_inducing = lap_time_num_inducing
+        self.pooled = pooled
+        self.pit_table_resolution = pit_table_resolution
+        self.inference = inference
+        self.total_laps = total_laps
+        self.top_quali = top_quali
+        self.lap_time_trajectories = None
+        self.deferred = set(RACER_COMPONENTS)
+        if not lazy or lap_time_trajectories is not None:
+            self.initialise('lap_time')
+        if lap_time_trajectories is not None:
+            with instrumentation.timer('racer.init.lap_time_trajectories'):
+                self.draw_lap_time_trajectories(lap_time_trajectories)
+        if not lazy:
+            for component in RACER_COMPONENTS[1:]:
+                self.initialise(component)
+
+    def __getattr__(self, name: str):
+        # only called for attributes that aren't set, fitting a deferred component on first use
+        component = ATTRIBUTE_COMPONENTS.get(name)
+        if component is None or component not in self.deferred:
+            raise AttributeError(f"'F1Racer' object has no attribute '{name}'")
+        self.initialise(component)
+        return getattr(self, name)
+
+    def initialise(self, component: str, model=None):
+        """Fits the models of one of `RACER_COMPONENTS`, timed as
+        `racer.init.<component>`
+
+        Args:
+            component (str): The component to fit
+            model: For 'pit_stop_duration', a duration model already fit for
+                the racer's constructor and year to use instead of fitting one
+        """
+        if component not in COMPONENT_ATTRIBUTES:
+            raise ValueError(f"Unknown component {component}, expected one of {RACER_COMPONENTS}")
+        with instrumentation.timer(f'racer.init.{component}'):
+            if component == 'lap_time':
+                self.initialise_lap_time_params(self.driver, self.year, self.total_laps, self.top_quali)
+            elif component == 'overtaking':
+                self.initialise_overtake_params()
+            elif component == 'pit_stop':
+                self.initialise_pit_stop_params()
+            else:
+                self.initialise_pit_stop_duration_params(model)
+        self.deferred.discard(component)
 
-        self.overtaking_mode = None
-        self.pit_stopping = None
-        self.pit_stop_duration = None
-        self.sampled_lap_time = None
+    def model_key(self, component: str) -> Tuple:
+        """Identifies the model a component fits, racers with the same key
+        sharing the model or fitting the same one"""
+        if component == 'lap_time':
+            return ('lap_time_pooled', self.year) if self.pooled else ('lap_time', self.driver, self.year)
+        if component == 'overtaking':
+            return ('overtaking_pooled', self.year) if self.pooled else ('overtaking', self.driver)
+        if component == 'pit_stop':
+            return ('pit_stop', self.course, self.year)
+        return ('pit_stop_duration', self.constructor, self.year)
 
     def __repr__(self):
         return f"""
         {self.driver=}
         {self.constructor=}
         {self.course=}
-        {self.current_time=}
-        {self.year=}
-        {self.laps_since_pit_stop=}"""
+        {self.starting_time=}
+        {self.year=}"""
 
     def initialise_lap_time_params(self, driver_id: int, year: int, total_laps: int, top_quali: datetime.timedelta, normalise_pit_laps: bool = True):
         """Fits the model that will govern the lap times of the racer
         """
-        self.lap_time_process = lap_times.make_lap_time_process(driver_id=driver_id, year=year, total_laps=total_laps, top_quali=top_quali)
+        pooled_model = lap_times.fit_pooled_lap_time_model(year=year, normalise_pit_laps=normalise_pit_laps, model_store=self.model_store, num_inducing=self.lap_time_num_inducing, features=self.features, context=self.context) if self.pooled else None
+        if pooled_model is not None and driver_id in pooled_model:
+            self.use_lap_time_model(pooled_model.for_driver(driver_id), normalise_pit_laps)
+        else:
+            self.use_lap_time_model(lap_times.fit_lap_time_model(driver_id=driver_id, year=year, normalise_pit_laps=normalise_pit_laps, model_store=self.model_store, num_inducing=self.lap_time_num_inducing, features=self.features, context=self.context), normalise_pit_laps)
+
+    def use_lap_time_model(self, model, normalise_pit_laps: bool = True):
+        """Samples the racer's lap times from `model` from now on, e.g. the
+        fitted model conditioned on the laps of a race under way, see
+        `live.LiveRace`. Pre-drawn trajectories are dropped, as they were
+        drawn from the old model.
+        """
+        self.lap_time_model = model
+        self.lap_time_trajectories = None
+        model = with_backend(model, self.inference)
+        self.lap_time_process = lap_times.make_lap_time_process(driver_id=self.driver, year=self.year, total_laps=self.total_laps, top_quali=self.top_quali, normalise_pit_laps=normalise_pit_laps, model=model)
+        self.batched_lap_time_process = lap_times.make_batched_lap_time_process(model, total_laps=self.total_laps, top_quali=self.top_quali, normalise_pit_laps=normalise_pit_laps)
+
+    def draw_lap_time_trajectories(self, n_trajectories: int, normalise_pit_laps: bool = True):
+        """Draws `n_trajectories` joint lap time trajectories over the whole
+        race and caches them on the racer, so that sampling a lap becomes an
+        array lookup into the race's trajectory, `RaceState.trajectory`, see
+        `sample_lap_time` and `batched_lap_time`
+        """
+        self.lap_time_trajectories = lap_times.draw_lap_time_trajectories(with_backend(self.lap_time_model, self.inference), total_laps=self.total_laps, top_quali=self.top_quali, n_trajectories=n_trajectories, normalise_pit_laps=normalise_pit_laps)
 
     def initialise_overtake_params(self):
         """Fits the model that will govern the racer's ability to overtake
         """
-        self.overtake_process = overtaking.make_overtaking_process(driver=self.driver, constructor=self.constructor, courseId=self.course, year=self.year, df=self.overtaking_data)
+        pooled_model = overtaking.fit_pooled_overtaking_model(year=self.year, features=self.features, model_store=self.model_store, context=self.context) if self.pooled else None
+        if pooled_model is not None and self.driver in pooled_model:
+            self.overtake_model = pooled_model.for_driver(self.driver)
+        else:
+            self.overtake_model = overtaking.fit_overtaking_model(driver=self.driver, features=self.features, model_store=self.model_store, context=self.context)
+        model = with_backend(self.overtake_model, self.inference)
+        self.overtake_process = overtaking.make_overtaking_process(driver=self.driver, constructor=self.constructor, courseId=self.course, year=self.year, features=self.features, model=model)
+        self.batched_overtake_process = overtaking.make_batched_overtaking_process(model, constructor=self.constructor, courseId=self.course, year=self.year)
 
     def initialise_pit_stop_params(self):
-        """Fits the model that will govern the racer's need to pit stop as well
-        as the duration of pit stops
+        """Fits the model that will govern the racer's need to pit stop
+        """
+        self.pit_stop_process = pit_stopping.make_pit_stop_process(driver_id=self.driver, constructor_id=self.constructor, course_id=self.course, year=self.year, model_store=self.model_store, features=self.features, table_resolution=self.pit_table_resolution, inference=self.inference, context=self.context)
+        self.batched_pit_stop_process = pit_stopping.make_batched_pit_stop_process(course_id=self.course, year=self.year, model_store=self.model_store, features=self.features, table_resolution=self.pit_table_resolution, inference=self.inference, context=self.context)
+
+    def initialise_pit_stop_duration_params(self, model=None):
+        """Fits the model that will govern the duration of the racer's pit
+        stops, unless given one
         """
-        self.pit_stop_process = pit_stopping.make_pit_stop_process(driver_id=self.driver, constructor_id=self.constructor, course_id=self.course, year=self.year)
-        self.pit_stop_duration_process = pit_stopping.make_pit_stop_duration_process(driver_id=self.driver, constructor_id=self.constructor, course_id=self.course, year=self.year)
+        self.pit_stop_duration_model = model if model is not None else pit_stopping.fit_pit_stop_duration_model(constructor_id=self.constructor, year=self.year, model_store=self.model_store, features=self.features, context=self.context)
+        # tabulated once and shared by both processes and the constructor's other racers
+        model = pit_stopping.get_pit_stop_duration_table(self.constructor, self.year, self.pit_stop_duration_model, self.pit_table_resolution, self.context)
+        self.pit_stop_duration_process = pit_stopping.make_pit_stop_duration_process(driver_id=self.driver, constructor_id=self.constructor, course_id=self.course, year=self.year, model=model, inference=self.inference, context=self.context)
+        self.batched_pit_stop_duration_process = pit_stopping.make_batched_pit_stop_duration_process(model, inference=self.inference)
 
-    def sample_lap_time(self, lap_number) -> float:
+    @instrumentation.timed('sample.lap_time')
+    def sample_lap_time(self, lap_number: int, laps_since_pit_stop: int, trajectory: int = 0) -> float:
         """Sample a lap time from the racer's lap time model and the course
 
+        Args:
+            lap_number (int): The lap being driven
+            laps_since_pit_stop (int): Laps since the racer's last pit stop
+            trajectory (int): With pre-drawn trajectories, the one to read from
+
         Returns:
             float: The time taken to complete the lap in milliseconds.
         """
-        return self.lap_time_process(lap_number, self.laps_since_pit_stop)
+        if self.lap_time_trajectories is not None:
+            return float(self.lap_time_trajectories[trajectory, lap_number, laps_since_pit_stop])
+        return self.lap_time_process(lap_number, laps_since_pit_stop) / np.timedelta64(1, 'ms')
+
+    def batched_lap_time(self, lap_number: int, laps_since_pit_stop: np.ndarray,
+                         trajectories: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """The array form of `sample_lap_time` for the batched race engine,
+        see `lap_times.make_batched_lap_time_process`
+
+        Args:
+            lap_number (int): The lap being driven
+            laps_since_pit_stop (np.ndarray): Laps since the racer's last pit
+                stop in each simulation
+            trajectories (Optional[np.ndarray]): With pre-drawn trajectories,
+                the one each simulation reads from
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The mean and standard deviation of
+                the lap time in milliseconds in each simulation, the standard
+                deviation being zero for a pre-drawn lap time
+        """
+        if self.lap_time_trajectories is not None:
+            return (self.lap_time_trajectories[trajectories, lap_number, laps_since_pit_stop],
+                    np.zeros(len(laps_since_pit_stop)))
+        return self.batched_lap_time_process(lap_number, laps_since_pit_stop)
 
-    def sample_overtake(self, opponent: F1Racer) -> bool:
-        """Sample whether this racer can overtake the `opponent` racer
+    @instrumentation.timed('sample.overtake')
+    def sample_overtake(self, lap_time: float) -> bool:
+        """Sample whether this racer can overtake the car ahead of it
 
         Args:
-            opponent (F1Racer): The racer who may be overtaken
+            lap_time (float): The racer's sampled lap time in seconds
 
         Returns:
-            bool: Whether this racer successfully overtook the `opponent` racer
+            bool: Whether this racer successfully overtook the car ahead
         """
-        return self.overtake_process(opponent)
+        return np.random.rand() < np.ravel(self.overtake_process(lap_time))[0]
 
-    def sample_pit_stop(self, car_before: float, car_after: float, lap_time: float) -> bool:
+    @instrumentation.timed('sample.pit_stop')
+    def sample_pit_stop(self, car_before: float, car_after: float, time_since_stop: float) -> bool:
         """Samples whether the racer will go in for a pit stop
 
+        Args:
+            car_before (float): The gap to the car ahead in milliseconds
+            car_after (float): The gap to the car behind in milliseconds
+            time_since_stop (float): Milliseconds driven since the racer's
+                last pit stop, including this lap, see `RaceState.time_since_stop`
+
         Returns:
             bool: Whether the car goes in for a pit stop
         """
-        return self.pit_stop_process(car_before, car_after, lap_time)
+        return self.pit_stop_process(car_before, car_after, time_since_stop)
 
+    @instrumentation.timed('sample.pit_stop_duration')
     def sample_pit_stop_duration(self, lap: int) -> float:
         """Gives the duration of the pit stop
 
@@ -121,6 +303,3 @@ class F1Racer:
             float: The time spent in the pit stop in milliseconds
         """
         return self.pit_stop_duration_process(lap)
-
-    def write_info(self, f, lap_no):
-        f.write(f'\n{self.race_id},{self.driver},{self.constructor},{self.course},{get_seconds_from_timedelta(self.current_time)},{self.year},{self.laps_since_pit_stop},{lap_no},{self.overtaking_mode},{self.pit_stopping},{self.pit_stop_duration},{get_seconds_from_timedelta(self.sampled_lap_time)}')
\ No newline at end of file
@@ -0,0 +1,232 @@
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from dataprocessing import F1Dataset
+from instrumentation import instrumentation
+
+# The columns of each dataset the feature builders read, so only those are loaded
+LAP_COLUMNS = ['raceId', 'driverId', 'lap', 'position', 'milliseconds']
+PIT_STOP_COLUMNS = ['raceId', 'driverId', 'lap', 'milliseconds']
+RACE_COLUMNS = ['raceId', 'year', 'circuitId']
+RESULT_COLUMNS = ['raceId', 'driverId', 'constructorId']
+QUALIFYING_COLUMNS = ['raceId', 'driverId', 'q1', 'q2', 'q3']
+
+
+def race_rows(table: pd.DataFrame, race_ids: Optional[List[int]] = None) -> pd.DataFrame:
+    """Return the rows of a table for the given races, or all of them"""
+    return table if race_ids is None else table.loc[table['raceId'].isin(race_ids)]
+
+
+def lookup(table: pd.DataFrame, key) -> pd.DataFrame:
+    """Return the rows of an indexed table for `key`, or no rows if it is absent"""
+    if key in table.index:
+        return table.loc[[key]]
+    return table.iloc[:0]
+
+
+class FeatureStore:
+    """Precomputed feature tables shared by the lap time, overtaking and pit
+    stop model builders. Each table is built with one set of joins the first
+    time it is needed and indexed by the ID the builders select on, so
+    fitting the models for a grid of racers costs one join per table and an
+    index lookup per racer instead of a scan of the full history each.
+
+    The lap time features are built per season; the overtaking and pit stop
+    features cover the whole history, as those models are fit across years.
+
+        Args:
+            data (F1Dataset): The dataset to build the features from
+    """
+    def __init__(self, data: F1Dataset):
+        self.data = data
+        self._season_laps = {}
+        self._overtaking_laps = None
+        self._overtaking = None
+        self._pit_laps = None
+        self._pit_durations = None
+
+    def __repr__(self) -> str:
+        return (f'FeatureStore({self.data.dirpath!r}, seasons={sorted(self._season_laps)}, '
+                f'overtaking={self._overtaking is not None}, pit_laps={self._pit_laps is not None}, '
+                f'pit_durations={self._pit_durations is not None})')
+
+    def season_laps(self, year: int) -> pd.DataFrame:
+        """Every lap of a season, indexed by `driverId`, with the race
+        progress `lap_r`, laps since the last pit stop and the lap time
+        relative to the race's fastest qualifying time `rel_time`. Pit stop
+        time is subtracted from the lap after each stop.
+        """
+        if year not in self._season_laps:
+            self._season_laps[year] = self._build_season_laps(year)
+        return self._season_laps[year]
+
+    @instrumentation.timed('features.season_laps')
+    def _build_season_laps(self, year: int) -> pd.DataFrame:
+        data = self.data
+        races = data.table('races', RACE_COLUMNS)
+        years_races = races.loc[races['year'] == year][['raceId', 'circuitId']]
+
+        # load qualification data,obtain fastest quali time at each race for normalisation purposes
+        qualis = data.table('qualifying', QUALIFYING_COLUMNS)
+        qrs = qualis.merge(years_races, on='raceId')
+        qrs = qrs.loc[~pd.isnull(qrs['q3'])]
+        top_times = qrs.groupby('raceId')['q3'].min().reset_index()
+
+        # load lap times, obtain number of laps in each race
+        years_laps = data.table('lap_times', LAP_COLUMNS).merge(years_races, on='raceId')[['milliseconds', 'raceId', 'driverId', 'lap']]
+        years_laps = years_laps.assign(time=pd.to_timedelta(years_laps['milliseconds'], unit='ms'))
+        race_laps = years_laps.groupby('raceId')['lap'].max().rename('lap_n').reset_index()
+
+        # load pit stops, increase lap number as the stop is timed in the following lap
+        years_pits = data.table('pit_stops', PIT_STOP_COLUMNS).merge(years_races, on='raceId').loc[:, ['milliseconds', 'raceId', 'driverId', 'lap']]
+        years_pits = years_pits.assign(pit_time=pd.to_timedelta(years_pits['milliseconds'], unit='ms'),
+                                       lap=years_pits['lap'] + 1).drop(columns='milliseconds')
+
+        # subtract pitstop time from lap time to have lower impact on lap times
+        laps = years_laps.merge(years_pits, on=['raceId', 'driverId', 'lap'], how='left')
+        laps = laps.assign(time=laps['time'] - laps['pit_time'].fillna(pd.Timedelta(0)))
+
+        # laps since the last pit stop, or since the start before the first
+        laps = laps.sort_values(by=['raceId', 'driverId', 'lap'])
+        last_pit = laps['lap'].where(laps['pit_time'].notna())
+        last_pit = last_pit.groupby([laps['raceId'], laps['driverId']]).ffill().fillna(0)
+        laps = laps.assign(laps_since_pit=laps['lap'] - last_pit)
+
+        # normalise progress across races, and lap time to the fastest quali time at the race
+        laps = laps.rename(columns={'lap': 'lap_idx'}).merge(race_laps, on='raceId').merge(top_times, on='raceId')
+        laps = laps.assign(lap_r=laps['lap_idx'] / laps['lap_n'], rel_time=laps['time'] / laps['q3'])
+        laps = laps.loc[:, ['raceId', 'driverId', 'lap_idx', 'lap_r', 'lap_n', 'laps_since_pit', 'rel_time']]
+
+        return laps.set_index('driverId', drop=False).sort_index()
+
+    def driver_laps(self, driver_id: int, year: int) -> pd.DataFrame:
+        """A driver's laps from `season_laps`"""
+        return lookup(self.season_laps(year), driver_id)
+
+    @instrumentation.timed('features.overtaking')
+    def _build_overtaking_laps(self, race_ids: Optional[List[int]] = None) -> pd.DataFrame:
+        # imported here as the overtaking package reads from this store
+        from overtaking.create_overtaking_dataset import make_overtakes_dataset
+        data = self.data
+        lp = make_overtakes_dataset(data=data, lap_times=race_rows(data.table('lap_times', LAP_COLUMNS), race_ids))
+        lp = lp.join(data.table('races', RACE_COLUMNS).set_index(['raceId'])[['year', 'circuitId']], on=['raceId'])
+        lp = lp.join(data.table('results', RESULT_COLUMNS).set_index(['raceId', 'driverId'])[['constructorId']], on=['raceId', 'driverId'])
+        lp = lp.join(data.table('qualifying', QUALIFYING_COLUMNS).set_index(['raceId', 'driverId'])[['q1', 'q2', 'q3']], on=['raceId', 'driverId'], lsuffix="qual_pos")
+        ## Take first qualifying time as number is variable
+        lp['qualtime'] = lp['q1'].dt.total_seconds()
+        return lp
+
+    @staticmethod
+    def _aggregate_overtaking(lp: pd.DataFrame) -> pd.DataFrame:
+        groups = lp.assign(gained=lp['position_change'].clip(lower=0),
+                           stuck=lp['stuck_behind_driver'].astype(int)).groupby(['raceId', 'driverId'])
+        overtaking = groups[['qualtime', 'year', 'circuitId', 'constructorId']].first()
+        overtaking['num_overtakes'] = groups['gained'].sum()
+        overtaking['stuck_behind'] = groups['stuck'].sum()
+        overtaking['success_perc'] = overtaking['num_overtakes'] / (overtaking['stuck_behind'] + overtaking['num_overtakes'])
+        return overtaking.reset_index().set_index('driverId', drop=False)
+
+    @property
+    def overtaking_laps(self) -> pd.DataFrame:
+        """Every lap in the history with position changes, whether the car was
+        stuck behind another and the race, constructor and qualifying details
+        """
+        if self._overtaking_laps is None:
+            self._overtaking_laps = self._build_overtaking_laps()
+        return self._overtaking_laps
+
+    @property
+    def overtaking(self) -> pd.DataFrame:
+        """One row per race and driver, indexed by `driverId`, with the number
+        of overtakes, the laps spent stuck behind another car and the fraction
+        of attempted overtakes completed `success_perc`
+        """
+        if self._overtaking is None:
+            self._overtaking = self._aggregate_overtaking(self.overtaking_laps).sort_index(kind='stable')
+        return self._overtaking
+
+    def driver_overtaking(self, driver_id: int) -> pd.DataFrame:
+        """A driver's rows from `overtaking`"""
+        return lookup(self.overtaking, driver_id)
+
+    @instrumentation.timed('features.pit_laps')
+    def _build_pit_laps(self, race_ids: Optional[List[int]] = None) -> pd.DataFrame:
+        data = self.data
+        lap_times_tmp = race_rows(data.table('lap_times', LAP_COLUMNS), race_ids).sort_values(by=['raceId', 'driverId', 'lap'])
+        lap_times = lap_times_tmp.assign(accumulated_time=lap_times_tmp.groupby(['raceId','driverId'])['milliseconds'].cumsum())
+
+        pit_stops = race_rows(data.table('pit_stops', PIT_STOP_COLUMNS), race_ids)
+        pit_stops = pit_stops.assign(last_stop=pit_stops['lap'])
+
+        df = lap_times.join(data.table('races', RACE_COLUMNS).set_index('raceId'), on='raceId', rsuffix='_race') \
+            .merge(pit_stops, on=['raceId', 'driverId', 'lap'], how='left', indicator = 'stop_indi')
+
+        races_with_pit_stops = df['raceId'][~(df['last_stop'].isna())].unique()
+        df = df.loc[df['raceId'].isin(races_with_pit_stops)]
+
+        # carried forward within each driver's race only, so that a race's
+        # rows don't depend on the races built alongside it
+        df = df.assign(last_stop=df.groupby(['raceId', 'driverId'])['last_stop'].ffill().fillna(0))
+        df = df.assign(time_last_stop=(df['lap'] - df['last_stop']) * df['milliseconds_x'],
+                       stop=np.where(df['stop_indi'] == 'both', 1, 0))
+        df = df.loc[:, ['raceId', 'circuitId', 'year', 'accumulated_time', 'time_last_stop', 'stop']]
+        return df.set_index('circuitId', drop=False)
+
+    @property
+    def pit_laps(self) -> pd.DataFrame:
+        """Every lap of the races with logged pit stops, indexed by
+        `circuitId`, with the accumulated race time, time since the last stop
+        and whether the car stopped
+        """
+        if self._pit_laps is None:
+            self._pit_laps = self._build_pit_laps().sort_index(kind='stable')
+        return self._pit_laps
+
+    def circuit_pit_laps(self, course_id: int) -> pd.DataFrame:
+        """A circuit's rows from `pit_laps`"""
+        return lookup(self.pit_laps, course_id)
+
+    @instrumentation.timed('features.pit_durations')
+    def _build_pit_durations(self, race_ids: Optional[List[int]] = None) -> pd.DataFrame:
+        data = self.data
+        df = race_rows(data.table('pit_stops', PIT_STOP_COLUMNS), race_ids) \
+            .join(data.table('races', RACE_COLUMNS).set_index('raceId'), on='raceId', rsuffix='_race') \
+            .merge(data.table('results', RESULT_COLUMNS).set_index('raceId'), on=['raceId','driverId'], suffixes=('','_results'))
+        df = df.loc[:, ['raceId', 'driverId', 'constructorId', 'year', 'lap', 'milliseconds']]
+        return df.set_index('constructorId', drop=False)
+
+    @property
+    def pit_durations(self) -> pd.DataFrame:
+        """Every pit stop with its race details, indexed by `constructorId`"""
+        if self._pit_durations is None:
+            self._pit_durations = self._build_pit_durations().sort_index(kind='stable')
+        return self._pit_durations
+
+    def constructor_pit_durations(self, constructor_id: int) -> pd.DataFrame:
+        """A constructor's rows from `pit_durations`"""
+        return lookup(self.pit_durations, constructor_id)
+
+    def append_race(self, race_id: int):
+        """Bring the features up to date with a race added to the dataset,
+        see `F1Dataset.append`. The tables built so far are extended with the
+        race's rows rather than rebuilt, and only the race's season of lap
+        time features is dropped, to be rebuilt on next use.
+
+        Args:
+            race_id (int): The ID of the race added
+        """
+        races = self.data.races
+        for year in races.loc[races['raceId'] == race_id, 'year'].unique():
+            self._season_laps.pop(year, None)
+
+        if self._overtaking_laps is not None:
+            lp = self._build_overtaking_laps([race_id])
+            self._overtaking_laps = pd.concat([self._overtaking_laps, lp])
+            if self._overtaking is not None:
+                self._overtaking = pd.concat([self._overtaking, self._aggregate_overtaking(lp)]).sort_index(kind='stable')
+        if self._pit_laps is not None:
+            self._pit_laps = pd.concat([self._pit_laps, self._build_pit_laps([race_id])]).sort_index(kind='stable')
+        if self._pit_durations is not None:
+            self._pit_durations = pd.concat([self._pit_durations, self._build_pit_durations([race_id])]).sort_index(kind='stable')
@@ -0,0 +1,128 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from f1_racer import F1Racer, RACER_COMPONENTS
+from instrumentation import instrumentation
+from utils import load_lazy_imports, seed_random
+from tqdm import tqdm
+
+FIT_EXECUTORS = ('thread', 'process')
+
+# The fits a process pool's workers run, set before the workers are forked
+# so they inherit it rather than the racers being pickled
+pending_fits: List[Tuple[F1Racer, str]] = []
+
+
+def warm_racer_features(racers: Sequence[F1Racer]):
+    """Builds the feature tables the racers' models are fit on, so concurrent
+    fits don't each build them"""
+    for features in {id(racer.features): racer.features for racer in racers}.values():
+        features.overtaking
+        features.pit_laps
+        features.pit_durations
+    for racer in racers:
+        racer.features.season_laps(racer.year)
+
+
+def fit_in_worker(index: int, seed: np.random.SeedSequence):
+    """Runs one of `pending_fits` in a worker process, which saves the fitted
+    model to the racer's model store for the parent to load. NumPy's global
+    generator is seeded with `seed` first, see `utils.seed_random`."""
+    seed_random(seed)
+    racer, component = pending_fits[index]
+    racer.initialise(component)
+
+
+def fit_racers(racers: Sequence[F1Racer], components: Sequence[str] = RACER_COMPONENTS,
+               workers: Optional[int] = None, executor: str = 'thread', progress: bool = True,
+               seed: Optional[int] = None) -> int:
+    """Fits the deferred components of a grid of racers created with
+    `lazy=True`, fitting the models concurrently.
+
+    Racers share some models: the pit decision model of their course, the
+    pit stop duration model of their constructor and, with `pooled`, the
+    season's lap time and overtaking models. Each shared model is fit once, by
+    the first racer that needs it, before the other racers pick it up.
+
+    With the 'thread' executor, the fits run in a thread pool in this process.
+    GPy spends much of an optimisation in NumPy and BLAS calls that release
+    the GIL, so large models fit in parallel. With 'process', the models are
+    fit in a pool of forked processes, free of the GIL, and passed back through the
+    racers' `ModelStore`, which has to be given. This process then loads them.
+
+    Args:
+        racers (Sequence[F1Racer]): The racers to fit
+        components (Sequence[str]): The components to fit, of `RACER_COMPONENTS`.
+            Those the racers aren't deferring are skipped.
+        workers (Optional[int]): The size of the pool, the number of CPUs if
+            not given
+        executor (str): One of `FIT_EXECUTORS`
+        progress (bool): Whether to show a progress bar of the fits
+        seed (Optional[int]): With 'process', the seed each fit's seed is
+            spawned from, fresh entropy if not given
+
+    Returns:
+        int: The number of components fit
+    """
+    if executor not in FIT_EXECUTORS:
+        raise ValueError(f"Unknown executor {executor}, expected one of {FIT_EXECUTORS}")
+    fits = [(racer, component) for racer in racers for component in components if component in racer.deferred]
+    if not fits:
+        return 0
+
+    # the first racer of each model fits it, the rest wait for it
+    owners: Dict[Tuple, F1Racer] = {}
+    first, rest = [], []
+    for racer, component in fits:
+        key = racer.model_key(component)
+        (rest if key in owners else first).append((racer, component))
+        owners.setdefault(key, racer)
+
+    warm_racer_features(racers)
+    load_lazy_imports()
+    workers = workers if workers is not None else os.cpu_count()
+    bar = tqdm(total=len(fits), desc='fitting models', disable=not progress, leave=False)
+    with instrumentation.timer('racer.fit_concurrent'):
+        if executor == 'process':
+            fit_in_processes(first, workers, bar, seed)
+        with ThreadPoolExecutor(workers) as pool:
+            # after fitting in processes, this loads the models from the store
+            run([pool.submit(racer.initialise, component) for racer, component in first],
+                bar if executor == 'thread' else None)
+            run([pool.submit(racer.initialise, component,
+                             owners[racer.model_key(component)].pit_stop_duration_model
+                             if component == 'pit_stop_duration' else None)
+                 for racer, component in rest], bar)
+    bar.close()
+    instrumentation.count('racer.fit_concurrent.components', len(fits))
+    return len(fits)
+
+
+def run(futures: list, bar: Optional[tqdm]):
+    """Waits for the fits, advancing the progress bar as each finishes and
+    raising the first error"""
+    for future in as_completed(futures):
+        future.result()
+        if bar is not None:
+            bar.update()
+
+
+def fit_in_processes(fits: List[Tuple[F1Racer, str]], workers: int, bar: tqdm, seed: Optional[int] = None):
+    """Fits each model in a pool of forked worker processes, which save them
+    to the racers' model store, each fit seeded with its own child of `seed`"""
+    global pending_fits
+    if any(racer.model_store is None for racer, _ in fits):
+        raise ValueError("Fitting in processes needs the racers to have a model store to pass the models back through")
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        raise ValueError("Fitting in processes needs the fork start method, use the thread executor")
+    pending_fits = fits
+    seeds = np.random.SeedSequence(seed).spawn(len(fits))
+    try:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as pool:
+            run([pool.submit(fit_in_worker, index, seeds[index]) for index in range(len(fits))], bar)
+    finally:
+        pending_fits = []
@@ -0,0 +1,329 @@
+from __future__ import annotations
+
+import copy
+import weakref
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+from pooling import DriverModel
+from tabulation import TabulatedModel
+from utils import lazy_import
+
+GPy = lazy_import('GPy')
+linalg = lazy_import('scipy.linalg')
+
+INFERENCE_BACKENDS = ('gpy', 'numpy')
+
+# The jitter GPy adds to the covariance of a sparse model's inducing inputs
+INDUCING_JITTER = 1e-8
+# The jitter GPy adds to the noise of an exact model's training covariance
+EXACT_JITTER = 1e-8
+# Spare rows left for the observations an exact model is conditioned on,
+# see `FactorBuffer`
+FACTOR_HEADROOM = 128
+
+KernelFunction = Callable[[np.ndarray, np.ndarray], np.ndarray]
+DiagonalFunction = Callable[[np.ndarray], np.ndarray]
+
+# Exports of the models fitted in this process, dropped with the model
+exported_models: 'weakref.WeakKeyDictionary[GPy.core.GP, NumpyGP]' = weakref.WeakKeyDictionary()
+
+
+def export_kernel(kernel: GPy.kern.Kern) -> Tuple[KernelFunction, DiagonalFunction]:
+    """Turns a GPy kernel into NumPy functions computing its covariance
+    between two sets of inputs and its variance at a set of inputs, with the
+    hyperparameters it has now. Supports the kernels the models here are
+    built from: `RBF`, `Bias` and `Coregionalize`, and sums and products of
+    them. Each function takes every input column, the kernel picking out its
+    `active_dims`.
+
+    Args:
+        kernel (GPy.kern.Kern): The kernel
+
+    Returns:
+        Tuple[KernelFunction, DiagonalFunction]: The covariance and variance functions
+    """
+    if isinstance(kernel, (GPy.kern.Add, GPy.kern.Prod)):
+        parts = [export_kernel(part) for part in kernel.parts]
+        combine = np.add if isinstance(kernel, GPy.kern.Add) else np.multiply
+
+        def K(X, X2):
+            result = parts[0][0](X, X2)
+            for part, _ in parts[1:]:
+                result = combine(result, part(X, X2))
+            return result
+
+        def Kdiag(X):
+            result = parts[0][1](X)
+            for _, part in parts[1:]:
+                result = combine(result, part(X))
+            return result
+
+        return K, Kdiag
+
+    dims = np.asarray(kernel.active_dims, dtype=int)
+    if isinstance(kernel, GPy.kern.RBF):
+        variance = float(kernel.variance[0])
+        lengthscale = np.array(kernel.lengthscale, dtype=float)
+
+        def K(X, X2):
+            A, B = X[:, dims] / lengthscale, X2[:, dims] / lengthscale
+            squared = (A ** 2).sum(axis=1)[:, None] + (B ** 2).sum(axis=1)[None, :] - 2 * A @ B.T
+            return variance * np.exp(-0.5 * np.maximum(squared, 0))
+
+        return K, lambda X: np.full(len(X), variance)
+
+    if isinstance(kernel, GPy.kern.Bias):
+        variance = float(kernel.variance[0])
+        return lambda X, X2: np.full((len(X), len(X2)), variance), lambda X: np.full(len(X), variance)
+
+    if isinstance(kernel, GPy.kern.Coregionalize):
+        W = np.array(kernel.W, dtype=float)
+        B = W @ W.T + np.diag(np.array(kernel.kappa, dtype=float))
+        column = dims[0]
+        return (lambda X, X2: B[np.ix_(X[:, column].astype(int), X2[:, column].astype(int))],
+                lambda X: B.diagonal()[X[:, column].astype(int)])
+
+    raise ValueError(f"No NumPy form of the {type(kernel).__name__} kernel")
+
+
+class FactorBuffer:
+    """Preallocated storage for an inverse Cholesky factor that grows by
+    rows as its model is conditioned on more observations, so that each
+    conditioning writes the new rows rather than copying the whole factor.
+    Posteriors conditioned one after the other share it, each viewing its
+    own leading rows and columns, which later rows leave unchanged. Only the
+    last of them can append to it, any other copies it.
+
+        Args:
+            inverse_chol (np.ndarray): The factor to start from
+            capacity (int): The rows and columns to allocate
+
+        Attributes:
+            array (np.ndarray): `[capacity, capacity]` storage
+            rows (int): The rows filled
+    """
+    __slots__ = ('array', 'rows')
+
+    def __init__(self, inverse_chol: np.ndarray, capacity: int):
+        self.rows = len(inverse_chol)
+        self.array = np.zeros((capacity, capacity))
+        self.array[:self.rows, :self.rows] = inverse_chol
+
+    def __repr__(self) -> str:
+        return f'FactorBuffer(rows={self.rows}, capacity={len(self.array)})'
+
+
+class NumpyGP:
+    """A fitted GP's posterior in plain NumPy, with the `predict` and
+    `posterior_samples_f` methods of the GPy model the processes call, so it
+    can stand in for the model. The kernel's hyperparameters, the training
+    inputs (a sparse model's inducing inputs) and the parts of the posterior
+    that don't depend on the test inputs are exported once: the inverse of
+    the Cholesky factor of the training covariance, or a sparse model's
+    Woodbury inverse. Each prediction is then a couple of matrix products,
+    without GPy's parameter and caching machinery. The export is fixed, so it
+    no longer follows the model if its hyperparameters change. It can be
+    conditioned on more observations with the same hyperparameters, see
+    `condition`.
+
+        Args:
+            model (GPy.core.GP): A `GPRegression`, `SparseGPRegression` or
+                `GPHeteroscedasticRegression` with a kernel `export_kernel`
+                supports and no normalizer or mean function
+
+        Attributes:
+            X (np.ndarray): The training, or inducing, inputs
+            woodbury_vector (np.ndarray): `[n, 1]` weights of the training
+                inputs in the predictive mean
+            inverse_chol (Optional[np.ndarray]): `L^-1` for the Cholesky
+                factor `L` of the noisy training covariance, exact models only
+            whitened_targets (Optional[np.ndarray]): `L^-1 Y`, exact models only
+            factor_buffer (Optional[FactorBuffer]): The storage
+                `inverse_chol` is a view of once the model is conditioned
+            woodbury_inv (Optional[np.ndarray]): The sparse posterior's
+                Woodbury inverse, sparse models only
+            inducing_inverse (Optional[np.ndarray]): The inverse of the
+                inducing inputs' covariance, sparse models only
+            noise_variance (Optional[float]): The likelihood's noise, only
+                known for a Gaussian likelihood with a single variance
+    """
+    __slots__ = ('X', 'woodbury_vector', 'inverse_chol', 'whitened_targets', 'factor_buffer', 'woodbury_inv',
+                 'inducing_inverse', 'noise_variance', 'input_dim', '_K', '_Kdiag')
+
+    def __init__(self, model: GPy.core.GP):
+        if model.normalizer is not None or model.mean_function is not None:
+            raise ValueError("Models with a normalizer or mean function have no NumPy form")
+        self._K, self._Kdiag = export_kernel(model.kern)
+        posterior = model.posterior
+        self.input_dim = model.X.shape[1]
+        self.factor_buffer = None
+        self.woodbury_vector = np.array(posterior.woodbury_vector, dtype=float)
+        if isinstance(model, GPy.core.SparseGP):
+            self.X = np.array(model.Z, dtype=float)
+            self.inverse_chol = self.whitened_targets = None
+            self.woodbury_inv = np.array(posterior.woodbury_inv, dtype=float)
+            self.inducing_inverse = np.linalg.inv(self._K(self.X, self.X) + INDUCING_JITTER * np.eye(len(self.X)))
+        else:
+            self.X = np.array(model.X, dtype=float)
+            chol = np.array(posterior.woodbury_chol, dtype=float)
+            self.inverse_chol = linalg.solve_triangular(chol, np.eye(len(chol)), lower=True)
+            self.whitened_targets = chol.T @ self.woodbury_vector
+            self.woodbury_inv = self.inducing_inverse = None
+        self.noise_variance = float(model.likelihood.variance[0]) \
+            if type(model.likelihood) is GPy.likelihoods.Gaussian else None
+
+    def __repr__(self) -> str:
+        return f'NumpyGP(points={len(self.X)}, sparse={self.inverse_chol is None})'
+
+    def predict(self, X: np.ndarray, full_cov: bool = False, include_likelihood: bool = True):
+        """Returns the predictive mean, `[m, 1]`, and variance, `[m, 1]` or
+        with `full_cov` the `[m, m]` covariance, at `[m, d]` inputs, as GPy's
+        `predict` does"""
+        X = np.asarray(X, dtype=float).reshape([-1, self.input_dim])
+        Kx = self._K(X, self.X)
+        mean = Kx @ self.woodbury_vector
+        if self.inverse_chol is not None:
+            V = Kx @ self.inverse_chol.T
+            var = self._K(X, X) - V @ V.T if full_cov else self._Kdiag(X) - (V ** 2).sum(axis=1)
+        else:
+            KW = Kx @ self.woodbury_inv
+            var = self._K(X, X) - KW @ Kx.T if full_cov else self._Kdiag(X) - (KW * Kx).sum(axis=1)
+        if include_likelihood:
+            if self.noise_variance is None:
+                raise ValueError("The likelihood's noise is only exported for Gaussian likelihoods, "
+                                 "predict with include_likelihood=False")
+            var = var + np.eye(len(X)) * self.noise_variance if full_cov else var + self.noise_variance
+        return mean, var if full_cov else var.reshape([-1, 1])
+
+    def predict_mean(self, X: np.ndarray) -> np.ndarray:
+        """Returns only the predictive mean, `[m, 1]`, at `[m, d]` inputs, a
+        single product with the training covariance, skipping the variance's
+        product with the `[n, n]` factor"""
+        X = np.asarray(X, dtype=float).reshape([-1, self.input_dim])
+        return self._K(X, self.X) @ self.woodbury_vector
+
+    def posterior_samples_f(self, X: np.ndarray, size: int = 10, **predict_kwargs) -> np.ndarray:
+        """Draws `size` joint samples of the latent function at `[m, d]`
+        inputs from NumPy's global generator, returned as `[m, 1, size]` like
+        GPy's `posterior_samples_f`"""
+        mean, cov = self.predict(X, full_cov=True, include_likelihood=False)
+        if len(mean) == 1:
+            samples = mean[0, 0] + np.sqrt(max(cov[0, 0], 0)) * np.random.standard_normal(size)
+            return samples.reshape([1, 1, size])
+        try:
+            root = np.linalg.cholesky(cov + 1e-10 * np.mean(np.diag(cov)) * np.eye(len(cov)))
+        except np.linalg.LinAlgError:
+            eigenvalues, eigenvectors = np.linalg.eigh(cov)
+            root = eigenvectors * np.sqrt(np.maximum(eigenvalues, 0))
+        samples = mean + root @ np.random.standard_normal((len(mean), size))
+        return samples[:, None, :]
+
+    def reserve(self, observations: int) -> 'NumpyGP':
+        """Returns this posterior with room allocated for conditioning an
+        exact model on `observations` more points without reallocating its
+        factor, see `FactorBuffer`. A sparse model is returned as it is."""
+        if self.inverse_chol is None:
+            return self
+        reserved = copy.copy(self)
+        reserved.factor_buffer = FactorBuffer(self.inverse_chol, len(self.X) + observations)
+        reserved.inverse_chol = reserved.factor_buffer.array[:len(self.X), :len(self.X)]
+        return reserved
+
+    def condition(self, X: np.ndarray, Y: np.ndarray, noise_variance: Optional[float] = None) -> 'NumpyGP':
+        """Returns the posterior after also observing `[k, 1]` targets at
+        `[k, d]` inputs, keeping the hyperparameters, while this posterior is
+        left as it is. Nothing is refactorised: an exact model's Cholesky
+        factor is extended by a row per observation, `O(k n^2)`, and a sparse
+        model's posterior over its inducing values takes a rank-one update
+        per observation, `O(k m^2)`.
+
+        Args:
+            X (np.ndarray): The inputs observed at
+            Y (np.ndarray): The observed targets
+            noise_variance (Optional[float]): The observations' noise, the
+                likelihood's if not given
+
+        Returns:
+            NumpyGP: The conditioned posterior
+        """
+        noise_variance = noise_variance if noise_variance is not None else self.noise_variance
+        if noise_variance is None:
+            raise ValueError("The likelihood's noise is only exported for Gaussian likelihoods, give noise_variance")
+        X = np.asarray(X, dtype=float).reshape([-1, self.input_dim])
+        Y = np.asarray(Y, dtype=float).reshape([-1, 1])
+        conditioned = copy.copy(self)
+        if self.inverse_chol is not None:
+            # L' = [[L, 0], [B^T, C]] with B = L^-1 K(X_n, X) and C the
+            # Cholesky factor of what the new points' covariance leaves
+            B = self.inverse_chol @ self._K(self.X, X)
+            C = np.linalg.cholesky(self._K(X, X) + (noise_variance + EXACT_JITTER) * np.eye(len(X)) - B.T @ B)
+            inverse_C = linalg.solve_triangular(C, np.eye(len(X)), lower=True)
+            new_rows = -inverse_C @ B.T @ self.inverse_chol
+            n, size = len(self.X), len(self.X) + len(X)
+            buffer = self.factor_buffer
+            if buffer is None or buffer.rows != n or len(buffer.array) < size:
+                buffer = FactorBuffer(self.inverse_chol, size + FACTOR_HEADROOM)
+            buffer.array[n:size, :n] = new_rows
+            buffer.array[n:size, n:size] = inverse_C
+            buffer.rows = size
+            conditioned.factor_buffer = buffer
+            conditioned.inverse_chol = buffer.array[:size, :size]
+            whitened = inverse_C @ (Y - B.T @ self.whitened_targets)
+            conditioned.whitened_targets = np.vstack([self.whitened_targets, whitened])
+            conditioned.woodbury_vector = np.vstack([self.woodbury_vector + new_rows.T @ whitened,
+                                                     inverse_C.T @ whitened])
+            conditioned.X = np.vstack([self.X, X])
+        else:
+            # with the inducing values' posterior N(m, S), Woodbury inverse
+            # K^-1 - K^-1 S K^-1 and vector K^-1 m, an observation y at x is
+            # a Kalman update of N(m, S) along K^-1 k(Z, x)
+            woodbury_inv, woodbury_vector = self.woodbury_inv.copy(), self.woodbury_vector.copy()
+            for k, y in zip(self._K(self.X, X).T, Y[:, 0]):
+                k = k[:, None]
+                gain = self.inducing_inverse @ k - woodbury_inv @ k
+                variance = (k.T @ gain)[0, 0] + noise_variance
+                woodbury_vector += gain * (y - (k.T @ woodbury_vector)[0, 0]) / variance
+                woodbury_inv += gain @ gain.T / variance
+            conditioned.woodbury_inv, conditioned.woodbury_vector = woodbury_inv, woodbury_vector
+        return conditioned
+
+
+def export_model(model: GPy.core.GP) -> NumpyGP:
+    """The `NumpyGP` of a fitted model, exported once per model"""
+    exported = exported_models.get(model)
+    if exported is None:
+        exported = exported_models[model] = NumpyGP(model)
+    return exported
+
+
+def predictive_mean(model, X: np.ndarray) -> np.ndarray:
+    """The predictive mean of any model the processes take at `[m, d]`
+    inputs, without its variance where the model can skip it"""
+    if isinstance(model, NumpyGP):
+        return model.predict_mean(X)
+    return model.predict(X, include_likelihood=False)[0]
+
+
+def with_backend(model, backend: str = 'gpy'):
+    """Returns the model to predict and sample with on one of
+    `INFERENCE_BACKENDS`: the model itself for 'gpy', its `NumpyGP` for
+    'numpy'. Views of pooled models are exported through to the pooled
+    model, tables and models without a NumPy form are returned as they are.
+
+    Args:
+        model: A fitted GPy model, a `pooling.DriverModel`, a
+            `tabulation.TabulatedModel` or None
+        backend (str): One of `INFERENCE_BACKENDS`
+    """
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend}, expected one of {INFERENCE_BACKENDS}")
+    if backend == 'gpy' or model is None or isinstance(model, (TabulatedModel, NumpyGP)):
+        return model
+    if isinstance(model, DriverModel):
+        return DriverModel(with_backend(model.model, backend), model.driver_index)
+    try:
+        return export_model(model)
+    except ValueError:
+        return model
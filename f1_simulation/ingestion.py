@@ -0,0 +1,184 @@
+import argparse
+import os
+from typing import Dict, FrozenSet, List, NamedTuple, Optional
+
+import pandas as pd
+
+import elo
+from context import SimulationContext, get_context
+from dataprocessing import F1Dataset
+from features import FeatureStore
+from model_store import ModelStore
+from pit_stopping.pit_stop_model import MIN_SAMPLES_REQUIRED, MIN_SAMPLES_REQUIRED_PIT_DECISION
+
+# Datasets whose rows belong to a single race, appended race by race
+RACE_DATASETS = ['races', 'results', 'qualifying', 'lap_times', 'pit_stops']
+# Datasets referenced by ID from the race datasets, appended when a race
+# brings a new driver, constructor or circuit
+REFERENCE_DATASETS = {'drivers': 'driverId', 'constructors': 'constructorId', 'circuits': 'circuitId'}
+
+
+class IngestedRace(NamedTuple):
+    """What a newly added race touches, to decide which models it affects"""
+    race_id: int
+    year: int
+    circuit_id: int
+    drivers: FrozenSet[int]
+    constructors: FrozenSet[int]
+
+
+def read_source(dirpath: str) -> Dict[str, pd.DataFrame]:
+    """Reads a newer copy of the F1 CSVs, e.g. a fresh download of the
+    Kaggle dataset, as untyped strings so rows are appended exactly as written
+
+    Args:
+        dirpath (str): The directory with the newer CSVs in
+
+    Returns:
+        Dict[str, pd.DataFrame]: The race and reference datasets found
+    """
+    source = {}
+    for dataset in RACE_DATASETS + list(REFERENCE_DATASETS):
+        path = os.path.join(dirpath, dataset + '.csv')
+        if os.path.exists(path):
+            source[dataset] = pd.read_csv(path, dtype=str, keep_default_na=False)
+    return source
+
+
+def new_race_ids(data: F1Dataset, source: Dict[str, pd.DataFrame]) -> List[int]:
+    """Returns the races with results in `source` that aren't in `data`, in date order"""
+    races = source['races'].loc[source['races']['raceId'].astype(int).isin(source['results']['raceId'].astype(int))]
+    races = races.loc[~races['raceId'].astype(int).isin(data.races['raceId'])]
+    return races.sort_values(by=['date', 'raceId'])['raceId'].astype(int).tolist()
+
+
+def stale_model(key: List, race: IngestedRace, features: FeatureStore) -> bool:
+    """Whether the stored model with `key` is fit on data that changed when
+    `race` was added. Models that fall back to the whole history because they
+    have too few samples of their own are always affected.
+
+    Args:
+        key (List): The model's key in the `ModelStore`
+        race (IngestedRace): The race added
+        features (FeatureStore): The features, already including the race
+
+    Returns:
+        bool: Whether the model needs refitting
+    """
+    kind = key[0]
+    if kind == 'lap_time':
+        return key[1] in race.drivers and key[2] == race.year
+    if kind == 'overtaking':
+        return key[1] in race.drivers
+    if kind in ('lap_time_pooled', 'overtaking_pooled'):
+        return key[1] == race.year
+    if kind == 'pit_stop':
+        return key[1] == race.circuit_id or len(features.circuit_pit_laps(key[1])) < MIN_SAMPLES_REQUIRED_PIT_DECISION
+    if kind == 'pit_stop_duration':
+        return key[1] in race.constructors or len(features.constructor_pit_durations(key[1])) < MIN_SAMPLES_REQUIRED
+    return True
+
+
+def ingest_race(data: F1Dataset, race_id: int, source: Dict[str, pd.DataFrame],
+                features: Optional[FeatureStore] = None, model_store: Optional[ModelStore] = None,
+                context: Optional[SimulationContext] = None) -> IngestedRace:
+    """Adds one race to the dataset without reprocessing the races before it.
+    The race's rows, and any drivers, constructors or circuits new with it,
+    are appended to the CSVs and binary cache, its Elo ratings are computed
+    from the last stored ratings, the shared features are extended with it
+    and only the models it affects are marked stale, see `stale_model`.
+
+    Args:
+        data (F1Dataset): The dataset to add the race to
+        race_id (int): The ID of the race
+        source (Dict[str, pd.DataFrame]): The newer CSVs, see `read_source`
+        features (Optional[FeatureStore]): The shared features to extend,
+            `context`'s if not given
+        model_store (Optional[ModelStore]): The fitted models to bring up to date
+        context (Optional[SimulationContext]): The context whose fitted
+            models the race makes stale are dropped, the data directory's if
+            not given
+
+    Returns:
+        IngestedRace: What the race touched
+    """
+    context = context if context is not None else get_context(data.dirpath, data)
+    features = features if features is not None else context.features
+    before = data.fingerprint(data.datasets)
+
+    race_rows = {dataset: rows.loc[rows['raceId'].astype(int) == race_id]
+                 for dataset, rows in source.items() if dataset in RACE_DATASETS}
+    for dataset, column in REFERENCE_DATASETS.items():
+        if dataset in source and dataset in data.datasets:
+            ids = source[dataset][column].astype(int)
+            referenced = pd.concat([rows[column].astype(int) for rows in race_rows.values() if column in rows])
+            new_rows = source[dataset].loc[ids.isin(referenced) & ~ids.isin(getattr(data, dataset)[column])]
+            if len(new_rows):
+                data.append(dataset, new_rows)
+    for dataset, rows in race_rows.items():
+        if dataset in data.datasets and len(rows):
+            data.append(dataset, rows)
+
+    if 'elo_ratings' in data.datasets:
+        elo.update_elo_ratings(data, [race_id])
+
+    features.append_race(race_id)
+
+    race = data.races.loc[data.races['raceId'] == race_id].iloc[0]
+    results = data.results.loc[data.results['raceId'] == race_id]
+    ingested = IngestedRace(race_id, int(race['year']), int(race['circuitId']),
+                            frozenset(results['driverId'].astype(int)), frozenset(results['constructorId'].astype(int)))
+
+    for key in list(context.pit_stop_models):
+        if stale_model(['pit_stop', *key], ingested, features):
+            del context.pit_stop_models[key]
+    for key in list(context.pit_stop_tables):
+        if stale_model(['pit_stop', *key[:3]], ingested, features):
+            del context.pit_stop_tables[key]
+    for key in list(context.pit_stop_duration_tables):
+        if stale_model(['pit_stop_duration', *key[:2]], ingested, features):
+            del context.pit_stop_duration_tables[key]
+    for key in list(context.pooled_models):
+        if stale_model(list(key), ingested, features):
+            del context.pooled_models[key]
+    if model_store is not None:
+        model_store.carry_forward(before, data.fingerprint(data.datasets),
+                                  lambda key: stale_model(key, ingested, features))
+    return ingested
+
+
+def ingest_new_races(data: F1Dataset, source_dirpath: str, features: Optional[FeatureStore] = None,
+                     model_store: Optional[ModelStore] = None,
+                     context: Optional[SimulationContext] = None) -> List[IngestedRace]:
+    """Adds every race in a newer copy of the CSVs that the dataset doesn't
+    have yet, oldest first, see `ingest_race`
+
+    Args:
+        data (F1Dataset): The dataset to add the races to
+        source_dirpath (str): The directory with the newer CSVs in
+        features (Optional[FeatureStore]): The shared features to extend
+        model_store (Optional[ModelStore]): The fitted models to bring up to date
+        context (Optional[SimulationContext]): The context whose stale
+            fitted models are dropped
+
+    Returns:
+        List[IngestedRace]: What each race added touched
+    """
+    source = read_source(source_dirpath)
+    return [ingest_race(data, race_id, source, features, model_store, context)
+            for race_id in new_race_ids(data, source)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Add the races in a newer copy of the F1 CSVs to the dataset')
+    parser.add_argument('source', help='directory with the newer CSVs')
+    parser.add_argument('--data', default='data', help='directory with the dataset to update')
+    parser.add_argument('--models', default='models', help='directory of the fitted model store')
+    args = parser.parse_args()
+
+    data = F1Dataset(args.data)
+    model_store = ModelStore(args.models)
+    for race in ingest_new_races(data, args.source, model_store=model_store):
+        print(f'Added race {race.race_id} ({race.year}, circuit {race.circuit_id}) '
+              f'with {len(race.drivers)} drivers')
+    print(model_store)
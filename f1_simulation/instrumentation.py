@@ -0,0 +1,194 @@
+import bisect
+import csv
+import functools
+import json
+import os
+from contextlib import contextmanager
+from timeit import default_timer as timer
+from typing import Any, Callable, Dict, List, Optional
+
+# Upper bounds in seconds of the latency histogram buckets, four per decade
+# from a microsecond to 100 seconds, the last bucket catching anything slower
+BUCKET_BOUNDS = [10 ** (exponent / 4) for exponent in range(-24, 9)]
+
+
+class Histogram:
+    """Latency histogram over `BUCKET_BOUNDS`, with the count, total, minimum
+    and maximum of the recorded durations"""
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.min = float('inf')
+        self.max = 0.
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+
+    def merge(self, other: Dict[str, Any]):
+        """Adds in a histogram exported by `to_dict`"""
+        self.count += other['count']
+        self.total += other['total']
+        self.min = min(self.min, other['min'])
+        self.max = max(self.max, other['max'])
+        self.buckets = [a + b for a, b in zip(self.buckets, other['buckets'])]
+
+    def quantile(self, q: float) -> float:
+        """Estimates a quantile as the upper bound of the bucket it falls in,
+        capped at the largest duration recorded"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS + [self.max], self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(count=self.count, total=self.total, min=self.min, max=self.max,
+                    mean=self.total / self.count if self.count else 0.,
+                    p50=self.quantile(0.5), p95=self.quantile(0.95), p99=self.quantile(0.99),
+                    buckets=list(self.buckets))
+
+
+class _NullTimer:
+    """Context manager that does nothing, handed out while disabled"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Instrumentation:
+    """Registry of named counters and latency histograms. While disabled,
+    `timer` returns a shared no-op context manager and `count`, `record` and
+    functions wrapped by `timed` return after a single flag check, so the
+    instrumentation can stay in the hot paths.
+
+    Stage names are dotted, e.g. `dataset.load`, `model.fit.lap_time`,
+    `sample.overtake`, `simulation.lap`.
+
+        Args:
+            enabled (bool): Whether to record from the start
+    """
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.counters: Dict[str, int] = {}
+        self.histograms: Dict[str, Histogram] = {}
+
+    def __repr__(self) -> str:
+        return f'Instrumentation(enabled={self.enabled}, {len(self.counters)} counters, {len(self.histograms)} histograms)'
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        """Drops everything recorded"""
+        self.counters.clear()
+        self.histograms.clear()
+
+    def count(self, name: str, n: int = 1):
+        """Adds `n` to counter `name`"""
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name: str, seconds: float):
+        """Records a duration in histogram `name`"""
+        if self.enabled:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.record(seconds)
+
+    def timer(self, name: str):
+        """Context manager recording the duration of its block in histogram `name`"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return self._timer(name)
+
+    @contextmanager
+    def _timer(self, name: str):
+        start = timer()
+        try:
+            yield
+        finally:
+            self.record(name, timer() - start)
+
+    def timed(self, name: str) -> Callable[[Callable], Callable]:
+        """Decorator recording the duration of every call in histogram `name`"""
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                start = timer()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(name, timer() - start)
+            return wrapper
+        return decorator
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Returns everything recorded as plain values"""
+        return dict(counters=dict(self.counters),
+                    histograms={name: histogram.to_dict() for name, histogram in sorted(self.histograms.items())})
+
+    def merge(self, snapshot: Dict[str, Any]):
+        """Adds in a `snapshot` from another registry, e.g. a worker process's"""
+        for name, n in snapshot['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + n
+        for name, histogram in snapshot['histograms'].items():
+            self.histograms.setdefault(name, Histogram()).merge(histogram)
+
+    def rows(self) -> List[Dict[str, Any]]:
+        """Returns one row per counter and histogram, without the buckets"""
+        rows = [dict(name=name, kind='counter', count=n) for name, n in sorted(self.counters.items())]
+        for name, histogram in sorted(self.histograms.items()):
+            summary = histogram.to_dict()
+            del summary['buckets']
+            rows.append(dict(name=name, kind='histogram', **summary))
+        return rows
+
+    def export(self, path: str):
+        """Writes everything recorded to `path`, as CSV rows from `rows` if it
+        ends in `.csv` and as the JSON `snapshot` otherwise"""
+        if os.path.splitext(path)[1] == '.csv':
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=['name', 'kind', 'count', 'total', 'min', 'max', 'mean',
+                                                       'p50', 'p95', 'p99'])
+                writer.writeheader()
+                writer.writerows(self.rows())
+        else:
+            with open(path, 'w') as f:
+                json.dump(self.snapshot(), f, indent=2)
+
+    def report(self) -> str:
+        """Returns a table of the counters and latencies, slowest stages first"""
+        lines = [f'{"stage":<36}{"count":>10}{"total s":>12}{"mean ms":>12}{"p95 ms":>12}']
+        for name, histogram in sorted(self.histograms.items(), key=lambda item: -item[1].total):
+            lines.append(f'{name:<36}{histogram.count:>10}{histogram.total:>12.3f}'
+                         f'{1000 * histogram.total / histogram.count:>12.3f}{1000 * histogram.quantile(0.95):>12.3f}')
+        for name, n in sorted(self.counters.items()):
+            lines.append(f'{name:<36}{n:>10}')
+        return '\n'.join(lines)
+
+
+# The registry the simulation reports to, enabled from the start if the
+# F1_INSTRUMENTATION environment variable is set to 1
+instrumentation = Instrumentation(enabled=os.environ.get('F1_INSTRUMENTATION') == '1')
@@ -1 +1 @@
-from lap_times.lap_time_model import make_lap_time_process
\ No newline at end of file
+from lap_times.lap_time_model import make_lap_time_process, make_batched_lap_time_process, fit_lap_time_model, fit_pooled_lap_time_model, draw_lap_time_trajectories
\ No newline at end of file
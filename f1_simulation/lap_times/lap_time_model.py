@@ -1,71 +1,228 @@
+from __future__ import annotations
+
 import numpy as np
-from typing import Callable, Tuple
-from dataprocessing import F1Dataset
+from typing import Callable, Optional, Sequence, Tuple
+from context import SimulationContext, get_context
+from model_store import ModelStore, fit_or_load
+from features import FeatureStore
+from pooling import PooledModel, driver_offset_kernel, get_pooled_model
+from utils import lazy_import
 import pandas as pd
-import GPy
 import datetime
+from timeit import default_timer as timer
+
+GPy = lazy_import('GPy')
+
+LAP_TIME_SOURCES = ['races', 'qualifying', 'lap_times', 'pit_stops']
+
+# Above this many laps the exact GP's cubic fit cost dominates, so the lap
+# time model switches to an inducing point approximation by default
+MAX_EXACT_LAPS = 2000
+DEFAULT_NUM_INDUCING = 100
+
+
+def get_lap_time_training_data(driver_id: int, year: int, normalise_pit_laps: bool = True,
+                               features: Optional[FeatureStore] = None,
+                               context: Optional[SimulationContext] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Builds the lap time model's `[n, 2]` inputs (race progress, laps since
+    pit stop) and `[n, 1]` targets (lap time relative to the fastest
+    qualifying time) from a driver's laps in a given year, from `context`'s
+    features if not given
+    """
+    context = context if context is not None else get_context()
+    features = features if features is not None else context.features
+    laps = features.driver_laps(driver_id, year)
+    laps_since_pit = laps['laps_since_pit'] / laps['lap_n'] if normalise_pit_laps else laps['laps_since_pit']
+    return (np.stack([laps['lap_r'].values, laps_since_pit.values], axis=1).astype(float),
+            laps['rel_time'].values.reshape([-1, 1]).astype(float))
+
+
+def build_lap_time_model(X: np.ndarray, Y: np.ndarray, num_inducing: Optional[int] = None) -> GPy.core.GP:
+    """Makes the unoptimised lap time GP. An exact GP is used unless
+    `num_inducing` is given, or the data has more than `MAX_EXACT_LAPS` rows,
+    in which case a sparse GP with that many (or `DEFAULT_NUM_INDUCING`)
+    inducing points spread through the data is used instead.
+    """
+    kernel = GPy.kern.RBF(input_dim=2)
+    if num_inducing is None and len(X) > MAX_EXACT_LAPS:
+        num_inducing = DEFAULT_NUM_INDUCING
+    if num_inducing is None or num_inducing >= len(X):
+        return GPy.models.GPRegression(X, Y, kernel)
+    Z = X[np.linspace(0, len(X) - 1, num_inducing).astype(int)]
+    return GPy.models.SparseGPRegression(X, Y, kernel, Z=Z.copy())
+
+
+def fit_lap_time_model(driver_id: int, year: int, normalise_pit_laps: bool = True,
+                       model_store: Optional[ModelStore] = None,
+                       num_inducing: Optional[int] = None,
+                       features: Optional[FeatureStore] = None,
+                       context: Optional[SimulationContext] = None) -> GPy.core.GP:
+    """Fits the GP mapping (race progress, laps since pit stop) to lap time
+    relative to the fastest qualifying time for a driver in a given year.
+
+    Args:
+        driver_id (int): The driver ID in the F1Dataset
+        year (int): The season whose laps the model is trained on
+        normalise_pit_laps (bool): Whether laps since pit stop is given as a
+            ratio of the race distance
+        model_store (Optional[ModelStore]): Store to load the fitted model
+            from or save it to, `context`'s if not given
+        num_inducing (Optional[int]): Number of inducing points for a sparse
+            GP, see `build_lap_time_model`
+        features (Optional[FeatureStore]): The features to train on,
+            `context`'s if not given
+        context (Optional[SimulationContext]): The simulation's context, that
+            of the 'data' directory if not given
+
+    Returns:
+        GPy.core.GP: The optimised lap time model
+    """
+    context = context if context is not None else get_context()
+    features = features if features is not None else context.features
+    model_store = model_store if model_store is not None else context.model_store
+    return fit_or_load(model_store, ('lap_time', driver_id, year, normalise_pit_laps, num_inducing),
+                       lambda X, Y: build_lap_time_model(X, Y, num_inducing),
+                       lambda: get_lap_time_training_data(driver_id, year, normalise_pit_laps, features),
+                       lambda: features.data.fingerprint(LAP_TIME_SOURCES))
+
+
+def get_pooled_lap_time_training_data(year: int, normalise_pit_laps: bool = True,
+                                      features: Optional[FeatureStore] = None,
+                                      context: Optional[SimulationContext] = None
+                                      ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Builds the pooled lap time model's `[n, 3]` inputs, those of
+    `get_lap_time_training_data` with the driver's index appended, and `[n, 1]`
+    targets from every driver's laps in a given year, along with the sorted
+    driver IDs the indices refer to
+    """
+    context = context if context is not None else get_context()
+    features = features if features is not None else context.features
+    laps = features.season_laps(year)
+    driver_ids = laps.index.unique().values
+    laps_since_pit = laps['laps_since_pit'] / laps['lap_n'] if normalise_pit_laps else laps['laps_since_pit']
+    X = np.stack([laps['lap_r'].values, laps_since_pit.values, np.searchsorted(driver_ids, laps.index.values)], axis=1)
+    return X.astype(float), laps['rel_time'].values.reshape([-1, 1]).astype(float), driver_ids
+
+
+def build_pooled_lap_time_model(X: np.ndarray, Y: np.ndarray, num_drivers: int,
+                                num_inducing: Optional[int] = None) -> GPy.core.GP:
+    """Makes the unoptimised pooled lap time GP: a lap time curve shared by
+    every driver plus an offset per driver, see `pooling.driver_offset_kernel`.
+    It has no constructor term. Like the drivers' own lap time models, it
+    ignores the constructor. Within a season a driver almost always drives
+    for one team, so their offset takes in the car as well as the driver.
+    As a season of laps is too many for an exact GP, a sparse GP with
+    `num_inducing` (or `DEFAULT_NUM_INDUCING`) inducing points spread through
+    the data is used unless the data has at most `MAX_EXACT_LAPS` rows. The
+    inducing points are fixed so they stay on whole driver indices.
+    """
+    kernel = GPy.kern.RBF(input_dim=2, active_dims=[0, 1]) + driver_offset_kernel(num_drivers, column=2)
+    if num_inducing is None and len(X) <= MAX_EXACT_LAPS:
+        return GPy.models.GPRegression(X, Y, kernel)
+    num_inducing = num_inducing if num_inducing is not None else DEFAULT_NUM_INDUCING
+    Z = X[np.linspace(0, len(X) - 1, min(num_inducing, len(X))).astype(int)]
+    model = GPy.models.SparseGPRegression(X, Y, kernel, Z=Z.copy())
+    model.inducing_inputs.fix()
+    return model
+
+
+def fit_pooled_lap_time_model(year: int, normalise_pit_laps: bool = True,
+                              model_store: Optional[ModelStore] = None,
+                              num_inducing: Optional[int] = None,
+                              features: Optional[FeatureStore] = None,
+                              context: Optional[SimulationContext] = None) -> PooledModel:
+    """Fits one lap time GP on every driver's laps in a given year, once per
+    context, for all the season's racers to share. A driver's view of it,
+    `PooledModel.for_driver`, can be passed to the lap time processes in place
+    of their own model from `fit_lap_time_model`, so fitting a grid costs one
+    optimisation rather than one per driver.
+
+    Args:
+        year (int): The season whose laps the model is trained on
+        normalise_pit_laps (bool): Whether laps since pit stop is given as a
+            ratio of the race distance
+        model_store (Optional[ModelStore]): Store to load the fitted model
+            from or save it to, `context`'s if not given
+        num_inducing (Optional[int]): Number of inducing points, see
+            `build_pooled_lap_time_model`
+        features (Optional[FeatureStore]): The features to train on,
+            `context`'s if not given
+        context (Optional[SimulationContext]): The simulation's context,
+            which keeps the fitted model, that of the 'data' directory if not given
+
+    Returns:
+        PooledModel: The optimised model and the driver IDs it was fit on
+    """
+    context = context if context is not None else get_context()
+    features = features if features is not None else context.features
+    model_store = model_store if model_store is not None else context.model_store
+    key = ('lap_time_pooled', year, normalise_pit_laps, num_inducing)
+
+    def fit() -> PooledModel:
+        X, Y, driver_ids = get_pooled_lap_time_training_data(year, normalise_pit_laps, features)
+        model = fit_or_load(model_store, key,
+                            lambda X, Y: build_pooled_lap_time_model(X, Y, len(driver_ids), num_inducing),
+                            lambda: (X, Y),
+                            lambda: features.data.fingerprint(LAP_TIME_SOURCES))
+        return PooledModel(model, driver_ids)
+
+    return get_pooled_model(key, fit, context)
+
+
+def compare_lap_time_backends(
+        driver_id: int,
+        year: int,
+        inducing_counts: Sequence[int] = (10, 25, 50, 100, 200),
+        test_fraction: float = 0.2,
+        normalise_pit_laps: bool = True,
+        seed: int = 0,
+        features: Optional[FeatureStore] = None,
+) -> pd.DataFrame:
+    """Shows the accuracy against fit time trade-off of the sparse lap time
+    model by fitting the exact GP and a sparse GP for each inducing point
+    count on the same random split of a driver's laps.
+
+    Args:
+        driver_id (int): The driver ID in the F1Dataset
+        year (int): The season whose laps the models are trained on
+        inducing_counts (Sequence[int]): The inducing point counts to try
+        test_fraction (float): The fraction of laps held out for scoring
+        normalise_pit_laps (bool): Whether laps since pit stop is given as a
+            ratio of the race distance
+        seed (int): Seed for the train/test split
+        features (Optional[FeatureStore]): The features to train on
+
+    Returns:
+        pd.DataFrame: One row per model with its number of inducing points
+            (None for the exact GP), fit time in seconds, held-out RMSE of the
+            relative lap time and held-out mean negative log predictive density
+    """
+    X, Y = get_lap_time_training_data(driver_id, year, normalise_pit_laps, features)
+    test = np.random.default_rng(seed).random(len(X)) < test_fraction
 
-processed_laps = dict()
-processed_pits = dict()
-
-
-def get_or_load_data(year: int) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    # return data if it was already processed
-    global processed_laps
-    global processed_pits
-    if year in processed_pits:
-        print("already processed")
-        return processed_laps[year], processed_pits[year]
-
-    data = F1Dataset('data')
-    races = data.races
-    years_races = races.loc[races['year'] == year][['raceId', 'circuitId']]
-
-    # load qualification data,obtain fastest quali time at each race for normalisation purposes
-    qualis = data.qualifying
-    qrs = qualis.merge(years_races, on='raceId')
-    qrs = qrs.loc[~pd.isnull(qrs['q3'])]
-    top_time_idx = qrs.groupby(['raceId'])['q3'].transform(min) == qrs['q3']
-    top_times = qrs[top_time_idx][['q3', 'raceId']]
-    top_times['q3'] = pd.to_datetime(top_times['q3'], format='%M:%S.%f') \
-                      - pd.to_datetime('00:00.000000', format='%M:%S.%f')
-
-    # load lap times, process time string to timedelta, obtain number of laps in each race
-    lap_times = data.lap_times
-    years_laps = lap_times.merge(years_races, on='raceId')[['milliseconds', 'raceId', 'driverId', 'lap']]
-    years_laps = years_laps.assign(time=pd.to_timedelta(years_laps['milliseconds'], unit='ms'))
-    rc_laps = years_laps.groupby(['raceId'])['lap'].transform(max) == years_laps['lap']
-    race_laps = years_laps[rc_laps][['raceId', 'lap']].drop_duplicates(ignore_index=True)
-
-    # load pit stops, filter other years, process time and increase lap number for lap time sanitisation
-    pit_stops = data.pit_stops
-    years_pits = pit_stops.merge(years_races, on='raceId').loc[:, ['milliseconds', 'raceId', 'driverId', 'lap']]
-    years_pits = years_pits.assign(time=pd.to_timedelta(years_pits['milliseconds'], unit='ms'))
-    years_pits['lap'] += 1
-
-    # subtract pitstop time from lap time to have lower impact on lap times
-    pitted_laps = years_laps.merge(years_pits, on=['raceId', 'lap', 'driverId'], suffixes=['_laps', '_pits'])
-    pitted_laps = pitted_laps.assign(time=pitted_laps['time_laps'] - pitted_laps['time_pits'])
-    pitted_laps.set_index(['raceId', 'lap', 'driverId'], inplace=True)
-    years_laps.set_index(['raceId', 'lap', 'driverId'], inplace=True)
-    years_laps.update(pitted_laps)
-    years_laps.reset_index(inplace=True)
-    pitted_laps.reset_index(inplace=True)
-
-    # transform lap idx to ratio of whole race for normalisation of progress across races
-    normalised_laps = years_laps.merge(race_laps, on='raceId', suffixes=['_idx', '_n'])
-    normalised_laps = normalised_laps.assign(lap_r=normalised_laps['lap_idx'] / normalised_laps['lap_n'])
-
-    # transform lap time into ratio of original time to fastest quali time at the race for normalisation across races
-    normalised_laps = normalised_laps.merge(top_times, on='raceId')
-    normalised_laps = normalised_laps.assign(
-        rel_time=normalised_laps['time']/normalised_laps['q3']).loc[
-                      :, ['raceId', 'driverId', 'lap_idx', 'lap_r', 'lap_n', 'rel_time']]
-
-    processed_laps[year] = normalised_laps
-    processed_pits[year] = pitted_laps
-
-    return normalised_laps, pitted_laps
+    rows = []
+    for num_inducing in [None, *inducing_counts]:
+        before = timer()
+        model = build_lap_time_model(X[~test], Y[~test], num_inducing=num_inducing)
+        model.optimize(messages=False)
+        fit_time = timer() - before
+
+        mean, var = model.predict(X[test])
+        rmse = np.sqrt(np.mean((mean - Y[test]) ** 2))
+        nlpd = np.mean(0.5 * np.log(2 * np.pi * var) + (Y[test] - mean) ** 2 / (2 * var))
+        rows.append(dict(num_inducing=num_inducing, fit_time=fit_time, rmse=rmse, nlpd=nlpd))
+    return pd.DataFrame(rows)
+
+
+def lap_time_inputs(lap, laps_since_pitstop, total_laps: int, normalise_pit_laps: bool = True) -> np.ndarray:
+    """Builds the `[n, 2]` model inputs for laps and laps since pit stop, which
+    may be scalars or arrays of equal length
+    """
+    lap = np.broadcast_to(np.asarray(lap, dtype=float), np.shape(laps_since_pitstop))
+    laps_since_pitstop = np.asarray(laps_since_pitstop, dtype=float)
+    if normalise_pit_laps:
+        laps_since_pitstop = laps_since_pitstop / total_laps
+    return np.stack([np.ravel(lap) / total_laps, np.ravel(laps_since_pitstop)], axis=1)
 
 
 def make_lap_time_process(
@@ -74,45 +231,97 @@ def make_lap_time_process(
         total_laps: int,
         top_quali: datetime.timedelta,
         normalise_pit_laps: bool = True,
+        model: Optional[GPy.core.GP] = None,
+        model_store: Optional[ModelStore] = None,
+        num_inducing: Optional[int] = None,
+        features: Optional[FeatureStore] = None,
+        context: Optional[SimulationContext] = None,
 ) -> Callable[[int, int], float]:
 
-    normalised_laps, years_pits = get_or_load_data(year)
-
-    # filter out rows with data of other drivers
-    normalised_laps = normalised_laps.loc[normalised_laps['driverId'] == driver_id]
-    years_pits = years_pits.loc[years_pits['driverId'] == driver_id]
-
-    # define function to create laps since pitstop column and create it
-    def laps_since_pit(race_id, lap_idx, laps):
-        last_pit = years_pits.loc[(years_pits['raceId'] == race_id) & (years_pits['lap'] <= lap_idx)]['lap'].max()
-        if pd.isnull(last_pit):
-            res = lap_idx
-        else:
-            res = lap_idx - last_pit
-        if normalise_pit_laps:
-            return res / laps
-        else:
-            return res
-
-    normalised_laps = normalised_laps.assign(
-        laps_since_pit=normalised_laps.apply(lambda row: laps_since_pit(
-            row['raceId'], row['lap_idx'], row['lap_n']), axis=1))
-
-    # create model and optimise
-    kernel = GPy.kern.RBF(input_dim=2)
-    model = GPy.models.GPRegression(normalised_laps.loc[:, ['lap_r', 'laps_since_pit']].values.reshape([-1, 2]),
-                                    normalised_laps.loc[:, 'rel_time'].values.reshape([-1, 1]), kernel)
-    model.optimize(messages=False)
+    if model is None:
+        model = fit_lap_time_model(driver_id, year, normalise_pit_laps, model_store, num_inducing, features, context)
 
     # return prediction
-    if normalise_pit_laps:
-        return lambda lap, laps_since_pitstop: model.posterior_samples_f(
-            np.array([[lap, laps_since_pitstop]]) / total_laps, size=1)[0, 0, 0] * top_quali
-    else:
-        return lambda lap, laps_since_pitstop: model.posterior_samples_f(
-            np.array([[lap / total_laps, laps_since_pitstop]]), size=1)[0, 0, 0] * top_quali
+    return lambda lap, laps_since_pitstop: model.posterior_samples_f(
+        lap_time_inputs(lap, laps_since_pitstop, total_laps, normalise_pit_laps), size=1)[0, 0, 0] * top_quali
+
+
+def make_batched_lap_time_process(
+        model: GPy.core.GP,
+        total_laps: int,
+        top_quali: datetime.timedelta,
+        normalise_pit_laps: bool = True,
+) -> Callable[[int, np.ndarray], Tuple[np.ndarray, np.ndarray]]:
+    """Makes the array form of the lap time process used by the batched race
+    engine. Rather than drawing samples, it returns the predictive mean and
+    standard deviation of the lap time in milliseconds so that the caller
+    controls the random draws.
+
+    Only the distinct laps since pit stop values are sent through the GP, as
+    there are at most `lap + 1` of them whatever the number of simulations.
+
+    Args:
+        model (GPy.core.GP): A model from `fit_lap_time_model`
+        total_laps (int): The number of laps in the race
+        top_quali (datetime.timedelta): The fastest qualifying time
+        normalise_pit_laps (bool): Must match the value the model was fit with
+
+    Returns:
+        Callable[[int, np.ndarray], Tuple[np.ndarray, np.ndarray]]: Takes the
+            lap and an array of laps since pit stop and returns the mean and
+            standard deviation of the lap time for each entry
+    """
+    top_quali_ms = top_quali / np.timedelta64(1, 'ms')
+
+    def batched_lap_time(lap: int, laps_since_pitstop: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        unique, inverse = np.unique(laps_since_pitstop, return_inverse=True)
+        mean, var = model.predict(lap_time_inputs(lap, unique, total_laps, normalise_pit_laps),
+                                  include_likelihood=False)
+        mean = mean[:, 0] * top_quali_ms
+        std = np.sqrt(np.maximum(var[:, 0], 0)) * top_quali_ms
+        return mean[inverse], std[inverse]
+
+    return batched_lap_time
+
+
+def draw_lap_time_trajectories(
+        model: GPy.core.GP,
+        total_laps: int,
+        top_quali: datetime.timedelta,
+        n_trajectories: int,
+        normalise_pit_laps: bool = True,
+        rng: Optional[np.random.Generator] = None,
+) -> np.ndarray:
+    """Draws whole-race lap time trajectories from the joint GP posterior over
+    every `(lap, laps_since_pit)` input the race can reach, so that a driver's
+    pace is coherent from one lap to the next. As a racer starts with no laps
+    since a stop, on lap `l` it can only have done `0..l` laps since pitting,
+    leaving a triangle of `total_laps * (total_laps + 1) / 2` inputs that are
+    all sampled with a single factorisation of their covariance.
+
+    Args:
+        model (GPy.core.GP): A model from `fit_lap_time_model`
+        total_laps (int): The number of laps in the race
+        top_quali (datetime.timedelta): The fastest qualifying time
+        n_trajectories (int): The number of trajectories to draw
+        normalise_pit_laps (bool): Must match the value the model was fit with
+        rng (Optional[np.random.Generator]): Source of randomness
 
+    Returns:
+        np.ndarray: `[n_trajectories, total_laps, total_laps]` lap times in
+            milliseconds indexed by trajectory, lap and laps since pit stop,
+            NaN where the input is unreachable
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    laps, laps_since_pitstop = np.tril_indices(total_laps)
+    mean, cov = model.predict(lap_time_inputs(laps, laps_since_pitstop, total_laps, normalise_pit_laps),
+                              full_cov=True, include_likelihood=False)
+    # a symmetric square root rather than a Cholesky factor, as the posterior
+    # covariance of a sparse model is low rank
+    eigenvalues, eigenvectors = np.linalg.eigh(cov)
+    root = eigenvectors * np.sqrt(np.maximum(eigenvalues, 0))
+    samples = mean[:, 0] + rng.standard_normal((n_trajectories, len(laps))) @ root.T
 
-if __name__ == '__main__':
-    f = make_lap_time_process(842, 2020, 60, datetime.timedelta(minutes=1.2))
-    print(f(30, 15))
+    trajectories = np.full((n_trajectories, total_laps, total_laps), np.nan)
+    trajectories[:, laps, laps_since_pitstop] = samples * (top_quali / np.timedelta64(1, 'ms'))
+    return trajectories
@@ -0,0 +1,139 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from batch_simulation import simulate_races
+from f1_racer import F1Racer
+from gp_inference import NumpyGP, with_backend
+from instrumentation import instrumentation
+from lap_times.lap_time_model import lap_time_inputs
+from pooling import DriverModel, with_driver_column
+from race_state import RaceState
+
+
+def lap_time_posterior(racer: F1Racer) -> NumpyGP:
+    """The NumPy posterior of a racer's lap time model, the pooled model's
+    for a racer on a view of one"""
+    model = with_backend(racer.lap_time_model, 'numpy')
+    posterior = model.model if isinstance(model, DriverModel) else model
+    if not isinstance(posterior, NumpyGP):
+        raise ValueError(f"The lap time model of driver {racer.driver} has no NumPy form to condition")
+    return posterior
+
+
+class LiveRace:
+    """Follows a race as it is run, conditioning each racer's lap time model
+    on the laps they are seen to drive and re-simulating the rest of the race
+    from where it stands.
+
+    Refitting the models between laps is far too slow, so each racer's
+    fitted model is exported once to NumPy, see `gp_inference.NumpyGP`, and
+    every observed lap updates the posterior with the hyperparameters kept:
+    an exact model's Cholesky factor gains a row, a sparse model takes a
+    rank-one update. Racers on the same pooled model share one posterior,
+    which learns from every driver's laps. The conditioned models are swapped
+    into the racers, see `F1Racer.use_lap_time_model`, so the racers given
+    belong to this race from then on.
+
+        Args:
+            racers (List[F1Racer]): The racers at the start of the race
+            num_laps (int): The number of laps that the race lasts for
+            normalise_pit_laps (bool): Must match the value the lap time
+                models were fit with
+
+        Attributes:
+            state (RaceState): The state at the start of the next lap
+            lap (int): The next lap, the number of laps observed
+    """
+    __slots__ = ('racers', 'num_laps', 'normalise_pit_laps', 'state', 'lap')
+
+    def __init__(self, racers: List[F1Racer], num_laps: int, normalise_pit_laps: bool = True):
+        self.racers = racers
+        self.num_laps = num_laps
+        self.normalise_pit_laps = normalise_pit_laps
+        self.state = RaceState.from_racers(racers)
+        self.lap = 0
+        with instrumentation.timer('live.export'):
+            for posterior, rows in self.posterior_groups():
+                # room for every lap the racers on the posterior will drive
+                self.use_posterior(rows, posterior.reserve(len(rows) * num_laps))
+
+    def __repr__(self) -> str:
+        return f'LiveRace(lap={self.lap}, num_laps={self.num_laps}, state={self.state})'
+
+    def posterior_groups(self) -> List[Tuple[NumpyGP, List[int]]]:
+        """The racers' lap time posteriors, each with the indices of the
+        racers on it"""
+        groups: Dict[int, Tuple[NumpyGP, List[int]]] = {}
+        for i, racer in enumerate(self.racers):
+            posterior = lap_time_posterior(racer)
+            groups.setdefault(id(posterior), (posterior, []))[1].append(i)
+        return list(groups.values())
+
+    def use_posterior(self, rows: Sequence[int], posterior: NumpyGP):
+        """Has the racers at `rows` sample their lap times from `posterior`"""
+        for i in rows:
+            racer = self.racers[i]
+            model = racer.lap_time_model
+            racer.use_lap_time_model(DriverModel(posterior, model.driver_index) if isinstance(model, DriverModel)
+                                     else posterior, self.normalise_pit_laps)
+
+    def observe_lap(self, lap_times: Sequence[float], pit_durations: Optional[Sequence[float]] = None) -> RaceState:
+        """Conditions the racers' lap time models on the lap just driven and
+        moves the race state on to the start of the next lap. As the models
+        are trained, a lap's time less any time spent in the pits is what each
+        model observes, relative to the fastest qualifying time.
+
+        Args:
+            lap_times (Sequence[float]): Each racer's lap time in
+                milliseconds, including any time spent in the pits
+            pit_durations (Optional[Sequence[float]]): Milliseconds each
+                racer spent in the pits on the lap, NaN for those who didn't
+                pit, nobody pitting if not given
+
+        Returns:
+            RaceState: `state`, at the start of the next lap
+        """
+        if self.lap >= self.num_laps:
+            raise ValueError(f"All {self.num_laps} laps of the race have been observed")
+        lap_times = np.asarray(lap_times, dtype=float)
+        pit_durations = np.full(len(self.racers), np.nan) if pit_durations is None \
+            else np.asarray(pit_durations, dtype=float)
+        pitted = ~np.isnan(pit_durations)
+        driven = lap_times - np.where(pitted, pit_durations, 0)
+
+        with instrumentation.timer('live.condition'):
+            for posterior, rows in self.posterior_groups():
+                inputs = []
+                for i in rows:
+                    racer = self.racers[i]
+                    X = lap_time_inputs(self.lap, self.state.laps_since_pit_stop[i], racer.total_laps,
+                                        self.normalise_pit_laps)
+                    model = racer.lap_time_model
+                    inputs.append(with_driver_column(X, model.driver_index) if isinstance(model, DriverModel) else X)
+                top_quali = np.array([self.racers[i].top_quali / np.timedelta64(1, 'ms') for i in rows])
+                self.use_posterior(rows, posterior.condition(np.vstack(inputs), driven[rows] / top_quali))
+
+        self.state.current_time += lap_times
+        self.state.laps_since_pit_stop[:] = np.where(pitted, 0, self.state.laps_since_pit_stop + 1)
+        self.state.time_since_stop[:] = np.where(pitted, 0, self.state.time_since_stop + driven)
+        self.state.pit_stopping[:] = pitted
+        self.state.pit_stop_duration[:] = pit_durations
+        self.state.sampled_lap_time[:] = driven
+        self.lap += 1
+        return self.state
+
+    @instrumentation.timed('live.resimulate')
+    def resimulate(self, n_sims: int, rng: Optional[np.random.Generator] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Simulates `n_sims` runs of the rest of the race from the current
+        state with the batched engine, see `batch_simulation.simulate_races`
+
+        Args:
+            n_sims (int): The number of runs
+            rng (Optional[np.random.Generator]): Source of randomness
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: `[n_sims, n_racers]` finishing
+                orders and finishing times, as `simulate_races` returns them
+        """
+        return simulate_races(self.racers, self.num_laps, n_sims, rng, self.state, self.lap)
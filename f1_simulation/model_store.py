@@ -0,0 +1,228 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import tempfile
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from instrumentation import instrumentation
+from utils import lazy_import
+
+GPy = lazy_import('GPy')
+
+STORE_VERSION = 1
+
+ModelBuilder = Callable[[np.ndarray, np.ndarray], 'GPy.core.GP']
+DataGetter = Callable[[], Optional[Tuple[np.ndarray, np.ndarray]]]
+
+
+def _plain(value: Any) -> Any:
+    """Converts numpy scalars in a key to plain python values so keys built
+    from dataframe values and literals hash the same"""
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def data_fingerprint(X: np.ndarray, Y: np.ndarray) -> str:
+    """Returns a hash of a model's training data"""
+    digest = hashlib.sha1()
+    for array in (X, Y):
+        array = np.ascontiguousarray(array, dtype=float)
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+class ModelStore:
+    """Versioned on-disk store of fitted GP models. Each entry holds a model's
+    optimised hyperparameters, its training data and a fingerprint of both
+    the training data and the source CSVs it was derived from. An entry is
+    served while the source CSVs are unchanged; once they change, the
+    training data is rebuilt and the stored hyperparameters are reused only if
+    the data fingerprint still matches, otherwise the model is refit. When
+    rows are only appended, `carry_forward` keeps the unaffected entries valid.
+
+    Entries are evicted least recently used first once the store holds more
+    than `max_entries` entries or `max_bytes` bytes.
+
+        Args:
+            dirpath (str): The directory the entries are kept in
+            max_entries (Optional[int]): The most entries to keep
+            max_bytes (Optional[int]): The most bytes of entries to keep
+    """
+    def __init__(self, dirpath: str, max_entries: Optional[int] = 1000, max_bytes: Optional[int] = 2 * 1024 ** 3):
+        self.dirpath = dirpath
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(dirpath, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return f'ModelStore({self.dirpath!r}, {len(self._entries())} entries, {self.hits=}, {self.misses=})'
+
+    def _path(self, key: Tuple) -> str:
+        key_str = json.dumps([_plain(k) for k in key])
+        return os.path.join(self.dirpath, hashlib.sha1(key_str.encode()).hexdigest() + '.npz')
+
+    def _entries(self):
+        return [entry for entry in os.scandir(self.dirpath) if entry.name.endswith('.npz')]
+
+    def _read(self, key: Tuple) -> Optional[Dict[str, Any]]:
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                meta = json.loads(str(entry['meta']))
+                if meta['version'] != STORE_VERSION or meta['key'] != [_plain(k) for k in key]:
+                    return None
+                return dict(meta=meta, X=entry['X'], Y=entry['Y'], params=entry['params'])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def _write(self, key: Tuple, model: GPy.core.GP, X: np.ndarray, Y: np.ndarray, sources: Dict[str, Any],
+               fingerprint: str):
+        # the data the model was built from rather than `model.X, model.Y`,
+        # which builders may derive from it
+        meta = dict(version=STORE_VERSION, key=[_plain(k) for k in key], model=type(model).__name__,
+                    sources=sources, data_fingerprint=fingerprint)
+        self._write_entry(self._path(key), meta, np.asarray(X), np.asarray(Y), model.param_array)
+        self.evict()
+
+    def _write_entry(self, path: str, meta: Dict[str, Any], X: np.ndarray, Y: np.ndarray, params: np.ndarray):
+        fd, tmp_path = tempfile.mkstemp(dir=self.dirpath, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, meta=np.array(json.dumps(meta)), X=X, Y=Y, params=params)
+        os.replace(tmp_path, path)  # atomic so concurrent readers never see a partial entry
+
+    def evict(self):
+        """Deletes least recently used entries until the store is within its bounds"""
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        total_bytes = sum(entry.stat().st_size for entry in entries)
+        while entries and ((self.max_entries is not None and len(entries) > self.max_entries)
+                           or (self.max_bytes is not None and total_bytes > self.max_bytes)):
+            entry = entries.pop(0)
+            total_bytes -= entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:  # evicted by another process
+                pass
+
+    def invalidate(self, key: Tuple):
+        """Removes the entry for `key`, if any, so it is refit on next use"""
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def carry_forward(self, before: Dict[str, Any], after: Dict[str, Any],
+                      is_stale: Callable[[List], bool]) -> Tuple[int, int]:
+        """Brings the store up to date with an append to the source CSVs
+        without refitting or rebuilding training data. Entries whose models
+        depend on the appended rows are removed, and the entries that were
+        valid for the CSVs `before` the append are re-stamped as valid for
+        them `after` it. Entries that were already out of date are left for
+        `fit_or_load` to check.
+
+        Args:
+            before (Dict[str, Any]): Fingerprint of every source CSV before the
+                append, see `F1Dataset.fingerprint`
+            after (Dict[str, Any]): Fingerprint of every source CSV after it
+            is_stale (Callable[[List], bool]): Whether the model with the given
+                key, e.g. `['lap_time', driver_id, year, ...]`, is affected
+
+        Returns:
+            Tuple[int, int]: The number of entries carried forward and removed
+        """
+        carried, removed = 0, 0
+        for entry in self._entries():
+            try:
+                with np.load(entry.path) as f:
+                    meta = json.loads(str(f['meta']))
+                    arrays = f['X'], f['Y'], f['params']
+            except (OSError, KeyError, ValueError):
+                continue
+            if meta['version'] != STORE_VERSION:
+                continue
+            if is_stale(meta['key']):
+                os.remove(entry.path)
+                removed += 1
+            elif all(before.get(name) == source for name, source in meta['sources'].items()):
+                meta['sources'] = {name: after[name] for name in meta['sources']}
+                stat = entry.stat()
+                self._write_entry(entry.path, meta, *arrays)
+                os.utime(entry.path, ns=(stat.st_atime_ns, stat.st_mtime_ns))  # keep its place in the eviction order
+                carried += 1
+        return carried, removed
+
+    def fit_or_load(self, key: Tuple, build: ModelBuilder, get_data: DataGetter, sources: Dict[str, Any],
+                    optimize: bool = True) -> Optional[GPy.core.GP]:
+        """Returns the model for `key`, from the store if its entry is still
+        valid and otherwise by fitting it and storing the result
+
+        Args:
+            key (Tuple): Identifies the model, e.g. `('lap_time', driver_id, year)`
+            build (ModelBuilder): Makes the unoptimised model from `X, Y`
+            get_data (DataGetter): Computes `X, Y`, or None if there is no data
+            sources (Dict[str, Any]): Fingerprint of the CSVs the data comes from,
+                see `F1Dataset.fingerprint`
+            optimize (bool): Whether the model's hyperparameters are optimised
+
+        Returns:
+            Optional[GPy.core.GP]: The model, or None if there is no data
+        """
+        entry = self._read(key)
+        if entry is not None and entry['meta']['sources'] == sources:
+            os.utime(self._path(key))  # mark as recently used
+            self.hits += 1
+            instrumentation.count('model_store.hit')
+            return restore_model(build, entry['X'], entry['Y'], entry['params'])
+
+        self.misses += 1
+        instrumentation.count('model_store.miss')
+        data = get_data()
+        if data is None:
+            return None
+        X, Y = data
+        fingerprint = data_fingerprint(X, Y)
+        if entry is not None and entry['meta']['data_fingerprint'] == fingerprint:
+            # the CSVs changed, but not in a way that affects this model
+            model = restore_model(build, X, Y, entry['params'])
+        else:
+            model = build(X, Y)
+            if optimize:
+                optimize_model(model, key[0])
+        self._write(key, model, X, Y, sources, fingerprint)
+        return model
+
+
+def restore_model(build: ModelBuilder, X: np.ndarray, Y: np.ndarray, params: np.ndarray) -> GPy.core.GP:
+    """Rebuilds a model and sets its hyperparameters without optimising"""
+    model = build(X, Y)
+    model[:] = params
+    return model
+
+
+def optimize_model(model: GPy.core.GP, kind: str):
+    """Optimises a model's hyperparameters, timed as `model.optimize.<kind>`"""
+    with instrumentation.timer(f'model.optimize.{kind}'):
+        model.optimize(messages=False)
+
+
+def fit_or_load(model_store: Optional[ModelStore], key: Tuple, build: ModelBuilder, get_data: DataGetter,
+                sources: Callable[[], Dict[str, Any]], optimize: bool = True) -> Optional[GPy.core.GP]:
+    """Fits a model through `model_store` if one is given, otherwise fits it
+    directly. `sources` is only called when a store is used. Timed as
+    `model.fit.<kind>`, where the kind is the first element of `key`.
+    """
+    with instrumentation.timer(f'model.fit.{key[0]}'):
+        if model_store is not None:
+            return model_store.fit_or_load(key, build, get_data, sources(), optimize=optimize)
+        data = get_data()
+        if data is None:
+            return None
+        model = build(*data)
+        if optimize:
+            optimize_model(model, key[0])
+        return model
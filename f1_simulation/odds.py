@@ -0,0 +1,221 @@
+import statistics
+from typing import Callable, List, NamedTuple, Optional
+
+import numpy as np
+
+from batch_simulation import simulate_races
+from f1_racer import F1Racer
+from instrumentation import instrumentation
+from race_state import RaceState
+
+PODIUM = 3
+
+
+class DrawSource:
+    """The random draws of the batched race engine, `simulate_races`, made
+    from a NumPy generator's standard normals and uniforms only, so that a
+    mirrored source with the same seed makes the antithetic draws: every
+    normal negated and every uniform `u` replaced by `1 - u`. It has the
+    methods of `np.random.Generator` the engine calls. Integers, which pick
+    each race's pre-drawn lap time trajectories, are not mirrored, so both
+    races of an antithetic pair follow the same trajectories.
+
+        Args:
+            seed: Seed of the underlying generator, anything
+                `np.random.default_rng` takes
+            mirrored (bool): Whether to make the antithetic draws
+    """
+    __slots__ = ('rng', 'mirrored')
+
+    def __init__(self, seed, mirrored: bool = False):
+        self.rng = np.random.default_rng(seed)
+        self.mirrored = mirrored
+
+    def __repr__(self) -> str:
+        return f'DrawSource(mirrored={self.mirrored})'
+
+    def standard_normal(self, size=None) -> np.ndarray:
+        draws = self.rng.standard_normal(size)
+        return -draws if self.mirrored else draws
+
+    def normal(self, loc=0.0, scale=1.0, size=None) -> np.ndarray:
+        return loc + scale * self.standard_normal(size)
+
+    def random(self, size=None) -> np.ndarray:
+        draws = self.rng.random(size)
+        # 1 - u lies in (0, 1], so 1 is moved to the largest float below it
+        return np.minimum(1 - draws, np.nextafter(1, 0)) if self.mirrored else draws
+
+    def integers(self, low, high=None, size=None) -> np.ndarray:
+        return self.rng.integers(low, high, size)
+
+    def geometric(self, p) -> np.ndarray:
+        """Draws the number of trials to the first success by inverting the
+        geometric distribution's CDF at a uniform"""
+        p = np.asarray(p, dtype=float)
+        # a certain success, p = 1, divides by log(0) = -inf, giving one trial
+        with np.errstate(divide='ignore'):
+            trials = np.ceil(np.log1p(-self.random(p.shape)) / np.log1p(-p))
+        return np.maximum(trials, 1).astype(np.int64)
+
+
+class Odds(NamedTuple):
+    """Monte Carlo estimates of a race's finishing odds, indexed like the
+    race's racers
+
+        Args:
+            win (np.ndarray): Each racer's probability of winning
+            podium (np.ndarray): Each racer's probability of finishing in the
+                top three
+            win_error (np.ndarray): The half width of each win probability's
+                confidence interval
+            podium_error (np.ndarray): The half width of each podium
+                probability's confidence interval
+            positions (np.ndarray): `[racer, position]` finishing position
+                probabilities, see `batch_simulation.finishing_position_probabilities`
+            n_sims (int): The number of races simulated
+            converged (bool): Whether every interval reached the target width
+                before the simulation budget ran out
+    """
+    win: np.ndarray
+    podium: np.ndarray
+    win_error: np.ndarray
+    podium_error: np.ndarray
+    positions: np.ndarray
+    n_sims: int
+    converged: bool
+
+
+def finishing_positions(finishing_orders: np.ndarray) -> np.ndarray:
+    """Turns `[n_sims, n_racers]` finishing orders into `[n_sims, racer,
+    position]` indicators of where each racer finished"""
+    n_sims, n_racers = finishing_orders.shape
+    positions = np.zeros((n_sims, n_racers, n_racers))
+    positions[np.arange(n_sims)[:, None], finishing_orders, np.arange(n_racers)] = 1
+    return positions
+
+
+def simulate_positions(racers: List[F1Racer], num_laps: int, n_sims: int, seed, antithetic: bool,
+                       state: Optional[RaceState]) -> np.ndarray:
+    """Simulates a batch of races from `seed` and returns the finishing
+    position indicators of each sample. With `antithetic`, a sample is the
+    mean of a pair of races run on mirrored draws, half as many samples as
+    races."""
+    if not antithetic:
+        return finishing_positions(simulate_races(racers, num_laps, n_sims, DrawSource(seed), state)[0])
+    pairs = n_sims // 2
+    return (finishing_positions(simulate_races(racers, num_laps, pairs, DrawSource(seed), state)[0]) +
+            finishing_positions(simulate_races(racers, num_laps, pairs, DrawSource(seed, mirrored=True), state)[0])) / 2
+
+
+def run_until_converged(sample: Callable[[np.random.SeedSequence, int], np.ndarray], sims_per_sample: int,
+                        target: float, confidence: float, batch_size: int, max_sims: int,
+                        seed: Optional[int]) -> Odds:
+    """Draws batches of position indicator samples from `sample` until the
+    confidence interval of every racer's win and podium estimate is within
+    `target` of it, or `max_sims` races have been simulated. Batch `k` is
+    seeded with the `k`th child of `seed`, so calls with the same seed use
+    the same random numbers, batch by batch."""
+    z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+    seeds = np.random.SeedSequence(seed)
+    n_samples = n_sims = 0
+    total = win_squares = podium_squares = None
+    while True:
+        batch = min(batch_size, max_sims - n_sims)
+        with instrumentation.timer('odds.batch'):
+            positions = sample(seeds.spawn(1)[0], batch)
+        win, podium = positions[:, :, 0], positions[:, :, :PODIUM].sum(axis=2)
+        if total is None:
+            total, win_squares, podium_squares = positions.sum(axis=0), (win ** 2).sum(axis=0), (podium ** 2).sum(axis=0)
+        else:
+            total += positions.sum(axis=0)
+            win_squares += (win ** 2).sum(axis=0)
+            podium_squares += (podium ** 2).sum(axis=0)
+        n_samples += len(positions)
+        n_sims += len(positions) * sims_per_sample
+
+        mean = total / n_samples
+        win_mean, podium_mean = mean[:, 0], mean[:, :PODIUM].sum(axis=1)
+        # sample variances, 0 until there are two samples
+        correction = n_samples / max(n_samples - 1, 1)
+        win_error = z * np.sqrt(np.maximum(win_squares / n_samples - win_mean ** 2, 0) * correction / n_samples)
+        podium_error = z * np.sqrt(np.maximum(podium_squares / n_samples - podium_mean ** 2, 0) * correction / n_samples)
+        converged = n_samples > 1 and max(win_error.max(), podium_error.max()) <= target
+        if converged or n_sims + 2 * sims_per_sample > max_sims:
+            instrumentation.count('odds.simulations', n_sims)
+            return Odds(win_mean, podium_mean, win_error, podium_error, mean, n_sims, bool(converged))
+
+
+def estimate_odds(racers: List[F1Racer], num_laps: int, target: float = 0.01, confidence: float = 0.95,
+                  batch_size: int = 1000, max_sims: int = 100_000, antithetic: bool = False,
+                  seed: Optional[int] = None, state: Optional[RaceState] = None) -> Odds:
+    """Estimates each racer's win and podium probabilities by simulating the
+    race in batches with the batched engine, `batch_simulation.simulate_races`,
+    until every estimate's confidence interval is within `target` of it.
+    Rather than a fixed, oversized count, this runs as many races as the
+    precision asked for needs, rounded up to a batch.
+
+    Two variance reductions are available. With `antithetic`, half the races
+    are run on the mirror image of the other half's random draws, see
+    `DrawSource`, so a fast lap in one race is a slow lap in its twin. Their
+    errors cancel as far as the odds move monotonically with the draws, which
+    finishing positions only partly do, so measure before relying on it.
+    Racers with pre-drawn lap time trajectories follow the same ones in both
+    races of a pair, so their lap times are not mirrored. With
+    a `seed`, the same random numbers are used on every call (common random
+    numbers), so odds computed for two variants of a race differ by the
+    variants rather than by noise, see `compare_odds`.
+
+    Args:
+        racers (List[F1Racer]): The racers at the start of the race
+        num_laps (int): The number of laps that the race lasts for
+        target (float): The widest half width of any interval to stop at
+        confidence (float): The confidence level of the intervals
+        batch_size (int): The number of races per batch
+        max_sims (int): The most races to simulate, returning unconverged
+            estimates if they run out
+        antithetic (bool): Whether to simulate antithetic pairs of races
+        seed (Optional[int]): Seed of the random numbers, fresh ones if not given
+        state (Optional[RaceState]): The state every race starts from, the
+            racers' starting times if not given
+
+    Returns:
+        Odds: The estimates, their intervals and the number of races simulated
+    """
+    return run_until_converged(
+        lambda batch_seed, n_sims: simulate_positions(racers, num_laps, n_sims, batch_seed, antithetic, state),
+        2 if antithetic else 1, target, confidence, batch_size, max_sims, seed)
+
+
+def compare_odds(racers: List[F1Racer], other_racers: List[F1Racer], num_laps: int, target: float = 0.01,
+                 confidence: float = 0.95, batch_size: int = 1000, max_sims: int = 100_000, antithetic: bool = False,
+                 seed: Optional[int] = None, state: Optional[RaceState] = None,
+                 other_state: Optional[RaceState] = None) -> Odds:
+    """Estimates how much each racer's win and podium probabilities change
+    between two variants of a race, e.g. a different pit strategy, running
+    both on common random numbers. Each variant's races use the same draws,
+    so the noise in the two estimates largely cancels and the difference
+    converges in far fewer races than estimating each variant on its own.
+
+    Args:
+        racers (List[F1Racer]): The racers of the first variant
+        other_racers (List[F1Racer]): The racers of the second variant, the
+            same number in the same order
+        num_laps (int): The number of laps that the race lasts for
+        other_state (Optional[RaceState]): The state the second variant's
+            races start from, the racers' starting times if not given
+
+    The other arguments are those of `estimate_odds`.
+
+    Returns:
+        Odds: The second variant's probabilities less the first's, with the
+            intervals of the differences and the races simulated per variant
+    """
+    if len(racers) != len(other_racers):
+        raise ValueError(f"The variants have to have the same racers, not {len(racers)} and {len(other_racers)}")
+
+    def sample(batch_seed: np.random.SeedSequence, n_sims: int) -> np.ndarray:
+        return (simulate_positions(other_racers, num_laps, n_sims, batch_seed, antithetic, other_state) -
+                simulate_positions(racers, num_laps, n_sims, batch_seed, antithetic, state))
+
+    return run_until_converged(sample, 2 if antithetic else 1, target, confidence, batch_size, max_sims, seed)
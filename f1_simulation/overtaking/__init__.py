@@ -1 +1 @@
-from overtaking.overtaking_model import make_overtaking_process, process_overtaking_data
\ No newline at end of file
+from overtaking.overtaking_model import make_overtaking_process, make_batched_overtaking_process, sample_overtake_probabilities, fit_overtaking_model, fit_pooled_overtaking_model, process_overtaking_data
\ No newline at end of file
@@ -1,12 +1,16 @@
 import pandas as pd
+from typing import Optional
 from dataprocessing import F1Dataset
 
-def make_overtakes_dataset(cutoff_milliseconds=1000):
-    data = F1Dataset('data')
-    lap_times = data.lap_times
+def make_overtakes_dataset(cutoff_milliseconds=1000, data: Optional[F1Dataset] = None,
+                           lap_times: Optional[pd.DataFrame] = None):
+    if lap_times is None:
+        data = data if data is not None else F1Dataset('data')
+        lap_times = data.lap_times
 
-    lap_times['position_change'] = lap_times.groupby(['raceId', 'driverId'])['position'].diff().fillna(0)
-    lap_times['total_time'] = lap_times.groupby(['raceId', 'driverId'])['milliseconds'].cumsum()
+    lap_times = lap_times.assign(
+        position_change=lap_times.groupby(['raceId', 'driverId'])['position'].diff().fillna(0),
+        total_time=lap_times.groupby(['raceId', 'driverId'])['milliseconds'].cumsum())
 
     lap_times = lap_times.sort_values(by=['raceId', 'lap', 'total_time'])
     lap_times['distance_to_leading_racer'] = lap_times.groupby(['raceId', 'lap'])['total_time'].diff()
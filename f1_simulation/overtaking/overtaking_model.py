@@ -1,73 +1,123 @@
-import random
-from typing import Callable
-import GPy
-from dataprocessing import F1Dataset
+from __future__ import annotations
+
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from context import SimulationContext, get_context
+from model_store import ModelStore, fit_or_load
+from features import FeatureStore
+from pooling import DriverModel, PooledModel, driver_offset_kernel, get_pooled_model
+from utils import lazy_import
 import numpy as np
-from matplotlib import pyplot as plt
 import pandas as pd
-from sklearn.preprocessing import StandardScaler
-from . import create_overtaking_dataset
-from .create_overtaking_dataset import make_overtakes_dataset
-import datetime
 
-GPy.plotting.change_plotting_library('matplotlib')
+GPy = lazy_import('GPy')
 
-data = F1Dataset('data')
 
+def process_overtaking_data(context: Optional[SimulationContext] = None) -> pd.DataFrame:
+    context = context if context is not None else get_context()
+    return context.features.overtaking_laps
 
-def process_overtaking_data() -> pd.DataFrame:
-    lp = make_overtakes_dataset()
-    lp = lp.join(data.races.set_index(['raceId'])[['year', 'circuitId']], on=['raceId'])
-    lp = lp.join(data.results.set_index(['raceId', 'driverId'])[['constructorId']], on=['raceId', 'driverId'])
-    lp = lp.join(data.qualifying.set_index(['raceId', 'driverId'])[['q1','q2','q3']], on=['raceId','driverId'], lsuffix="qual_pos")
-    ## Take first qualifying time as number is variable
-    lp['q1'] = pd.to_datetime(lp['q1'], format='%M:%S.%f', errors='coerce')
-    lp['qualtime'] = list(map(lambda x: (x - datetime.datetime(1900, 1, 1)).total_seconds(), lp['q1']))
-    return lp
 
+OVERTAKING_SOURCES = ['lap_times', 'races', 'results', 'qualifying']
 
-def process_data(driverId, df: pd.DataFrame):
-    ## Assume this won't error due to update step
-    # driverId = get_driver_id(driver) 
-    
-    
-    try:
-        lp = df.loc[df['driverId'] == driverId]
-    except:
-        lp = df
-        print("Driver not found")
-
-    ## Missed overtakes
-    lp['num_overtakes'] = lp.groupby(['raceId', 'driverId'])['position_change'].transform(lambda x: x[x > 0].sum())
-    lp['stuck_behind'] = lp.groupby(['raceId', 'driverId'])['stuck_behind_driver'].transform(lambda x: x[x == True].sum())
-    # print("after:",lp)
-
-    ## Calculate percentage of successful overtakes
-    lp['success_perc'] = (lp['num_overtakes']/(lp['stuck_behind']+lp['num_overtakes']))
-    overtaking = lp.groupby(['raceId', 'driverId']).first().reset_index()
 
-    return overtaking
+def fit_overtaking_model(driver: str, features: Optional[FeatureStore] = None,
+                         model_store: Optional[ModelStore] = None,
+                         context: Optional[SimulationContext] = None) -> GPy.models.GPRegression:
+    """Fits the GP mapping (qualifying time, year, circuit, constructor) to the
+    fraction of attempted overtakes a driver completed in a race. The features
+    and model store default to `context`'s, itself the 'data' directory's if
+    not given.
 
+    The model trains on every race with those inputs and at least one
+    attempted overtake. Races aren't dropped for missing columns the model
+    doesn't use, such as a Q2 or Q3 time. Dropping them would leave a driver
+    who never reached Q3 with no data at all.
+    """
+    context = context if context is not None else get_context()
+    features = features if features is not None else context.features
+    model_store = model_store if model_store is not None else context.model_store
 
-def make_overtaking_process(driver: str, constructor: int, courseId: int, year: int, df: pd.DataFrame):
+    def get_data():
+        overtaking = features.driver_overtaking(driver)
+        overtaking = overtaking.dropna(subset=['qualtime', 'year', 'circuitId', 'constructorId', 'success_perc'])
+        X = overtaking[['qualtime', 'year', 'circuitId', 'constructorId']]
+        Y = overtaking[['success_perc']]
+        return X.values.astype(float), Y.values.astype(float)
     
-    overtaking = process_data(driver, df)
-    overtaking.dropna(inplace=True)
-    X = overtaking[['qualtime', 'year', 'circuitId', 'constructorId']]
-    Y = overtaking[['success_perc']]
-    
-    print("initialise kernel")
-    kernel = GPy.kern.RBF(input_dim=4, lengthscale=10)
-
-    print("fit model")
-    m = GPy.models.GPRegression(X,Y,kernel)
-    print("done")
-    m.optimize(messages=False)
+    def build(X, Y):
+        # timed as model.fit.overtaking by fit_or_load
+        kernel = GPy.kern.RBF(input_dim=4, lengthscale=10)
+        return GPy.models.GPRegression(X,Y,kernel)
     # m.optimize_restarts(num_restarts = 10)
 
-    #print(overtaking)
     # m.plot(fixed_inputs=[(1,year),(2,courseId),(3,constructor)], plot_data=True)
     # plt.show(block=True) 
+    return fit_or_load(model_store, ('overtaking', driver), build, get_data,
+                       lambda: features.data.fingerprint(OVERTAKING_SOURCES))
+
+
+def get_pooled_overtaking_training_data(year: int, features: FeatureStore) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Builds the pooled overtaking model's inputs, those of
+    `fit_overtaking_model` with the driver's index appended, and targets from
+    every driver's races in a given year, along with the sorted driver IDs the
+    indices refer to
+    """
+    overtaking = features.overtaking
+    overtaking = overtaking.loc[overtaking['year'] == year]
+    overtaking = overtaking.dropna(subset=['qualtime', 'year', 'circuitId', 'constructorId', 'success_perc'])
+    driver_ids = np.sort(overtaking.index.unique().values)
+    X = np.hstack([overtaking[['qualtime', 'year', 'circuitId', 'constructorId']].values.astype(float),
+                   np.searchsorted(driver_ids, overtaking.index.values).reshape([-1, 1])])
+    return X.astype(float), overtaking[['success_perc']].values.astype(float), driver_ids
+
+
+def fit_pooled_overtaking_model(year: int, features: Optional[FeatureStore] = None,
+                                model_store: Optional[ModelStore] = None,
+                                context: Optional[SimulationContext] = None) -> PooledModel:
+    """Fits one overtaking GP on every driver's races in a given year, once per
+    context, for all the season's racers to share. The kernel of
+    `fit_overtaking_model` is shared by every driver, each driver adding their
+    own offset, see `pooling.driver_offset_kernel`. A driver's view of it,
+    `PooledModel.for_driver`, can be passed to `make_overtaking_process` in
+    place of their own model.
+
+    Args:
+        year (int): The season whose races the model is trained on
+        features (Optional[FeatureStore]): The features to train on,
+            `context`'s if not given
+        model_store (Optional[ModelStore]): Store to load the fitted model
+            from or save it to, `context`'s if not given
+        context (Optional[SimulationContext]): The simulation's context,
+            which keeps the fitted model, that of the 'data' directory if not given
+
+    Returns:
+        PooledModel: The optimised model and the driver IDs it was fit on
+    """
+    context = context if context is not None else get_context()
+    features = features if features is not None else context.features
+    model_store = model_store if model_store is not None else context.model_store
+    key = ('overtaking_pooled', year)
+
+    def fit() -> PooledModel:
+        X, Y, driver_ids = get_pooled_overtaking_training_data(year, features)
+
+        def build(X, Y):
+            kernel = GPy.kern.RBF(input_dim=4, lengthscale=10, active_dims=[0, 1, 2, 3]) + \
+                driver_offset_kernel(len(driver_ids), column=4)
+            return GPy.models.GPRegression(X, Y, kernel)
+
+        model = fit_or_load(model_store, key, build, lambda: (X, Y),
+                            lambda: features.data.fingerprint(OVERTAKING_SOURCES))
+        return PooledModel(model, driver_ids)
+
+    return get_pooled_model(key, fit, context)
+
+
+def make_overtaking_process(driver: str, constructor: int, courseId: int, year: int, features: Optional[FeatureStore] = None,
+                            model: Optional[GPy.models.GPRegression] = None, model_store: Optional[ModelStore] = None,
+                            context: Optional[SimulationContext] = None):
+    
+    m = model if model is not None else fit_overtaking_model(driver, features, model_store, context)
 
     ##TODO: Either change input params to take ID, or write helper methods to converst strings to IDs
 
@@ -75,21 +125,71 @@ def make_overtaking_process(driver: str, constructor: int, courseId: int, year:
     result = lambda lap_time: m.posterior_samples_f(np.array([[lap_time,year, courseId, constructor]]), size=1)
     return result
 
-def get_driver_id(driver):
+
+def make_batched_overtaking_process(model: GPy.models.GPRegression, constructor: int, courseId: int,
+                                    year: int) -> Callable[[np.ndarray], Tuple[np.ndarray, np.ndarray]]:
+    """Makes the array form of the overtaking process used by the batched race
+    engine. It returns the predictive mean and standard deviation of the
+    overtake success probability for an array of lap times in seconds.
+    """
+    def batched_overtake(lap_times: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        lap_times = np.asarray(lap_times, dtype=float).reshape([-1, 1])
+        X = np.hstack([lap_times, np.tile([year, courseId, constructor], (len(lap_times), 1))])
+        mean, var = model.predict(X, include_likelihood=False)
+        return mean[:, 0], np.sqrt(np.maximum(var[:, 0], 0))
+
+    return batched_overtake
+
+
+def sample_overtake_probabilities(models: Sequence[GPy.models.GPRegression], lap_times: np.ndarray, year: int,
+                                  courseId: int, constructors: Sequence[int]) -> np.ndarray:
+    """Draws the overtake success probability of several racers on a lap at
+    once, as `make_overtaking_process` does for one. Racers whose models are
+    views of the same pooled model, see `pooling.DriverModel`, are drawn
+    jointly in one posterior call, so a grid on a season's pooled model costs
+    one call however many racers attempt overtakes. Racers with their own
+    models take one call each.
+
+    Args:
+        models (Sequence[GPy.models.GPRegression]): Each racer's overtaking
+            model, their own or a `DriverModel`
+        lap_times (np.ndarray): Each racer's lap time in seconds
+        year (int): The year of the race
+        courseId (int): The circuit of the race
+        constructors (Sequence[int]): Each racer's constructor
+
+    Returns:
+        np.ndarray: One posterior draw of each racer's success probability
+    """
+    X = np.column_stack([np.asarray(lap_times, dtype=float), np.full(len(models), year),
+                         np.full(len(models), courseId), np.asarray(constructors, dtype=float)])
+    groups: Dict[int, List[int]] = {}
+    for k, model in enumerate(models):
+        base = model.model if isinstance(model, DriverModel) else model
+        groups.setdefault(id(base), []).append(k)
+
+    probabilities = np.empty(len(models))
+    for rows in groups.values():
+        model = models[rows[0]]
+        if isinstance(model, DriverModel):
+            inputs = np.hstack([X[rows], np.array([[models[k].driver_index] for k in rows], dtype=float)])
+            samples = model.model.posterior_samples_f(inputs, size=1)
+        else:
+            samples = model.posterior_samples_f(X[rows], size=1)
+        probabilities[rows] = np.ravel(samples)
+    return probabilities
+
+def get_driver_id(driver, context: Optional[SimulationContext] = None):
+    """The ID of the driver with the `driverRef` given, None if there is no such driver"""
+    context = context if context is not None else get_context()
+    driver_data = context.data.drivers
     try:
-        driver_data = data.drivers
-        # print(driver_data.loc[driver_data['driverRef'] == driver]['driverId'])
-        driver_id = driver_data.loc[driver_data['driverRef'] == driver]['driverId'].item()
-    except KeyError as e:
-        print(e)
+        return driver_data.loc[driver_data['driverRef'] == driver]['driverId'].item()
+    except ValueError:
         return None
-    return driver_id
 
-def get_driver_ref(driverId):
-    driver_data = data.drivers
+def get_driver_ref(driverId, context: Optional[SimulationContext] = None):
+    context = context if context is not None else get_context()
+    driver_data = context.data.drivers
     driver_ref = (driver_data.loc[driver_data['driverId'] == driverId])['driverRef'].item()
     return driver_ref
-
-if __name__=="__main__":
-    overtaking = process_data("hamilton")   
-    make_overtaking_process(80, "hamilton", 1, 1, 2021)
@@ -1 +1 @@
-from pit_stopping.pit_stop_model import make_pit_stop_process, make_pit_stop_duration_process
\ No newline at end of file
+from pit_stopping.pit_stop_model import make_pit_stop_process, make_pit_stop_duration_process, make_batched_pit_stop_process, make_batched_pit_stop_duration_process, fit_pit_stop_duration_model, get_pit_stop_duration_table
\ No newline at end of file
@@ -1,42 +1,128 @@
+from __future__ import annotations
+
 import random
-from typing import Callable
-from dataprocessing import F1Dataset
-import GPy
+from typing import Callable, Optional, Sequence, Tuple
+from context import SimulationContext, get_context
+from model_store import ModelStore, fit_or_load
+from features import FeatureStore
+from tabulation import TabulatedModel, varying_columns
+from gp_inference import predictive_mean, with_backend
+from instrumentation import instrumentation
+from utils import lazy_import
 import numpy as np
+import pandas as pd
 
-data = F1Dataset('data')
+GPy = lazy_import('GPy')
 
 # Need to get the circuit ID of the courses
 MIN_SAMPLES_REQUIRED = 1
 MIN_SAMPLES_REQUIRED_PIT_DECISION = 100
+DEFAULT_PIT_STOP_DURATION = 5000
+
+# Above this many laps the pit decision model is trained on binned laps, see
+# `bin_pit_stop_data`, when its training mode is 'auto'
+MAX_EXACT_PIT_LAPS = 2000
+DEFAULT_MAX_PIT_STOP_BINS = 1000
+PIT_STOP_TRAINING_MODES = ('auto', 'exact', 'binned')
+PIT_STOP_SOURCES = ['lap_times', 'pit_stops', 'races', 'circuits']
+PIT_STOP_DURATION_SOURCES = ['pit_stops', 'races', 'results', 'circuits']
+
+def bin_pit_stop_data(X: np.ndarray, Y: np.ndarray, columns: Optional[Sequence[int]] = None,
+                      max_bins: int = DEFAULT_MAX_PIT_STOP_BINS) -> Tuple[np.ndarray, np.ndarray]:
+    """Aggregates pit decision laps into bins, turning any number of laps
+    into at most `max_bins` rows. Each of `columns` is cut at quantiles, or
+    kept as is if it has few enough distinct values (e.g. the year), and the
+    laps are grouped by their bin in every one of them, with as many bins
+    per column as fit in `max_bins`.
+
+    Args:
+        X (np.ndarray): `[n, d]` pit decision inputs of every lap
+        Y (np.ndarray): `[n, 1]` whether the car stopped on the lap
+        columns (Optional[Sequence[int]]): The columns to bin on, all of them
+            if not given. Columns the kernel only sees through a constant
+            are better left out, leaving more bins for the others.
+        max_bins (int): The most rows returned
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: `[b, d]` median inputs of the laps in
+            each bin and `[b, 2]` fraction of them the car stopped on and
+            number of laps, for `build_binned_pit_stop_model`
+    """
+    columns = list(range(X.shape[1])) if columns is None else list(columns)
+    bins_per_column = max(2, int(max_bins ** (1 / len(columns))))
+    while True:
+        codes = np.empty((len(X), len(columns)), dtype=np.int64)
+        for i, column in enumerate(columns):
+            values = X[:, column]
+            distinct = np.unique(values)
+            if len(distinct) <= bins_per_column:
+                codes[:, i] = np.searchsorted(distinct, values)
+            else:
+                edges = np.unique(np.quantile(values, np.linspace(0, 1, bins_per_column + 1)[1:-1]))
+                codes[:, i] = np.searchsorted(edges, values, side='right')
+        _, bins = np.unique(codes, axis=0, return_inverse=True)
+        bins = bins.ravel()
+        num_bins = bins.max() + 1
+        if num_bins <= max_bins or bins_per_column <= 2:
+            break
+        bins_per_column = max(2, int(bins_per_column * (max_bins / num_bins) ** (1 / len(columns))))
 
-models_created = {}
+    laps = np.bincount(bins, minlength=num_bins).astype(float)
+    stops = np.bincount(bins, weights=Y[:, 0], minlength=num_bins)
+    # medians, as a bin can span ordinary gaps and the leader's 1e9 sentinel
+    X_binned = pd.DataFrame(X).groupby(bins).median().values
+    return X_binned, np.stack([stops / laps, laps], axis=1)
 
-def make_pit_stop_process(driver_id: str, constructor_id: str, course_id: str, year: int) -> Callable[[float, float, float], bool]:
-    def get_model(course_id: str, year: int):
-        global models_created
-        if (course_id, year) in models_created.keys():
-            return models_created[(course_id, year)]
-        lap_times_tmp = data.lap_times.sort_values(by=['raceId', 'driverId', 'lap'])
-        lap_times = lap_times_tmp.assign(accumulated_time=lap_times_tmp.groupby(['raceId','driverId'])['milliseconds'].cumsum())
 
-        pit_stops = data.pit_stops
-        pit_stops = pit_stops.assign(last_stop=pit_stops['lap'])
+def pit_stop_kernel(input_dim: int) -> GPy.kern.Kern:
+    """The pit decision GP's kernel, the same whichever way it is trained"""
+    return GPy.kern.RBF(input_dim=1, lengthscale=500)+GPy.kern.Bias(input_dim=input_dim)
 
-        df = lap_times.join(data.races.set_index('raceId'), on='raceId', rsuffix='_race') \
-            .join(data.circuits.set_index('circuitId'), on='circuitId', rsuffix='_circuit') \
-            .merge(pit_stops, on=['raceId', 'driverId', 'lap'], how='left', indicator = 'stop_indi')
 
-        races_with_pit_stops = df['raceId'][~(df['last_stop'].isna())].unique()
-        df = df.loc[df['raceId'].isin(races_with_pit_stops)]
+def build_binned_pit_stop_model(X: np.ndarray, Y: np.ndarray) -> GPy.core.GP:
+    """Makes the pit decision GP on binned laps from `bin_pit_stop_data`. Each
+    bin's stop fraction is observed with the variance of the mean of its `n`
+    laps, `p (1 - p) / n` with `p` the stop rate over every bin, so bins with
+    many laps count for more. The noise is fixed, leaving the kernel to optimise.
+    """
+    stops, laps = Y[:, 0], Y[:, 1]
+    rate = np.clip(np.sum(stops * laps) / np.sum(laps), 1e-3, 1 - 1e-3)
+    m = GPy.models.GPHeteroscedasticRegression(X, Y[:, :1], pit_stop_kernel(X.shape[1]))
+    m.het_Gauss.variance[:] = (rate * (1 - rate) / laps).reshape([-1, 1])
+    m.het_Gauss.variance.fix()
+    return m
 
-        df['last_stop'] = df['last_stop'].ffill().fillna(0)
-        df=df.assign(time_last_stop = (df['lap']-df['last_stop'])*df['milliseconds_x'])
 
-        df['stop'] = np.where(df['stop_indi']=='both', 1, 0)
+def get_pit_stop_model(course_id: str, year: int, model_store: Optional[ModelStore] = None,
+                       features: Optional[FeatureStore] = None,
+                       training: str = 'auto',
+                       context: Optional[SimulationContext] = None) -> Optional[GPy.core.GP]:
+    """Fits, or fetches from `context` or `model_store`, the GP giving
+    the probability of a pit stop from the gaps to the surrounding cars and
+    the time since the last stop. Returns None when there is no data to fit on.
+    The features and model store default to `context`'s, itself the 'data'
+    directory's if not given.
 
-        if len(df[df["circuitId"] == course_id]) >= MIN_SAMPLES_REQUIRED_PIT_DECISION:
-            df = df[df["circuitId"] == course_id]
+    With `training` 'exact' the GP is fit on every lap, which is only
+    feasible for a few thousand laps. With 'binned' it is fit on the laps
+    aggregated into at most `DEFAULT_MAX_PIT_STOP_BINS` bins over the inputs
+    the kernel varies with, bounding the fit time and memory however much
+    history the circuit falls back to, see `bin_pit_stop_data`. 'auto' bins when there are more than
+    `MAX_EXACT_PIT_LAPS` laps.
+    """
+    if training not in PIT_STOP_TRAINING_MODES:
+        raise ValueError(f"Unknown pit stop training mode '{training}', expected one of {PIT_STOP_TRAINING_MODES}")
+    context = context if context is not None else get_context()
+    if (course_id, year, training) in context.pit_stop_models:
+        return context.pit_stop_models[(course_id, year, training)]
+
+    features = features if features is not None else context.features
+    model_store = model_store if model_store is not None else context.model_store
+
+    def get_data():
+        df = features.circuit_pit_laps(course_id)
+        if len(df) < MIN_SAMPLES_REQUIRED_PIT_DECISION:
+            df = features.pit_laps
 
         if len(df[df["year"] == year]) >= MIN_SAMPLES_REQUIRED_PIT_DECISION:
             df = df[df["year"] == year]
@@ -52,52 +138,184 @@ def make_pit_stop_process(driver_id: str, constructor_id: str, course_id: str, y
 
         X = df[x_params]
         Y = df[['stop']]
-
-        kernel = GPy.kern.RBF(input_dim=1, lengthscale=500)+GPy.kern.Bias(input_dim=len(x_params))
         if len(X) == 0:
-            print("ERROR: not enough data returning random number")
-            return lambda: False
-        m = GPy.models.GPRegression(X,Y,kernel)
-        m.optimize(messages=False)
-        models_created[(course_id, year)] = m
+            instrumentation.count('pit_stop.no_data')  # the racers never pit
+            return None
+        if training == 'binned' or (training == 'auto' and len(X) > MAX_EXACT_PIT_LAPS):
+            return bin_pit_stop_data(X.values.astype(float), Y.values.astype(float),
+                                     varying_columns(pit_stop_kernel(len(x_params))))
+        return X.values.astype(float), Y.values.astype(float)
+
+    def build(X, Y):
+        if Y.shape[1] == 2:  # binned laps
+            return build_binned_pit_stop_model(X, Y)
+        return GPy.models.GPRegression(X,Y,pit_stop_kernel(X.shape[1]))
+
+    m = fit_or_load(model_store, ('pit_stop', course_id, year, training), build, get_data,
+                    lambda: features.data.fingerprint(PIT_STOP_SOURCES))
+    if m is not None:
+        context.pit_stop_models[(course_id, year, training)] = m
+    return m
+
+
+def pit_stop_inputs(m: GPy.models.GPRegression, year: int, car_before, car_after, time_since_last_pitstop) -> np.ndarray:
+    """Builds the `[n, 3]` (or `[n, 4]` when the model was fit across years)
+    pit decision inputs from scalars or arrays of gaps in milliseconds
+    """
+    columns = [car_before, car_after, time_since_last_pitstop]
+    if m.input_dim == 4:
+        columns.append(year)
+    columns = np.broadcast_arrays(*[np.asarray(c, dtype=float) for c in columns])
+    return np.stack([np.ravel(c) for c in columns], axis=1)
+
+
+def tabulate(m: Optional[GPy.core.GP], table_resolution: Optional[int]) -> Optional[GPy.core.GP]:
+    """The model, or its table of `table_resolution` points per input if given"""
+    if m is None or table_resolution is None:
+        return m
+    return TabulatedModel(m, table_resolution)
+
+
+def get_pit_stop_table(course_id: str, year: int, model_store: Optional[ModelStore] = None,
+                       features: Optional[FeatureStore] = None, training: str = 'auto',
+                       table_resolution: Optional[int] = None,
+                       context: Optional[SimulationContext] = None) -> Optional[GPy.core.GP]:
+    """The pit decision model of `get_pit_stop_model`, or with
+    `table_resolution` its table, which every racer of the course and year
+    shares like the model"""
+    context = context if context is not None else get_context()
+    m = get_pit_stop_model(course_id, year, model_store, features, training, context)
+    if m is None or table_resolution is None:
         return m
+    key = (course_id, year, training, table_resolution)
+    if key not in context.pit_stop_tables:
+        context.pit_stop_tables[key] = TabulatedModel(m, table_resolution)
+    return context.pit_stop_tables[key]
 
-    time_since_last_pitstop = 0
-    m = get_model(course_id, year)
-
-    def is_pit_stop(car_before: float, car_after: float, lap_time: float):
-        nonlocal time_since_last_pitstop
-        time_since_last_pitstop += lap_time
-        mean = m.predict(np.array([[car_before, car_after, time_since_last_pitstop]]))[0]
-        if np.random.rand()<mean:
-            time_since_last_pitstop = 0
-            return True
-        else:
+
+def make_pit_stop_process(driver_id: str, constructor_id: str, course_id: str, year: int,
+                          model_store: Optional[ModelStore] = None,
+                          features: Optional[FeatureStore] = None,
+                          training: str = 'auto',
+                          table_resolution: Optional[int] = None,
+                          inference: str = 'gpy',
+                          context: Optional[SimulationContext] = None) -> Callable[[float, float, float], bool]:
+    """Makes the process sampling whether a racer pits on a lap. With
+    `table_resolution`, the model is evaluated once on a grid of that many
+    points per input it varies with and interpolated from then on, see
+    `tabulation.TabulatedModel`. Otherwise it is predicted from on the
+    `inference` backend, see `gp_inference.with_backend`. The model is shared
+    through `context`, see `get_pit_stop_model`. The time since the racer's
+    last stop is race state the caller holds, see `RaceState.time_since_stop`,
+    so the process holds none and can be used for any number of races.
+    """
+    m = with_backend(get_pit_stop_table(course_id, year, model_store, features, training, table_resolution, context),
+                     inference)
+
+    def is_pit_stop(car_before: float, car_after: float, time_since_stop: float) -> bool:
+        if m is None:
             return False
+        mean = predictive_mean(m, pit_stop_inputs(m, year, car_before, car_after, time_since_stop))
+        return np.random.rand() < mean
 
     return is_pit_stop
 
 
-def make_pit_stop_duration_process(driver_id: str, constructor_id: str, course_id: str, year: int) -> Callable[[float], float]:
+def make_batched_pit_stop_process(course_id: str, year: int,
+                                  model_store: Optional[ModelStore] = None,
+                                  features: Optional[FeatureStore] = None,
+                                  training: str = 'auto',
+                                  table_resolution: Optional[int] = None,
+                                  inference: str = 'gpy',
+                                  context: Optional[SimulationContext] = None
+                                  ) -> Callable[[np.ndarray, np.ndarray, np.ndarray], np.ndarray]:
+    """Makes the array form of the pit stop decision process used by the
+    batched race engine. The time since the last stop is state the engine
+    holds, so this only maps gaps and times since stopping (all milliseconds)
+    to pit stop probabilities. `table_resolution`, `inference` and `context`
+    are as for `make_pit_stop_process`.
+    """
+    m = with_backend(get_pit_stop_table(course_id, year, model_store, features, training, table_resolution, context),
+                     inference)
+
+    def batched_pit_stop(car_before: np.ndarray, car_after: np.ndarray, time_since_last_pitstop: np.ndarray) -> np.ndarray:
+        if m is None:
+            return np.zeros(np.shape(time_since_last_pitstop))
+        mean = predictive_mean(m, pit_stop_inputs(m, year, car_before, car_after, time_since_last_pitstop))
+        return mean[:, 0]
+
+    return batched_pit_stop
+
+
+def fit_pit_stop_duration_model(constructor_id: str, year: int, model_store: Optional[ModelStore] = None,
+                                features: Optional[FeatureStore] = None,
+                                context: Optional[SimulationContext] = None) -> Optional[GPy.models.GPRegression]:
+    """Builds the (unoptimised) GP mapping lap number to pit stop duration in
+    milliseconds. Returns None when there is no data to fit on. The features
+    and model store default to `context`'s, itself the 'data' directory's if
+    not given.
+    """
+    context = context if context is not None else get_context()
+    features = features if features is not None else context.features
+    model_store = model_store if model_store is not None else context.model_store
+
+    def get_data():
+        df = features.constructor_pit_durations(constructor_id)
+        if len(df) < MIN_SAMPLES_REQUIRED:
+            df = features.pit_durations
+
+        if len(df[df["year"] == year]) >= MIN_SAMPLES_REQUIRED:
+            df = df[df["year"] == year]
+
+        X = df[["lap"]]
+        Y = df[["milliseconds"]]
+        if len(X) == 0:
+            instrumentation.count('pit_stop_duration.no_data')  # DEFAULT_PIT_STOP_DURATION is used
+            return None
+        return X.values.astype(float), Y.values.astype(float)
+
+    def build(X, Y):
+        kernel = GPy.kern.RBF(input_dim=1, lengthscale=500)+GPy.kern.Bias(input_dim=1)
+        return GPy.models.GPRegression(X,Y,kernel)
 
-    df = data.pit_stops.join(data.races.set_index('raceId'), on='raceId', rsuffix='_race') \
-        .merge(data.results.set_index('raceId'), on=['raceId','driverId'], suffixes=('','_results')) \
-        .join(data.circuits.set_index('circuitId'), on='circuitId', rsuffix='_circuit')
+    return fit_or_load(model_store, ('pit_stop_duration', constructor_id, year), build, get_data,
+                       lambda: features.data.fingerprint(PIT_STOP_DURATION_SOURCES), optimize=False)
 
-    if len(df[df["constructorId"] == constructor_id])>= MIN_SAMPLES_REQUIRED:
-        df = df[df["constructorId"] == constructor_id]
 
-    if len(df[df["year"] == year]) >= MIN_SAMPLES_REQUIRED:
-        df = df[df["year"] == year]
+def get_pit_stop_duration_table(constructor_id: str, year: int, model: Optional[GPy.models.GPRegression],
+                                table_resolution: Optional[int] = None,
+                                context: Optional[SimulationContext] = None) -> Optional[GPy.core.GP]:
+    """The pit stop duration model of a constructor and year, or with
+    `table_resolution` its table, made once and shared through `context` by
+    every racer of the constructor and year and by both forms of their
+    duration process"""
+    if model is None or table_resolution is None:
+        return model
+    context = context if context is not None else get_context()
+    key = (constructor_id, year, table_resolution)
+    if key not in context.pit_stop_duration_tables:
+        context.pit_stop_duration_tables[key] = TabulatedModel(model, table_resolution)
+    return context.pit_stop_duration_tables[key]
 
-    X = df[["lap"]]
-    Y = df[["milliseconds"]]
-    kernel = GPy.kern.RBF(input_dim=1, lengthscale=500)+GPy.kern.Bias(input_dim=1)
-    if len(X) == 0:
-        print("ERROR: not enough data returning random number")
-        return lambda: 5000
-    m = GPy.models.GPRegression(X,Y,kernel)
-    #m.optimize(messages=False)
+
+def make_pit_stop_duration_process(driver_id: str, constructor_id: str, course_id: str, year: int,
+                                   model: Optional[GPy.models.GPRegression] = None,
+                                   model_store: Optional[ModelStore] = None,
+                                   features: Optional[FeatureStore] = None,
+                                   table_resolution: Optional[int] = None,
+                                   inference: str = 'gpy',
+                                   context: Optional[SimulationContext] = None) -> Callable[[float], float]:
+    """Makes the process sampling the duration of a pit stop in milliseconds
+    from the lap it is made on. `table_resolution` and `inference` are as for
+    `make_pit_stop_process`, the grid having a point on every lap when the
+    laps the model was fit on span no more than that many. The table is
+    shared through `context`, see `get_pit_stop_duration_table`.
+    """
+    m = model if model is not None else fit_pit_stop_duration_model(constructor_id, year, model_store, features,
+                                                                    context)
+    m = with_backend(get_pit_stop_duration_table(constructor_id, year, m, table_resolution, context), inference)
+    if m is None:
+        return lambda lap: DEFAULT_PIT_STOP_DURATION
 
     def callable(lap):
         prediction = m.predict(np.array([[lap]]))
@@ -105,3 +323,23 @@ def make_pit_stop_duration_process(driver_id: str, constructor_id: str, course_i
 
     return callable
 
+
+def make_batched_pit_stop_duration_process(model: Optional[GPy.models.GPRegression],
+                                           table_resolution: Optional[int] = None,
+                                           inference: str = 'gpy') -> Callable[[int], Tuple[float, float]]:
+    """Makes the array form of the pit stop duration process used by the
+    batched race engine. It returns the location and scale of the normal the
+    duration in milliseconds is drawn from, matching `make_pit_stop_duration_process`.
+    `model` may be a table from `get_pit_stop_duration_table` already, to share
+    it with the racer's `make_pit_stop_duration_process`, leaving
+    `table_resolution` unset.
+    """
+    model = with_backend(tabulate(model, table_resolution), inference)
+
+    def batched_duration(lap: int) -> Tuple[float, float]:
+        if model is None:
+            return DEFAULT_PIT_STOP_DURATION, 0.
+        loc, scale = model.predict(np.array([[lap]]))
+        return loc[0, 0], scale[0, 0]
+
+    return batched_duration
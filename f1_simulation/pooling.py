@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Callable, NamedTuple, Tuple
+
+import numpy as np
+
+from utils import lazy_import
+
+if TYPE_CHECKING:
+    from context import SimulationContext
+
+GPy = lazy_import('GPy')
+
+
+def driver_offset_kernel(num_drivers: int, column: int, rank: int = 1) -> GPy.kern.Kern:
+    """The kernel giving each driver their own offset from the pooled mean:
+    a constant over the other inputs times a coregionalisation matrix over the
+    driver index in `column`. The rank `rank` part of the matrix lets the
+    offsets of similar drivers be correlated, its diagonal lets each driver
+    differ from the rest.
+    """
+    return GPy.kern.Bias(1, active_dims=[column], name='driver_offset') * \
+        GPy.kern.Coregionalize(1, num_drivers, rank=rank, active_dims=[column], name='driver_coregion')
+
+
+def with_driver_column(X: np.ndarray, driver_index: int) -> np.ndarray:
+    """Appends the driver index to every row of the model inputs"""
+    return np.hstack([X, np.full((len(X), 1), driver_index, dtype=float)])
+
+
+class DriverModel:
+    """A pooled model seen from one driver. It has the `predict` and
+    `posterior_samples_f` methods of the GPy model the lap time and overtaking
+    processes call, with the driver's index appended to their inputs, so the
+    processes work the same whether they are given a driver's own model or
+    this.
+
+        Args:
+            model (GPy.core.GP): The pooled model, whose last input is the driver index
+            driver_index (int): The driver's index in the pooled model
+    """
+    __slots__ = ('model', 'driver_index')
+
+    def __init__(self, model: GPy.core.GP, driver_index: int):
+        self.model = model
+        self.driver_index = driver_index
+
+    def __repr__(self) -> str:
+        return f'DriverModel(driver_index={self.driver_index})'
+
+    def predict(self, X: np.ndarray, *args, **kwargs):
+        return self.model.predict(with_driver_column(X, self.driver_index), *args, **kwargs)
+
+    def posterior_samples_f(self, X: np.ndarray, *args, **kwargs):
+        return self.model.posterior_samples_f(with_driver_column(X, self.driver_index), *args, **kwargs)
+
+
+class PooledModel(NamedTuple):
+    """A model fitted once on every driver of a season
+
+        Args:
+            model (GPy.core.GP): The GP, whose last input is the driver index
+            driver_ids (np.ndarray): The sorted IDs of the drivers it was fit
+                on, a driver's index being their position in it
+    """
+    model: GPy.core.GP
+    driver_ids: np.ndarray
+
+    def __contains__(self, driver_id: int) -> bool:
+        index = np.searchsorted(self.driver_ids, driver_id)
+        return index < len(self.driver_ids) and self.driver_ids[index] == driver_id
+
+    def for_driver(self, driver_id: int) -> DriverModel:
+        """The model seen from a driver it was fit on"""
+        if driver_id not in self:
+            raise KeyError(f"Driver {driver_id} has no data in the pooled model")
+        return DriverModel(self.model, int(np.searchsorted(self.driver_ids, driver_id)))
+
+
+def get_pooled_model(key: Tuple, fit: Callable[[], PooledModel], context: SimulationContext) -> PooledModel:
+    """Returns the pooled model with `key` fitted in this process, kept by
+    `context` for every racer of the season to share, calling `fit` to fit or
+    load it the first time"""
+    if key not in context.pooled_models:
+        context.pooled_models[key] = fit()
+    return context.pooled_models[key]
@@ -0,0 +1,81 @@
+from typing import List, Optional
+
+import numpy as np
+
+# Codes of a racer's overtaking mode on the lap just simulated
+MODE_NONE = 0
+MODE_STUCK = 1
+MODE_SUCCESS = 2
+OVERTAKING_MODES = {None: MODE_NONE, 'stuck': MODE_STUCK, 'success': MODE_SUCCESS}
+OVERTAKING_MODE_NAMES = [None, 'stuck', 'success']
+
+
+def num_trajectories(racers: List) -> int:
+    """The number of pre-drawn lap time trajectories every racer that has
+    them can follow, 0 if none of the racers have any"""
+    drawn = [len(racer.lap_time_trajectories) for racer in racers if racer.lap_time_trajectories is not None]
+    return min(drawn) if drawn else 0
+
+
+class RaceState:
+    """The state of every racer in a race, held as one typed array per field
+    and indexed like the race's list of `F1Racer`s. `simulate_lap` updates it
+    in place every lap, so the racers themselves only hold their models.
+
+        Args:
+            starting_times (np.ndarray): Each racer's starting time in milliseconds
+            trajectory (int): For racers with pre-drawn lap time trajectories,
+                the trajectory every racer follows in this race
+
+        Attributes:
+            current_time (np.ndarray): float64 race time in milliseconds
+            laps_since_pit_stop (np.ndarray): int32 laps since the last pit stop
+            time_since_stop (np.ndarray): float64 milliseconds driven since
+                the last pit stop, which the pit decision models are given
+            overtaking_mode (np.ndarray): int8 `OVERTAKING_MODES` code on the last lap
+            pit_stopping (np.ndarray): Whether the racer pitted on the last lap
+            pit_stop_duration (np.ndarray): float64 milliseconds spent in the
+                pits on the last lap, NaN if the racer didn't pit
+            sampled_lap_time (np.ndarray): float64 milliseconds of the last
+                lap time sampled, before blocking and pit stops
+    """
+    __slots__ = ('current_time', 'laps_since_pit_stop', 'time_since_stop', 'overtaking_mode', 'pit_stopping', 'pit_stop_duration',
+                 'sampled_lap_time', 'trajectory')
+
+    def __init__(self, starting_times: np.ndarray, trajectory: int = 0):
+        num_racers = len(starting_times)
+        self.current_time = np.array(starting_times, dtype=np.float64)
+        self.laps_since_pit_stop = np.zeros(num_racers, dtype=np.int32)
+        self.time_since_stop = np.zeros(num_racers, dtype=np.float64)
+        self.overtaking_mode = np.zeros(num_racers, dtype=np.int8)
+        self.pit_stopping = np.zeros(num_racers, dtype=bool)
+        self.pit_stop_duration = np.full(num_racers, np.nan)
+        self.sampled_lap_time = np.zeros(num_racers)
+        self.trajectory = trajectory
+
+    @classmethod
+    def from_racers(cls, racers: List, trajectory: Optional[int] = None) -> 'RaceState':
+        """Makes the state at the start of a race from the racers' starting
+        times. Without a `trajectory`, racers with pre-drawn lap time
+        trajectories follow one drawn from NumPy's global generator, so that
+        races run one after another don't replay the same lap times."""
+        if trajectory is None:
+            drawn = num_trajectories(racers)
+            trajectory = np.random.randint(drawn) if drawn else 0
+        return cls([racer.starting_time / np.timedelta64(1, 'ms') for racer in racers], trajectory)
+
+    def __len__(self) -> int:
+        return len(self.current_time)
+
+    def __repr__(self) -> str:
+        return f'RaceState(order={self.order().tolist()}, current_time={self.current_time.tolist()})'
+
+    def order(self) -> np.ndarray:
+        """Returns the racers' indices from first to last"""
+        return np.argsort(self.current_time, kind='stable')
+
+    def copy(self) -> 'RaceState':
+        state = RaceState(self.current_time, self.trajectory)
+        for name in ('laps_since_pit_stop', 'time_since_stop', 'overtaking_mode', 'pit_stopping', 'pit_stop_duration', 'sampled_lap_time'):
+            getattr(state, name)[:] = getattr(self, name)
+        return state
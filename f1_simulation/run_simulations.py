@@ -1,65 +1,327 @@
+import argparse
+import functools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
 import pandas as pd
-from f1_racer import F1Racer
+import lap_times
+import overtaking
+from checkpoint import RunCheckpoint
+from f1_racer import EVERY_LAP_COMPONENTS, RACER_COMPONENTS, F1Racer
+from fitting import fit_racers
+from gp_inference import INFERENCE_BACKENDS
 from simulation import simulate_race
+from context import SimulationContext
 from dataprocessing import F1Dataset
+from features import QUALIFYING_COLUMNS, RACE_COLUMNS, RESULT_COLUMNS
+from sinks import ChunkedFileSink, MemorySink, NullSink
+from lap_times.lap_time_model import LAP_TIME_SOURCES
+from overtaking.overtaking_model import OVERTAKING_SOURCES
+from pit_stopping.pit_stop_model import PIT_STOP_DURATION_SOURCES, PIT_STOP_SOURCES
+from instrumentation import instrumentation
+from utils import load_lazy_imports, seed_random
 import numpy as np
-from timeit import default_timer
 from tqdm import tqdm
 
-data = F1Dataset('data')
+FIRST_LOGGED_RACE = 841  # data where there is proper logging of pit stopping
+# The datasets the simulated results depend on, whose changes make a checkpoint stale
+SIMULATION_SOURCES = sorted(set(['results', 'races', 'qualifying'] + LAP_TIME_SOURCES + OVERTAKING_SOURCES +
+                                PIT_STOP_SOURCES + PIT_STOP_DURATION_SOURCES))
+
+# Loaded once per process by `load`. Workers forked from a loaded parent
+# inherit them, sharing the parent's datasets, feature tables and fitted
+# models read-only.
+context: Optional[SimulationContext] = None
+race_table: Optional[pd.DataFrame] = None
+in_worker = False
+
+
+def load_race_table(data: F1Dataset) -> pd.DataFrame:
+    """Every race result joined with its race and the driver's best qualifying time"""
+    # Need to get the circuit ID of the courses
+    df = data.table('results', RESULT_COLUMNS + ['laps']).join(
+        data.table('races', RACE_COLUMNS).set_index('raceId'), on='raceId', rsuffix='_race')
+    df = (df.set_index(['raceId', 'driverId'])
+            .join(data.table('qualifying', QUALIFYING_COLUMNS)
+                      .set_index(['raceId', 'driverId'])[['q1', 'q2', 'q3']]
+                      .min(axis=1)
+                      .rename('top_quali')))  # Yikes
 
+    df.reset_index(drop=False, inplace=True)
+    return df
 
-from overtaking import process_overtaking_data
 
-overtaking_data = process_overtaking_data()
+def load(dirpath: str = 'data', models_dirpath: str = 'models', memory_budget: Optional[int] = None):
+    """Makes this process's simulation context and loads the race table, if
+    they aren't loaded already, keeping the datasets within `memory_budget`
+    bytes if given, see `F1Dataset`"""
+    global context, race_table
+    if context is None:
+        context = SimulationContext(dirpath, models_dirpath, memory_budget)
+        race_table = load_race_table(context.data)
 
 
-# Need to get the circuit ID of the courses
-df = data.results.join(data.races.set_index('raceId'), on='raceId', rsuffix='_race')
-df = (df.set_index(['raceId', 'driverId'])
-        .join(data.qualifying
-                  .set_index(['raceId', 'driverId'])[['q1', 'q2', 'q3']]
-                  .replace('\\N', np.nan)
-                  .apply(pd.to_datetime, format='%M:%S.%f')
-                  .min(axis=1)
-                  .rename('top_quali')))  # Yikes
+def init_worker(dirpath: str, models_dirpath: str, profile: bool, memory_budget: Optional[int] = None):
+    """Initialises a worker process of the pool"""
+    global in_worker
+    in_worker = True
+    if profile:
+        instrumentation.enable()
+    load(dirpath, models_dirpath, memory_budget)
 
-df['top_quali'] = df['top_quali'] - pd.to_datetime('1900-01-01', format='%Y-%m-%d')
-df.reset_index(drop=False, inplace=True)
 
-df = df.loc[df['raceId'] >= 841]  # data where there is proper logging of pit stopping
+def warm_features(years: List[int]):
+    """Builds the shared feature tables the models of `years` are fit on, so
+    workers forked afterwards use them instead of each building their own"""
+    context.features.overtaking
+    context.features.pit_laps
+    context.features.pit_durations
+    for year in years:
+        context.features.season_laps(year)
 
-races = df['raceId'].unique()
 
-with open('results.csv', 'w') as f:
-    f.write('race_id,driver,constructor,course,current_time,year,laps_since_pit_stop,lap_no,overtaking_mode,pit_stopping,pit_stop_duration,sampled_lap_time')
+def warm_pooled_models(years: List[int]):
+    """Fits the pooled models of `years`, so workers forked afterwards share
+    them instead of each fitting their own"""
+    for year in years:
+        lap_times.fit_pooled_lap_time_model(year, context=context)
+        overtaking.fit_pooled_overtaking_model(year, context=context)
 
-for race_id in tqdm(races):
-    race = df.loc[df['raceId'] == race_id]
+
+def make_racers(race_id: int, pooled: bool = False, pit_table_resolution: Optional[int] = None,
+                lazy: bool = False, fit_workers: Optional[int] = None,
+                inference: str = 'gpy') -> Tuple[List[F1Racer], int]:
+    """Creates the racers of a race, each starting a second behind the last,
+    and returns them with the number of laps in the race. With `pooled`, the
+    racers share their season's pooled lap time and overtaking models, and
+    with `pit_table_resolution` they interpolate tables of their pit stop
+    models. With `lazy`, each model is fit on first use. With `fit_workers`,
+    the models are fit concurrently by that many threads, see
+    `fitting.fit_racers`, leaving those only used on some laps to the first
+    use if `lazy`. The models are predicted from on the `inference` backend,
+    see `gp_inference.with_backend`."""
+    race = race_table.loc[race_table['raceId'] == race_id]
 
     assert len(race['circuitId'].unique()) == 1
     course_id = race['circuitId'].unique()[0]
 
     drivers = race['driverId'].tolist()
     constructors = race['constructorId'].tolist()
-    year = data.races.loc[data.races['raceId'] == race_id, 'year'].values[0]
-    num_laps = race['laps'].max()
+    races = context.data.table('races', RACE_COLUMNS)
+    year = races.loc[races['raceId'] == race_id, 'year'].values[0]
+    num_laps = int(race['laps'].max())
 
     delay = np.timedelta64(0, 's')
     racers = []
+    for driver_id, constructor_id in zip(drivers, constructors):
+        top_quali = race.loc[race['driverId'] == driver_id, 'top_quali'].values[0]
+        racer = F1Racer(race_id, driver_id, constructor_id, course_id, year, starting_time=delay, total_laps=num_laps, top_quali=top_quali, pooled=pooled, pit_table_resolution=pit_table_resolution, lazy=lazy or fit_workers is not None, inference=inference, context=context)
+        delay += np.timedelta64(1, 's')
+        racers.append(racer)
+    if fit_workers is not None:
+        fit_racers(racers, EVERY_LAP_COMPONENTS if lazy else RACER_COMPONENTS, fit_workers, progress=not in_worker)
+    return racers, num_laps
+
+
+class RaceResult(NamedTuple):
+    """What simulating one race gives back from a worker
+
+        Args:
+            race_id (int): The race
+            columns (Optional[Dict[str, list]]): Its results, one list per
+                column of `sinks.RESULT_COLUMNS`, up to the lap it failed on
+                if it failed, None if its racers couldn't be made
+            error (Optional[str]): The error it failed with, None if it finished
+            models (List[Tuple]): The keys of the models its racers fit or
+                loaded, see `F1Racer.model_key`
+            profile (Optional[Dict]): What the worker recorded for the race in
+                its instrumentation registry, if profiling
+    """
+    race_id: int
+    columns: Optional[Dict[str, list]]
+    error: Optional[str]
+    models: List[Tuple]
+    profile: Optional[Dict]
+
+
+def racer_models(racers: List[F1Racer]) -> List[Tuple]:
+    """The keys of the models the racers fit or loaded, each once"""
+    return sorted({racer.model_key(component) for racer in racers
+                   for component in RACER_COMPONENTS if component not in racer.deferred}, key=str)
+
+
+def simulate_race_results(race_id: int, seed: Optional[np.random.SeedSequence] = None, pooled: bool = False,
+                          pit_table_resolution: Optional[int] = None, lazy: bool = False,
+                          fit_workers: Optional[int] = None, inference: str = 'gpy') -> RaceResult:
+    """Simulates one race and returns its results, see `RaceResult`. Runs in
+    the worker processes, seeding NumPy's global generator with `seed` if
+    given, as forked workers would otherwise all draw the parent's stream."""
+    if in_worker:
+        instrumentation.reset()
+    if seed is not None:
+        seed_random(seed)
     try:
-        for driver_id, constructor_id in zip(drivers, constructors):
-            # print(f"Simulating {driver_id=}, {constructor_id=}")
-            top_quali = race.loc[race['driverId'] == driver_id, 'top_quali'].values[0]
-            racer = F1Racer(race_id, driver_id, constructor_id, course_id, year, starting_time=delay, total_laps=num_laps, top_quali=top_quali, overtaking_data=overtaking_data)
-            delay += np.timedelta64(1, 's')
-            racers.append(racer)
+        with instrumentation.timer('run.make_racers'):
+            racers, num_laps = make_racers(race_id, pooled, pit_table_resolution, lazy, fit_workers, inference)
     except Exception as e:
         print(f"Couldn't simulate race {race_id} because of error")
-        continue
+        return RaceResult(race_id, None, f'{type(e).__name__}: {e}', [], worker_profile())
 
+    sink = MemorySink()
+    error = None
     try:
-        simulate_race(racers, num_laps)
+        simulate_race(racers, num_laps, sink=sink)
     except Exception as e:
         print(f"Couldn't simulate race {race_id} because of error")
-    
+        error = f'{type(e).__name__}: {e}'
+    return RaceResult(race_id, sink.columns, error, racer_models(racers), worker_profile())
+
+
+def worker_profile() -> Optional[Dict]:
+    """Returns what this worker recorded since the last reset, if profiling"""
+    return instrumentation.snapshot() if in_worker and instrumentation.enabled else None
+
+
+def run_simulations(races: List[int], workers: int = 1, output: str = 'results.csv',
+                    dirpath: str = 'data', models_dirpath: str = 'models', profile: Optional[str] = None,
+                    pooled: bool = False, pit_table_resolution: Optional[int] = None, lazy: bool = False,
+                    fit_workers: Optional[int] = None, inference: str = 'gpy',
+                    memory_budget: Optional[int] = None, checkpoint: Optional[str] = None,
+                    seed: Optional[int] = None):
+    """Simulates each race once and writes the racers' lap by lap results to
+    `output` in chunks, in the order of `races`. Races are distributed over a
+    pool of `workers` processes, which are forked after the datasets and
+    feature tables are loaded so they share them rather than loading their own.
+
+    With `checkpoint`, each race's results are kept in that directory as it
+    finishes, see `checkpoint.RunCheckpoint`, and `output` is only written
+    once every race has been attempted. Rerunning with the same checkpoint
+    skips the races that finished and retries those that failed, so an
+    interrupted run picks up where it stopped, loading the models it had fit
+    from the model store, and has to be given the same options and `seed`.
+    Races that fail are left out of `output` rather than written up to the
+    lap they failed on.
+
+    Each race draws from its own child of `seed`, see `utils.seed_random`, so
+    races on different workers are independent and a race's draws don't
+    depend on the worker it runs on or the races simulated before it.
+
+    Args:
+        races (List[int]): The IDs of the races to simulate
+        workers (int): The number of worker processes, 1 to run in this process
+        output (str): The CSV or, with a `.parquet` extension, Parquet file the
+            results are written to
+        dirpath (str): The directory with the F1 data files in
+        models_dirpath (str): The directory of the fitted model store
+        profile (Optional[str]): If given, the time spent in each stage of the
+            run, merged across workers, is recorded and exported to this JSON
+            or CSV file, see `Instrumentation.export`
+        pooled (bool): Whether the racers share one lap time and one
+            overtaking model per season rather than fitting their own
+        pit_table_resolution (Optional[int]): If given, the pit stop models
+            are tabulated on grids of up to this many points per input and
+            interpolated rather than predicted from, see `tabulation.TabulatedModel`
+        lazy (bool): Whether each racer's models are only fit when first
+            used, skipping the overtaking and pit stop duration models of
+            racers that never catch a car or pit
+        fit_workers (Optional[int]): If given, the threads each race's models
+            are fit concurrently by, see `fitting.fit_racers`
+        inference (str): The backend the models are predicted and sampled on,
+            GPy or NumPy from their cached posterior factors, see `gp_inference.with_backend`
+        memory_budget (Optional[int]): If given, the bytes the raw datasets
+            may take up in each process, least recently used datasets being
+            dropped past it, see `F1Dataset`
+        checkpoint (Optional[str]): If given, the directory recording the
+            races finished, to resume the run from
+        seed (Optional[int]): The seed the races' seeds are spawned from,
+            fresh entropy if not given
+    """
+    if profile is not None:
+        instrumentation.enable()
+    load(dirpath, models_dirpath, memory_budget)
+    simulate = functools.partial(simulate_race_results, pooled=pooled, pit_table_resolution=pit_table_resolution,
+                                 lazy=lazy, fit_workers=fit_workers, inference=inference)
+    pending = races
+    if checkpoint is not None:
+        sources = [dataset for dataset in SIMULATION_SOURCES if dataset in context.data.datasets]
+        checkpoint = RunCheckpoint(checkpoint, dict(
+            dirpath=dirpath, models_dirpath=models_dirpath, pooled=pooled, pit_table_resolution=pit_table_resolution,
+            inference=inference, seed=seed, sources=context.data.fingerprint(sources)))
+        pending = checkpoint.pending(races)
+        print(f'{len(races) - len(pending)} races done, {len(pending)} to simulate, '
+              f'{len(set(pending) & set(checkpoint.failed))} of them retrying after failing')
+    # spawned for every race, so a race keeps its seed when the run is resumed
+    to_simulate = set(pending)
+    seeds = [race_seed for race_id, race_seed in zip(races, np.random.SeedSequence(seed).spawn(len(races)))
+             if race_id in to_simulate]
+
+    with ChunkedFileSink(output) if checkpoint is None else NullSink() as sink:
+        if workers == 1 or not pending:
+            results = map(simulate, pending, seeds)
+        else:
+            race_years = context.data.table('races', RACE_COLUMNS)
+            years = race_years.loc[race_years['raceId'].isin(pending), 'year'].unique().tolist()
+            warm_features(years)
+            if pooled:
+                warm_pooled_models(years)
+            load_lazy_imports()
+            methods = multiprocessing.get_all_start_methods()
+            mp_context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+            # with spawn, the workers load their own copy of the data
+            executor = ProcessPoolExecutor(workers, mp_context=mp_context, initializer=init_worker,
+                                           initargs=(dirpath, models_dirpath, profile is not None, memory_budget))
+            results = executor.map(simulate, pending, seeds)
+
+        try:
+            for result in tqdm(results, total=len(pending)):
+                if checkpoint is not None:
+                    checkpoint.record(result.race_id, result.columns, result.models, result.error)
+                elif result.columns is not None:
+                    sink.write_columns(result.columns)
+                if result.profile is not None:
+                    instrumentation.merge(result.profile)
+        finally:
+            if workers != 1 and pending:
+                executor.shutdown(cancel_futures=True)
+
+    if checkpoint is not None:
+        checkpoint.write_results(races, output)
+        print(checkpoint)
+
+    if profile is not None:
+        instrumentation.export(profile)
+        print(instrumentation.report())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate every race with logged pit stops and write the results')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--first-race', type=int, default=FIRST_LOGGED_RACE, help='first race ID to simulate')
+    parser.add_argument('--last-race', type=int, default=None, help='last race ID to simulate')
+    parser.add_argument('--output', default='results.csv', help='CSV or Parquet file the results are written to')
+    parser.add_argument('--data', default='data', help='directory with the F1 data files in')
+    parser.add_argument('--models', default='models', help='directory of the fitted model store')
+    parser.add_argument('--profile', default=None, help='JSON or CSV file to export the time spent in each stage to')
+    parser.add_argument('--pooled', action='store_true', help='share one lap time and overtaking model per season between the racers')
+    parser.add_argument('--pit-table-resolution', type=int, default=None,
+                        help='interpolate the pit stop models from tables of up to this many points per input')
+    parser.add_argument('--lazy', action='store_true', help='fit each model on first use, skipping unused ones')
+    parser.add_argument('--fit-workers', type=int, default=None, help='threads to fit each race\'s models concurrently with')
+    parser.add_argument('--inference', choices=INFERENCE_BACKENDS, default='gpy',
+                        help='predict from the models with GPy or with NumPy from their cached posterior factors')
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        help='megabytes the raw datasets may take up in each process, dropping the least recently used past it')
+    parser.add_argument('--checkpoint', default=None,
+                        help='directory recording the races finished, to skip them and retry failed ones when rerun')
+    parser.add_argument('--seed', type=int, default=None, help='seed the races\' random draws are spawned from')
+    args = parser.parse_args()
+
+    memory_budget = int(args.memory_budget * 2 ** 20) if args.memory_budget is not None else None
+    load(args.data, args.models, memory_budget)
+    race_ids = race_table['raceId']
+    race_ids = race_ids.loc[(race_ids >= args.first_race) & (race_ids <= (args.last_race if args.last_race is not None else race_ids.max()))]
+    run_simulations(race_ids.unique().tolist(), args.workers, args.output, args.data, args.models, args.profile, args.pooled,
+                    args.pit_table_resolution, args.lazy, args.fit_workers, args.inference, memory_budget,
+                    args.checkpoint, args.seed)
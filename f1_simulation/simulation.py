@@ -1,91 +1,305 @@
-from concurrent.futures import process
+import overtaking
 from f1_racer import F1Racer
+from gp_inference import with_backend
+from race_state import MODE_NONE, MODE_STUCK, MODE_SUCCESS, RaceState
+from sinks import ResultSink
+from instrumentation import instrumentation
 
-from typing import List
+import asyncio
+import bisect
+from typing import AsyncIterator, Generator, List, Optional, Tuple
 
-from timeit import default_timer
 import numpy as np
 
 
 def get_seconds_from_timedelta(time):
     return time / np.timedelta64(1, 's')
 
-def simulate_lap(racers: List[F1Racer], lap_number: int) -> List[F1Racer]:
-    """Simulates a lap of a Formula 1 race.
+def get_milliseconds_from_timedelta(time):
+    return time / np.timedelta64(1, 'ms')
+
+class LapSnapshot:
+    """The standings at the end of a lap, one entry per position. The arrays
+    are allocated once per race and overwritten every lap, so call `copy` to
+    keep a snapshot past the next lap.
+
+        Args:
+            num_racers (int): The number of racers in the race
+
+        Attributes:
+            lap (int): The lap just finished
+            order (np.ndarray): Index into the race's racers of the car in
+                each position
+            gaps (np.ndarray): Milliseconds behind the leader
+            pit_stopping (np.ndarray): Whether the car pitted this lap
+            overtaking_mode (np.ndarray): The car's `OVERTAKING_MODES` code
+    """
+    __slots__ = ('lap', 'order', 'gaps', 'pit_stopping', 'overtaking_mode')
+
+    def __init__(self, num_racers: int):
+        self.lap = -1
+        self.order = np.zeros(num_racers, dtype=np.int16)
+        self.gaps = np.zeros(num_racers)
+        self.pit_stopping = np.zeros(num_racers, dtype=bool)
+        self.overtaking_mode = np.zeros(num_racers, dtype=np.int8)
+
+    def __repr__(self) -> str:
+        return f'LapSnapshot(lap={self.lap}, order={self.order.tolist()})'
+
+    def update(self, lap_number: int, state: RaceState):
+        """Overwrites the snapshot with the standings in `state`"""
+        self.lap = lap_number
+        self.order[:] = state.order()
+        np.take(state.current_time, self.order, out=self.gaps)
+        self.gaps -= self.gaps[0]
+        np.take(state.pit_stopping, self.order, out=self.pit_stopping)
+        np.take(state.overtaking_mode, self.order, out=self.overtaking_mode)
+
+    def copy(self) -> 'LapSnapshot':
+        snapshot = LapSnapshot(len(self.order))
+        snapshot.lap = self.lap
+        for name in ('order', 'gaps', 'pit_stopping', 'overtaking_mode'):
+            getattr(snapshot, name)[:] = getattr(self, name)
+        return snapshot
+
+
+def sample_passes(probabilities: np.ndarray) -> np.ndarray:
+    """Samples how many cars in a row each racer gets past, attempting one
+    overtake after another with its success probability until one fails.
+    That count is geometric, so it takes one draw per racer however many
+    cars they catch.
+    """
+    # a racer certain to pass gets past around 1e12 cars, rather than the
+    # draw overflowing
+    failure = np.clip(1 - probabilities, 1e-12, 1)
+    return np.random.geometric(failure) - 1
+
+
+@instrumentation.timed('simulation.overtakes')
+def resolve_overtakes(racers: List[F1Racer], order: List[int], start_times: List[float], lap_times: List[float],
+                      pit_times: List[float]) -> Tuple[List[float], List[int]]:
+    """Resolves every overtake of a lap. A racer whose lap would end ahead of
+    cars that started the lap in front of it has crossed them, and tries to
+    pass them one by one from the nearest, the car finishing just ahead of
+    it. It gets past them all or is stuck behind the first it fails to pass,
+    finishing the lap at that car's time. A racer's pit stop is added after its
+    overtakes, so the cars behind have to pass a car that pits like any other.
+
+    The success probabilities of every racer that could cross a car are drawn
+    at once, see `overtaking.sample_overtake_probabilities`, in a single
+    posterior call when the racers share a pooled overtaking model
+    (`pooled=True`) and one call per racer otherwise. The order is then
+    resolved from the front by bisecting the sorted finishing times of the
+    cars ahead: O(log n) comparisons per car for n racers, but inserting
+    into the sorted list moves up to n entries, so O(n^2) in all, which for
+    a grid of 20 is a few hundred element moves a lap.
 
     Args:
-        racers (List[F1Racer]): A list of racers at the start of the lap
+        racers (List[F1Racer]): The racers of the race
+        order (List[int]): The racers' indices from first to last at the
+            start of the lap
+        start_times (List[float]): Each racer's race time in milliseconds at
+            the start of the lap
+        lap_times (List[float]): Each racer's sampled lap time in milliseconds
+        pit_times (List[float]): Milliseconds each racer spends in the pits
+            this lap, 0 if they don't pit
 
     Returns:
-        List[F1Racer]: A list of racers with updated parameters at the end of the lap
+        Tuple[List[float], List[int]]: Each racer's race time at the end of
+            the lap and their `OVERTAKING_MODES` code
     """
+    unblocked = [start + lap_time for start, lap_time in zip(start_times, lap_times)]
 
-    racers = sorted(racers, key=lambda x: x.current_time)
-    racers_past_times = list(map(lambda x: x.current_time, racers))
+    # A blocked car finishes at the time of a car ahead of it, so no car
+    # finishes later than the latest of its own and the cars ahead's bounds
+    # plus its pit stop. Only cars that would finish before the bound of the
+    # cars ahead can cross anyone.
+    candidates, latest = [], -np.inf
+    for i in order:
+        if unblocked[i] < latest:
+            candidates.append(i)
+        latest = max(latest, unblocked[i]) + pit_times[i]
 
-    for pos, racer in enumerate(racers):
-        # For logging
-        racer.overtaking_mode = None
-        racer.pit_stopping = None
-        racer.pit_stop_duration = None
-        racer.sampled_lap_time = None
+    passes = [0] * len(racers)
+    if candidates:
+        candidate_racers = [racers[i] for i in candidates]
+        probabilities = overtaking.sample_overtake_probabilities(
+            [with_backend(racer.overtake_model, racer.inference) for racer in candidate_racers],
+            [lap_times[i] / 1000 for i in candidates], candidate_racers[0].year, candidate_racers[0].course,
+            [racer.constructor for racer in candidate_racers])
+        for i, count in zip(candidates, sample_passes(probabilities).tolist()):
+            passes[i] = count
 
-        ##### Sample lap time ##### 
-        lap_time = racer.sample_lap_time(lap_number)
-        racer.current_time += lap_time
-        racer.sampled_lap_time = lap_time
-
-        ##### Overtakes ##### 
-        if pos != 0:  # first place can't get stuck behind another car
-            # TODO: Model lapping dynamics? What happens when racers are a lap behind leaders?
-            previous_racer = racers[pos-1]
-            # TODO Fix this so a car can overtake multiple other cars in one lap
-            if racer.current_time < previous_racer.current_time:
-                overtakes = racer.sample_overtake(get_seconds_from_timedelta(lap_time))
-                if not overtakes:
-                    racer.current_time = previous_racer.current_time  # Cap the lap time 
-                    racer.overtaking_mode = 'stuck'
-                else:
-                    racer.overtaking_mode = 'success'
+    end_times = [0.] * len(racers)
+    overtaking_mode = [MODE_NONE] * len(racers)
+    ahead = []  # finishing times of the cars ahead, ascending
+    for i in order:
+        # TODO: Model lapping dynamics? What happens when racers are a lap behind leaders?
+        time = unblocked[i]
+        crossed = len(ahead) - bisect.bisect_right(ahead, time)
+        if crossed:
+            if passes[i] >= crossed:
+                overtaking_mode[i] = MODE_SUCCESS
             else:
-                racer.overtaking_mode = None
+                time = ahead[len(ahead) - 1 - passes[i]]  # Cap the lap time
+                overtaking_mode[i] = MODE_STUCK
+        time += pit_times[i]
+        bisect.insort(ahead, time)
+        end_times[i] = time
+    return end_times, overtaking_mode
+
+
+@instrumentation.timed('simulation.lap')
+def simulate_lap(racers: List[F1Racer], state: RaceState, lap_number: int,
+                 sink: Optional[ResultSink] = None) -> RaceState:
+    """Simulates a lap of a Formula 1 race. Each racer's lap time and pit stop
+    are sampled first, then the overtakes of the whole field are resolved at
+    once by `resolve_overtakes`, so a car can pass several others in a lap.
+
+    Args:
+        racers (List[F1Racer]): The racers, in the order `state` is indexed by
+        state (RaceState): The state at the start of the lap, updated in place
+        lap_number (int): The lap being simulated
+        sink (Optional[ResultSink]): Receives the racers' state at the end
+            of the lap, nothing is recorded if not given
+
+    Returns:
+        RaceState: `state`, at the end of the lap
+    """
+    # the lap is run on plain python values and written back to the arrays once
+    order = state.order().tolist()
+    current_time = state.current_time.tolist()
+    past_times = [current_time[i] for i in order]
+    laps_since_pit_stop = state.laps_since_pit_stop.tolist()
+    time_since_stop = state.time_since_stop.tolist()
+    pit_stopping = [False] * len(racers)
+    pit_stop_duration = [np.nan] * len(racers)
+    pit_times = [0] * len(racers)
+    sampled_lap_time = [0.] * len(racers)
+
+    for pos, i in enumerate(order):
+        racer = racers[i]
+
+        ##### Sample lap time ##### 
+        lap_time = racer.sample_lap_time(lap_number, laps_since_pit_stop[i], state.trajectory)
+        sampled_lap_time[i] = lap_time
 
         ###### Pit stopping ###### 
-        car_before = racers_past_times[pos-1] if pos>0 else 1e9
-        car_after = racers_past_times[pos+1] if pos<len(racers_past_times)-1 else 1e9
-        if racer.sample_pit_stop(car_before, car_after, lap_time):
+        # gaps to the surrounding cars at the start of the lap, in milliseconds
+        car_before = past_times[pos] - past_times[pos-1] if pos>0 else 1e9
+        car_after = past_times[pos+1] - past_times[pos] if pos<len(past_times)-1 else 1e9
+        time_since_stop[i] += lap_time
+        if racer.sample_pit_stop(car_before, car_after, time_since_stop[i]):
             pit_stop_time = racer.sample_pit_stop_duration(lap_number)
-            racer.current_time += np.timedelta64(int(pit_stop_time), 'ms')
-            racer.laps_since_pit_stop = 0
-            racer.pit_stopping = True
-            racer.pit_stop_duration = pit_stop_time / 1000  # Convert to seconds
+            pit_times[i] = int(pit_stop_time)
+            laps_since_pit_stop[i] = 0
+            time_since_stop[i] = 0.
+            pit_stopping[i] = True
+            pit_stop_duration[i] = pit_stop_time
         else:
-            racer.laps_since_pit_stop += 1
-            racer.pit_stopping = False
-            racer.pit_stop_duration = None
+            laps_since_pit_stop[i] += 1
+
+    ##### Overtakes ##### 
+    current_time, overtaking_mode = resolve_overtakes(racers, order, current_time, sampled_lap_time, pit_times)
 
-    racers = sorted(racers, key=lambda x: x.current_time)  # Sort again for good measure
-    # print("#"*40 + "Lap Finished" + "#"*40)
-    # print(f"Lap Times: {lap_times}, Pit Stops: {pit_stop_times}, Num Pit Stops: {num_pit_stops} Overtakes {num_overtakes}")
-    with open('results.csv', 'a') as f:
-        for racer in racers:
-            racer.write_info(f, lap_number)
-    return racers
+    state.current_time[:] = current_time
+    state.laps_since_pit_stop[:] = laps_since_pit_stop
+    state.time_since_stop[:] = time_since_stop
+    state.overtaking_mode[:] = overtaking_mode
+    state.pit_stopping[:] = pit_stopping
+    state.pit_stop_duration[:] = pit_stop_duration
+    state.sampled_lap_time[:] = sampled_lap_time
+    if sink is not None:
+        sink.write_lap(racers, state, lap_number)
+    return state
 
 
+@instrumentation.timed('simulation.race')
 def simulate_race(racers: List[F1Racer],
-                  num_laps: int) -> List[F1Racer]:
+                  num_laps: int,
+                  trajectory: Optional[int] = None,
+                  sink: Optional[ResultSink] = None) -> RaceState:
     """Simulates an entire race from a list of F1 Racer objects over `num_laps`
     laps
 
     Args:
         racers (List[F1Racer]): A list of F1Racer objects at the start of the race
         num_laps (int): The number of laps that the race lasts for
+        trajectory (Optional[int]): For racers with pre-drawn lap time
+            trajectories, the trajectory each racer follows in this race,
+            drawn at random if not given, see `RaceState.from_racers`
+        sink (Optional[ResultSink]): Receives the racers' state at the end of
+            every lap, nothing is recorded if not given
 
     Returns:
-        List[F1Racer]: A list of F1Racer objects at the end of the race
+        RaceState: The state at the end of the race, `order()` giving the
+            finishing order
     """
+    state = RaceState.from_racers(racers, trajectory)
     for lap in range(num_laps):
-        racers = simulate_lap(racers, lap)
+        simulate_lap(racers, state, lap, sink)
+
+    return state
+
+
+def stream_race(racers: List[F1Racer],
+                num_laps: int,
+                trajectory: Optional[int] = None,
+                sink: Optional[ResultSink] = None) -> Generator[LapSnapshot, None, RaceState]:
+    """Generator form of `simulate_race`, yielding the standings after every
+    lap. A lap is only simulated once the consumer asks for it, so a slow
+    consumer holds the simulation back rather than snapshots piling up, and
+    the race can be cancelled by stopping iteration or calling `close`.
+
+    Args:
+        racers (List[F1Racer]): A list of F1Racer objects at the start of the race
+        num_laps (int): The number of laps that the race lasts for
+        trajectory (Optional[int]): For racers with pre-drawn lap time
+            trajectories, the trajectory each racer follows in this race,
+            drawn at random if not given, see `RaceState.from_racers`
+        sink (Optional[ResultSink]): Receives the racers' state at the end of
+            every lap, nothing is recorded if not given
 
-    return racers
+    Yields:
+        LapSnapshot: The standings, the same object every lap
+
+    Returns:
+        RaceState: The state at the end of the race
+    """
+    state = RaceState.from_racers(racers, trajectory)
+    snapshot = LapSnapshot(len(racers))
+    for lap in range(num_laps):
+        simulate_lap(racers, state, lap, sink)
+        snapshot.update(lap, state)
+        yield snapshot
+
+    return state
+
+
+async def astream_race(racers: List[F1Racer],
+                       num_laps: int,
+                       trajectory: Optional[int] = None,
+                       sink: Optional[ResultSink] = None) -> AsyncIterator[LapSnapshot]:
+    """Async iterator form of `stream_race`. Each lap is simulated in a worker
+    thread once the consumer asks for it, so the event loop stays responsive
+    and a slow consumer holds the simulation back. Cancelling the consuming
+    task, or leaving the loop, stops the race after the lap in progress.
+
+    Args:
+        racers (List[F1Racer]): A list of F1Racer objects at the start of the race
+        num_laps (int): The number of laps that the race lasts for
+        trajectory (Optional[int]): For racers with pre-drawn lap time
+            trajectories, the trajectory each racer follows in this race,
+            drawn at random if not given, see `RaceState.from_racers`
+        sink (Optional[ResultSink]): Receives the racers' state at the end of
+            every lap, nothing is recorded if not given
+
+    Yields:
+        LapSnapshot: The standings, the same object every lap
+    """
+    state = RaceState.from_racers(racers, trajectory)
+    snapshot = LapSnapshot(len(racers))
+    for lap in range(num_laps):
+        await asyncio.to_thread(simulate_lap, racers, state, lap, sink)
+        snapshot.update(lap, state)
+        yield snapshot
@@ -0,0 +1,153 @@
+import abc
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from race_state import OVERTAKING_MODE_NAMES, RaceState
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet output is unavailable without pyarrow
+    pa = None
+    pq = None
+
+# The columns of the results, one row per racer per lap
+RESULT_COLUMNS = ['race_id', 'driver', 'constructor', 'course', 'current_time', 'year', 'laps_since_pit_stop',
+                  'lap_no', 'overtaking_mode', 'pit_stopping', 'pit_stop_duration', 'sampled_lap_time']
+RESULT_SCHEMA = pa.schema([
+    ('race_id', pa.int64()), ('driver', pa.int64()), ('constructor', pa.int64()), ('course', pa.int64()),
+    ('current_time', pa.float64()), ('year', pa.int64()), ('laps_since_pit_stop', pa.int64()),
+    ('lap_no', pa.int64()), ('overtaking_mode', pa.string()), ('pit_stopping', pa.bool_()),
+    ('pit_stop_duration', pa.float64()), ('sampled_lap_time', pa.float64()),
+]) if pa is not None else None
+
+
+def lap_columns(racers: List, state: RaceState, lap_number: int) -> Dict[str, list]:
+    """Returns the racers' state at the end of a lap as one list per column
+    of `RESULT_COLUMNS`, from first to last and with times in seconds"""
+    order = state.order()
+    racers = [racers[i] for i in order]
+    pit_stop_duration = state.pit_stop_duration[order] / 1000
+    return {
+        'race_id': [racer.race_id for racer in racers],
+        'driver': [racer.driver for racer in racers],
+        'constructor': [racer.constructor for racer in racers],
+        'course': [racer.course for racer in racers],
+        'current_time': (state.current_time[order] / 1000).tolist(),
+        'year': [racer.year for racer in racers],
+        'laps_since_pit_stop': state.laps_since_pit_stop[order].tolist(),
+        'lap_no': [lap_number] * len(racers),
+        'overtaking_mode': [OVERTAKING_MODE_NAMES[mode] for mode in state.overtaking_mode[order]],
+        'pit_stopping': state.pit_stopping[order].tolist(),
+        'pit_stop_duration': [None if np.isnan(duration) else duration for duration in pit_stop_duration.tolist()],
+        'sampled_lap_time': (state.sampled_lap_time[order] / 1000).tolist(),
+    }
+
+
+class ResultSink(abc.ABC):
+    """Receives the racers' state at the end of every simulated lap. Sinks
+    can be used as context managers, which close them on exit. Subclasses
+    implement `write_columns`.
+    """
+    def write_lap(self, racers: List, state: RaceState, lap_number: int):
+        """Records the racers' state at the end of lap `lap_number`"""
+        self.write_columns(lap_columns(racers, state, lap_number))
+
+    @abc.abstractmethod
+    def write_columns(self, columns: Dict[str, list]):
+        """Records rows given as one list per column of `RESULT_COLUMNS`"""
+
+    def flush(self):
+        """Writes out any buffered rows"""
+
+    def close(self):
+        """Flushes the sink and releases anything it holds open"""
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class NullSink(ResultSink):
+    """Discards every row, for benchmarks and runs that only need the final
+    state of the racers"""
+    def write_lap(self, racers: List, state: RaceState, lap_number: int):
+        pass
+
+    def write_columns(self, columns: Dict[str, list]):
+        pass
+
+
+class MemorySink(ResultSink):
+    """Keeps every row in memory, one list per column"""
+    def __init__(self):
+        self.columns = {column: [] for column in RESULT_COLUMNS}
+
+    def __len__(self) -> int:
+        return len(self.columns['race_id'])
+
+    def write_columns(self, columns: Dict[str, list]):
+        for column in RESULT_COLUMNS:
+            self.columns[column].extend(columns[column])
+
+    def to_frame(self) -> pd.DataFrame:
+        """Returns the rows as a dataframe"""
+        return pd.DataFrame(self.columns, columns=RESULT_COLUMNS)
+
+    def clear(self):
+        """Drops the rows held"""
+        for values in self.columns.values():
+            values.clear()
+
+
+class ChunkedFileSink(MemorySink):
+    """Buffers rows in memory and writes them to a CSV or Parquet file in
+    chunks of `chunk_size` rows, so the file is written a few times per run
+    rather than opened every lap. The file is replaced when the sink is
+    created.
+
+        Args:
+            path (str): The file to write
+            chunk_size (int): The number of rows buffered before writing
+            format (Optional[str]): 'csv' or 'parquet', from the extension
+                of `path` if not given
+    """
+    def __init__(self, path: str, chunk_size: int = 100_000, format: Optional[str] = None):
+        super().__init__()
+        self.path = path
+        self.chunk_size = chunk_size
+        self.format = format if format is not None else ('parquet' if path.endswith('.parquet') else 'csv')
+        self._parquet_writer = None
+        if self.format == 'parquet':
+            if pq is None:
+                raise ImportError("Writing Parquet results requires pyarrow")
+            self._parquet_writer = pq.ParquetWriter(path, RESULT_SCHEMA)
+        elif self.format == 'csv':
+            self.to_frame().to_csv(path, index=False)
+        else:
+            raise ValueError(f"Unknown results format '{self.format}'")
+
+    def write_columns(self, columns: Dict[str, list]):
+        super().write_columns(columns)
+        if len(self) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not len(self):
+            return
+        if self._parquet_writer is not None:
+            self._parquet_writer.write_table(pa.Table.from_pydict(self.columns, schema=RESULT_SCHEMA))
+        else:
+            self.to_frame().to_csv(self.path, mode='a', header=False, index=False, na_rep='None')
+        self.clear()
+
+    def close(self):
+        self.flush()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
@@ -0,0 +1,201 @@
+import argparse
+import os
+from typing import Dict, NamedTuple
+
+import numpy as np
+import pandas as pd
+
+
+class Scale(NamedTuple):
+    """The size of a synthetic dataset"""
+    seasons: int
+    races_per_season: int
+    drivers: int
+    laps: int
+
+
+# Named sizes, from a quick smoke test to around the size of the Kaggle data
+# since proper pit stop logging began
+SCALES: Dict[str, Scale] = {
+    'tiny': Scale(seasons=2, races_per_season=3, drivers=6, laps=20),
+    'small': Scale(seasons=2, races_per_season=5, drivers=10, laps=40),
+    'medium': Scale(seasons=4, races_per_season=10, drivers=20, laps=55),
+    'large': Scale(seasons=12, races_per_season=20, drivers=20, laps=60),
+}
+
+# Milliseconds
+BASE_LAP_TIME = 80_000
+PIT_LANE_TIME = 22_000
+# The first race with logged pit stops in the Kaggle data, `run_simulations.FIRST_LOGGED_RACE`
+FIRST_RACE_ID = 841
+
+
+def format_lap_time(milliseconds: np.ndarray) -> np.ndarray:
+    """Formats milliseconds as the dataset's 'M:SS.fff' time strings"""
+    milliseconds = np.asarray(milliseconds, dtype=np.int64)
+    return np.array([f'{ms // 60000}:{(ms // 1000) % 60:02d}.{ms % 1000:03d}' for ms in milliseconds.tolist()],
+                    dtype=object)
+
+
+def generate_dataset(dirpath: str, seasons: int = 2, races_per_season: int = 3, drivers: int = 6, laps: int = 20,
+                     first_year: int = 2011, first_race_id: int = FIRST_RACE_ID, seed: int = 0):
+    """Writes a synthetic Formula 1 dataset that `F1Dataset` can load in
+    place of the Kaggle CSVs: `races`, `results`, `lap_times`, `pit_stops`,
+    `qualifying`, `drivers`, `constructors` and `circuits`, with the Kaggle
+    columns and `\\N` for missing values.
+
+    Every season runs the same circuits in the same order with the same
+    drivers, two to a constructor. Each driver has a pace that drifts a little
+    from season to season, and their lap times get slower with tyre wear and
+    faster as fuel burns off. Every driver makes one or two pit stops a race,
+    the pit lane time added to the lap they stop on.
+
+    Args:
+        dirpath (str): The directory to write the CSVs to, created if needed
+        seasons (int): The number of seasons
+        races_per_season (int): The number of races, and circuits, per season
+        drivers (int): The number of drivers in every race
+        laps (int): The number of laps in every race, at least 10
+        first_year (int): The year of the first season
+        first_race_id (int): The ID of the first race, the default being the
+            first race with logged pit stops in the Kaggle data so that
+            `run_simulations` picks every race up
+        seed (int): Seed of the random generator, the same seed and sizes
+            giving the same files
+    """
+    if laps < 10:
+        raise ValueError(f"Races need at least 10 laps to fit in the pit stops, not {laps}")
+    rng = np.random.default_rng(seed)
+    os.makedirs(dirpath, exist_ok=True)
+
+    num_races = seasons * races_per_season
+    race_ids = first_race_id + np.arange(num_races)
+    years = first_year + np.arange(seasons).repeat(races_per_season)
+    rounds = np.tile(np.arange(1, races_per_season + 1), seasons)
+    circuit_ids = rounds
+    driver_ids = np.arange(1, drivers + 1)
+    constructor_ids = (driver_ids + 1) // 2
+
+    races = pd.DataFrame({
+        'raceId': race_ids, 'year': years, 'round': rounds, 'circuitId': circuit_ids,
+        'name': [f'Grand Prix {circuit}' for circuit in circuit_ids],
+        'date': [f'{year}-{3 + (rnd - 1) * 9 // races_per_season:02d}-{1 + (rnd - 1) % 4 * 7:02d}'
+                 for year, rnd in zip(years, rounds)],
+        'time': '\\N', 'url': '\\N',
+    })
+    circuits = pd.DataFrame({
+        'circuitId': np.arange(1, races_per_season + 1),
+        'circuitRef': [f'circuit_{i}' for i in range(1, races_per_season + 1)],
+        'name': [f'Circuit {i}' for i in range(1, races_per_season + 1)],
+        'location': 'Synthetic', 'country': 'Synthetic', 'lat': 0.0, 'lng': 0.0, 'alt': '\\N', 'url': '\\N',
+    })
+    drivers_df = pd.DataFrame({
+        'driverId': driver_ids, 'driverRef': [f'driver_{i}' for i in driver_ids], 'number': driver_ids,
+        'code': [f'D{i:02d}' for i in driver_ids], 'forename': 'Driver', 'surname': [f'{i}' for i in driver_ids],
+        'dob': '1990-01-01', 'nationality': 'Synthetic', 'url': '\\N',
+    })
+    constructors = pd.DataFrame({
+        'constructorId': np.unique(constructor_ids),
+        'constructorRef': [f'constructor_{i}' for i in np.unique(constructor_ids)],
+        'name': [f'Constructor {i}' for i in np.unique(constructor_ids)],
+        'nationality': 'Synthetic', 'url': '\\N',
+    })
+
+    # [race, driver] pace and qualifying
+    pace = rng.normal(0, 500, drivers) + rng.normal(0, 150, (seasons, drivers)).cumsum(axis=0)
+    pace = pace.repeat(races_per_season, axis=0)
+    circuit_base = BASE_LAP_TIME + 1000 * circuit_ids[:, None]
+    quali_time = circuit_base - 1000 + pace + rng.normal(0, 100, (num_races, drivers))
+    grid = quali_time.argsort(axis=1).argsort(axis=1) + 1
+
+    # [race, driver] pit stops, one or two a race at distinct laps
+    num_stops = rng.integers(1, 3, (num_races, drivers))
+    first_stop = rng.integers(laps // 5, laps // 2, (num_races, drivers))
+    second_stop = rng.integers(laps // 2 + 1, laps - laps // 5, (num_races, drivers))
+    stop_durations = rng.normal(PIT_LANE_TIME, 1000, (num_races, drivers, 2)).astype(np.int64)
+
+    # [race, driver, lap] lap times
+    lap_numbers = np.arange(1, laps + 1)
+    first_stop, second_stop = first_stop[..., None], np.where(num_stops == 2, second_stop, laps + 1)[..., None]
+    stopped = (lap_numbers == first_stop) | (lap_numbers == second_stop)
+    last_stop = np.where(lap_numbers > second_stop, second_stop, np.where(lap_numbers > first_stop, first_stop, 0))
+    milliseconds = (circuit_base[..., None] + pace[..., None]
+                    + 40 * (lap_numbers - last_stop)  # tyre wear
+                    - 15 * lap_numbers  # fuel burn
+                    + rng.normal(0, 300, (num_races, drivers, laps)))
+    milliseconds[:, :, 0] += 2000 + 500 * (grid - 1)  # standing start from the grid
+    milliseconds += np.where(lap_numbers == first_stop, stop_durations[..., 0, None], 0)
+    milliseconds += np.where(lap_numbers == second_stop, stop_durations[..., 1, None], 0)
+    milliseconds = milliseconds.astype(np.int64)
+    accumulated = milliseconds.cumsum(axis=2)
+    positions = accumulated.argsort(axis=1).argsort(axis=1) + 1
+
+    race_index, driver_index, lap_index = np.indices((num_races, drivers, laps)).reshape(3, -1)
+    lap_times = pd.DataFrame({
+        'raceId': race_ids[race_index], 'driverId': driver_ids[driver_index], 'lap': lap_index + 1,
+        'position': positions.ravel(), 'time': format_lap_time(milliseconds.ravel()),
+        'milliseconds': milliseconds.ravel(),
+    })
+
+    stop_race, stop_driver, stop_lap = np.nonzero(stopped)
+    stop_number = np.where(stop_lap + 1 == first_stop[stop_race, stop_driver, 0], 1, 2)
+    durations = stop_durations[stop_race, stop_driver, stop_number - 1]
+    time_of_day = 14 * 3600 + accumulated[stop_race, stop_driver, stop_lap] // 1000  # from a 2pm start
+    pit_stops = pd.DataFrame({
+        'raceId': race_ids[stop_race], 'driverId': driver_ids[stop_driver], 'stop': stop_number,
+        'lap': stop_lap + 1,
+        'time': [f'{t // 3600:02d}:{t // 60 % 60:02d}:{t % 60:02d}' for t in time_of_day.tolist()],
+        'duration': [f'{duration / 1000:.3f}' for duration in durations], 'milliseconds': durations,
+    })
+
+    race_index, driver_index = np.indices((num_races, drivers)).reshape(2, -1)
+    quali_position = grid.ravel()
+    quali = quali_time.ravel()
+    qualifying = pd.DataFrame({
+        'qualifyId': np.arange(1, len(quali) + 1), 'raceId': race_ids[race_index],
+        'driverId': driver_ids[driver_index], 'constructorId': constructor_ids[driver_index],
+        'number': driver_ids[driver_index], 'position': quali_position,
+        'q1': format_lap_time(quali + 500),
+        'q2': np.where(quali_position <= max(1, drivers * 3 // 4), format_lap_time(quali + 200), '\\N'),
+        'q3': np.where(quali_position <= max(1, drivers // 2), format_lap_time(quali), '\\N'),
+    })
+
+    total = accumulated[:, :, -1]
+    finish = positions[:, :, -1].ravel()
+    fastest_lap = milliseconds.argmin(axis=2)
+    results = pd.DataFrame({
+        'resultId': np.arange(1, len(finish) + 1), 'raceId': race_ids[race_index],
+        'driverId': driver_ids[driver_index], 'constructorId': constructor_ids[driver_index],
+        'number': driver_ids[driver_index], 'grid': quali_position, 'position': finish,
+        'positionText': finish.astype(str), 'positionOrder': finish, 'points': 0.0, 'laps': laps,
+        'time': '\\N', 'milliseconds': total.ravel(), 'fastestLap': fastest_lap.ravel() + 1,
+        'rank': fastest_lap.argsort(axis=1).argsort(axis=1).ravel() + 1,
+        'fastestLapTime': format_lap_time(milliseconds.min(axis=2).ravel()),
+        'fastestLapSpeed': '\\N', 'statusId': 1,
+    }).sort_values(['raceId', 'position'], kind='stable')
+
+    for name, df in [('races', races), ('circuits', circuits), ('drivers', drivers_df),
+                     ('constructors', constructors), ('lap_times', lap_times), ('pit_stops', pit_stops),
+                     ('qualifying', qualifying), ('results', results)]:
+        df.to_csv(os.path.join(dirpath, f'{name}.csv'), index=False)
+
+
+def generate_scale(dirpath: str, scale: str = 'tiny', seed: int = 0):
+    """Writes a synthetic dataset of one of the `SCALES`, see `generate_dataset`"""
+    generate_dataset(dirpath, **SCALES[scale]._asdict(), seed=seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic dataset in the format of the Kaggle F1 CSVs')
+    parser.add_argument('dirpath', help='directory to write the CSVs to')
+    parser.add_argument('--scale', choices=list(SCALES), default='tiny', help='named size of the dataset')
+    parser.add_argument('--seasons', type=int, default=None, help='number of seasons, overriding the scale')
+    parser.add_argument('--races-per-season', type=int, default=None, help='races per season, overriding the scale')
+    parser.add_argument('--drivers', type=int, default=None, help='drivers per race, overriding the scale')
+    parser.add_argument('--laps', type=int, default=None, help='laps per race, overriding the scale')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random generator')
+    args = parser.parse_args()
+
+    sizes = SCALES[args.scale]._asdict()
+    sizes.update({name: getattr(args, name) for name in sizes if getattr(args, name) is not None})
+    generate_dataset(args.dirpath, **sizes, seed=args.seed)
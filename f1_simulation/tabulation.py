@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from utils import lazy_import
+
+GPy = lazy_import('GPy')
+interpolate = lazy_import('scipy.interpolate')
+
+DEFAULT_TABLE_RESOLUTION = 256
+# The most points the maximum error is measured at
+MAX_ERROR_POINTS = 2000
+
+
+def varying_columns(kernel: GPy.kern.Kern) -> List[int]:
+    """The input columns a kernel varies with, those of its parts other than constants"""
+    parts = kernel.parts if isinstance(kernel, GPy.kern.Add) else [kernel]
+    return sorted({int(dim) for part in parts if not isinstance(part, GPy.kern.Bias) for dim in part.active_dims})
+
+
+def column_grid(values: np.ndarray, resolution: int) -> np.ndarray:
+    """The grid points for one input column of the training data. Whole
+    numbers with no more distinct values than `resolution` in their range,
+    like laps, get a point at every one of them. Otherwise half the points
+    are spread evenly from the smallest value to the 90th percentile and half
+    at quantiles of the data, so far outliers like the leader's 1e9 gap are
+    covered without thinning the grid where the data is.
+    """
+    low, high = values.min(), values.max()
+    if np.all(values == np.round(values)) and high - low + 1 <= resolution:
+        return np.arange(low, high + 1)
+    even = np.linspace(low, np.quantile(values, 0.9), resolution - resolution // 2)
+    quantiles = np.quantile(values, np.linspace(0, 1, resolution // 2))
+    return np.unique(np.concatenate([even, quantiles]))
+
+
+class TabulatedModel:
+    """A GP's predictive mean and variance evaluated once on a grid and
+    interpolated linearly from then on. It has the `predict` method the pit
+    stop processes call, so it can stand in for the live model. Only the
+    columns the kernel varies with are tabulated, see `varying_columns`, and
+    inputs outside the grid are clamped to its edges. The pit decision
+    kernel's RBF only takes the gap to the car ahead, `car_before`, its other
+    inputs entering through a constant `Bias`, so its table is 1-D over that
+    gap. The duration table is 1-D over the lap.
+
+    The largest differences from the live model's mean and standard
+    deviation, at the training inputs and the midpoints between grid points,
+    are kept in `max_error`.
+
+        Args:
+            model (GPy.core.GP): The live model
+            resolution (int): The most grid points per tabulated column
+            grids (Optional[Dict[int, np.ndarray]]): Grid points of some
+                columns, in place of `column_grid`
+
+        Attributes:
+            columns (List[int]): The tabulated columns
+            grids (List[np.ndarray]): The grid points of each tabulated column
+            max_error (Dict[str, float]): The largest absolute `mean` and
+                `std` differences from the live model
+    """
+    def __init__(self, model: GPy.core.GP, resolution: int = DEFAULT_TABLE_RESOLUTION,
+                 grids: Optional[Dict[int, np.ndarray]] = None):
+        grids = grids if grids is not None else {}
+        X = np.asarray(model.X)
+        self.input_dim = X.shape[1]
+        self.columns = varying_columns(model.kern) or [0]
+        self.grids = [np.asarray(grids[column], dtype=float) if column in grids
+                      else column_grid(X[:, column], resolution) for column in self.columns]
+        # the kernel is constant in the other columns, any value will do
+        self._fill = np.median(X, axis=0)
+        self.noise_variance = float(model.likelihood.variance[0]) \
+            if type(model.likelihood) is GPy.likelihoods.Gaussian else None
+
+        points = np.stack([axis.ravel() for axis in np.meshgrid(*self.grids, indexing='ij')], axis=1)
+        mean, var = model.predict(self._inputs(points), include_likelihood=False)
+        shape = [len(grid) for grid in self.grids]
+        self.mean_table = mean[:, 0].reshape(shape)
+        self.var_table = np.maximum(var[:, 0], 0).reshape(shape)
+        if len(self.columns) > 1:
+            self._mean = interpolate.RegularGridInterpolator(self.grids, self.mean_table)
+            self._var = interpolate.RegularGridInterpolator(self.grids, self.var_table)
+        self.max_error = self._max_error(model, X)
+
+    def __repr__(self) -> str:
+        return (f'TabulatedModel(columns={self.columns}, points={[len(grid) for grid in self.grids]}, '
+                f'max_error={self.max_error})')
+
+    def _inputs(self, points: np.ndarray) -> np.ndarray:
+        X = np.tile(self._fill, (len(points), 1))
+        X[:, self.columns] = points
+        return X
+
+    def _max_error(self, model: GPy.core.GP, X: np.ndarray) -> Dict[str, float]:
+        rng = np.random.default_rng(0)
+        if len(X) > MAX_ERROR_POINTS:
+            X = X[rng.choice(len(X), MAX_ERROR_POINTS, replace=False)]
+        midpoints = [(grid[1:] + grid[:-1]) / 2 if len(grid) > 1 else grid for grid in self.grids]
+        points = np.stack([rng.choice(midpoint, min(MAX_ERROR_POINTS, max(map(len, midpoints))))
+                           for midpoint in midpoints], axis=1)
+        X = np.concatenate([X, self._inputs(points)])
+        mean, var = model.predict(X, include_likelihood=False)
+        table_mean, table_var = self.predict(X, include_likelihood=False)
+        return dict(mean=float(np.max(np.abs(mean - table_mean))),
+                    std=float(np.max(np.abs(np.sqrt(np.maximum(var, 0)) - np.sqrt(table_var)))))
+
+    def predict(self, X: np.ndarray, include_likelihood: bool = True):
+        """Interpolates the predictive mean and variance, as `[n, 1]` arrays,
+        at `[n, d]` inputs. The likelihood's noise is only known for a
+        Gaussian likelihood with a single variance.
+        """
+        X = np.asarray(X, dtype=float).reshape([-1, self.input_dim])
+        points = np.stack([np.clip(X[:, column], grid[0], grid[-1]) for column, grid in zip(self.columns, self.grids)],
+                          axis=1)
+        if len(self.columns) == 1:
+            mean = np.interp(points[:, 0], self.grids[0], self.mean_table)
+            var = np.interp(points[:, 0], self.grids[0], self.var_table)
+        else:
+            mean, var = self._mean(points), self._var(points)
+        if include_likelihood:
+            if self.noise_variance is None:
+                raise ValueError("The likelihood's noise is only tabulated for Gaussian likelihoods, "
+                                 "predict with include_likelihood=False")
+            var = var + self.noise_variance
+        return mean.reshape([-1, 1]), var.reshape([-1, 1])
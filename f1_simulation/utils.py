@@ -1 +1,58 @@
+import importlib
+import importlib.util
+import sys
+from types import ModuleType
+from typing import List
 
+import numpy as np
+
+# The modules imported with `lazy_import`, for `load_lazy_imports`
+lazy_imports: List[str] = []
+
+
+def lazy_import(name: str) -> ModuleType:
+    """Imports a module on first use rather than now. The module returned
+    stands in for it, running its code the first time one of its attributes
+    is read, so a heavy dependency (GPy takes seconds) is only loaded by the
+    processes that fit or predict from a model. Annotations naming the
+    module have to be left unevaluated, with `from __future__ import annotations`.
+    Before Python 3.12 the first use isn't thread-safe, so code using the
+    module from several threads loads it first, see `load_lazy_imports`.
+
+    Args:
+        name (str): The module's absolute name
+
+    Returns:
+        ModuleType: The module, loaded already if it had been imported
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    lazy_imports.append(name)
+    return module
+
+
+def load_lazy_imports():
+    """Loads every module imported with `lazy_import`, e.g. before forking
+    workers, which then share them rather than each loading its own, or
+    before starting threads that use them"""
+    for name in lazy_imports:
+        sys.modules[name].__dict__
+
+
+def seed_random(seed: np.random.SeedSequence):
+    """Seeds NumPy's global generator, which the racers' processes draw from,
+    from a child of a `SeedSequence`. Forked workers start with their
+    parent's generator, so each task seeds it with its own child to draw a
+    stream independent of the other workers'.
+
+    Args:
+        seed (np.random.SeedSequence): The task's seed, spawned from the run's
+    """
+    np.random.seed(seed.generate_state(4))
@@ -0,0 +1,38 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+# the simulation's modules import each other by their top-level names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'f1_simulation'))
+
+from benchmarks import reset_process  # noqa: E402
+from synthetic_data import generate_scale  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def tiny_dirpath(tmp_path_factory) -> str:
+    """A tiny synthetic dataset shared by the tests that only read it"""
+    dirpath = str(tmp_path_factory.mktemp('tiny'))
+    generate_scale(dirpath, 'tiny')
+    return dirpath
+
+
+@pytest.fixture
+def data_dirpath(tiny_dirpath, tmp_path) -> str:
+    """A copy of the tiny synthetic dataset that a test can modify"""
+    dirpath = str(tmp_path / 'data')
+    shutil.copytree(tiny_dirpath, dirpath, ignore=shutil.ignore_patterns('.cache'))
+    return dirpath
+
+
+@pytest.fixture(scope='session')
+def simulation(tiny_dirpath, tmp_path_factory):
+    """`run_simulations` loaded on the tiny dataset, with a model store the
+    tests share so each model is fit once"""
+    import run_simulations
+    reset_process()
+    run_simulations.load(tiny_dirpath, str(tmp_path_factory.mktemp('models')))
+    yield run_simulations
+    reset_process()
@@ -0,0 +1,76 @@
+import pandas as pd
+import pytest
+
+from checkpoint import RunCheckpoint
+from sinks import RESULT_COLUMNS
+
+SETTINGS = dict(pooled=False, sources={'races': 'a'})
+
+
+def columns(race_id, rows=2):
+    """Results of `rows` laps of a race"""
+    results = {column: [0] * rows for column in RESULT_COLUMNS}
+    results.update(race_id=[race_id] * rows, lap_no=list(range(rows)), overtaking_mode=['none'] * rows)
+    return results
+
+
+def test_checkpoint_round_trips(tmp_path):
+    checkpoint = RunCheckpoint(str(tmp_path), SETTINGS)
+    checkpoint.record(1, columns(1), [('lap_time', 5, 2020)])
+    checkpoint.record(2, None, [], 'ValueError: no laps')
+    checkpoint.record(3, columns(3, 3), [])
+
+    resumed = RunCheckpoint(str(tmp_path), SETTINGS)
+    assert (resumed.done, resumed.failed) == ([1, 3], [2])
+    assert resumed.pending([3, 2, 1, 4]) == [2, 4]
+    assert resumed.results(3) == columns(3, 3)
+    assert resumed.races[1]['models'] == [['lap_time', 5, 2020]]
+
+    resumed.record(2, columns(2), [])
+    assert resumed.races[2]['attempts'] == 2
+    output = str(tmp_path / 'results.csv')
+    assert resumed.write_results([3, 2, 1], output) == 3
+    assert pd.read_csv(output)['race_id'].tolist() == [3, 3, 3, 2, 2, 1, 1]
+
+
+def test_checkpoint_with_other_settings_is_refused(tmp_path):
+    RunCheckpoint(str(tmp_path), SETTINGS)
+    with pytest.raises(ValueError):
+        RunCheckpoint(str(tmp_path), dict(SETTINGS, pooled=True))
+
+
+def test_resumed_run_matches_an_uninterrupted_run(simulation, tmp_path, monkeypatch):
+    races = sorted(simulation.race_table['raceId'].unique().tolist())
+    run = dict(dirpath=simulation.context.dirpath, models_dirpath=simulation.context.models_dirpath, seed=3)
+    uninterrupted = str(tmp_path / 'uninterrupted.csv')
+    simulation.run_simulations(races, output=uninterrupted, **run)
+
+    simulate_race = simulation.simulate_race
+    simulated = []
+
+    def flaky_simulate_race(*args, **kwargs):
+        simulated.append(args)
+        if len(simulated) == 2:
+            raise RuntimeError('worker lost')
+        return simulate_race(*args, **kwargs)
+
+    monkeypatch.setattr(simulation, 'simulate_race', flaky_simulate_race)
+    output = str(tmp_path / 'resumed.csv')
+    checkpoint = str(tmp_path / 'checkpoint')
+    simulation.run_simulations(races, output=output, checkpoint=checkpoint, **run)
+    assert races[1] not in pd.read_csv(output)['race_id'].tolist()
+
+    simulated.clear()
+    simulation.run_simulations(races, output=output, checkpoint=checkpoint, **run)
+    assert len(simulated) == 1
+    pd.testing.assert_frame_equal(pd.read_csv(output), pd.read_csv(uninterrupted))
+
+
+@pytest.mark.parametrize('seed', [4, None])
+def test_resuming_with_another_seed_is_refused(simulation, tmp_path, seed):
+    races = sorted(simulation.race_table['raceId'].unique().tolist())[:1]
+    run = dict(dirpath=simulation.context.dirpath, models_dirpath=simulation.context.models_dirpath,
+               output=str(tmp_path / 'results.csv'), checkpoint=str(tmp_path / 'checkpoint'))
+    simulation.run_simulations(races, seed=3, **run)
+    with pytest.raises(ValueError):
+        simulation.run_simulations(races, seed=seed, **run)
@@ -0,0 +1,43 @@
+import pandas as pd
+import pytest
+
+from dataprocessing import COLUMN_DTYPES, F1Dataset, format_lap_time, parse_lap_time
+
+
+def test_format_lap_time_round_trips():
+    times = pd.Series(['1:20.693', '0:59.001', None, '12:05.100'])
+    parsed = parse_lap_time(times)
+    assert format_lap_time(parsed).tolist()[:2] == ['1:20.693', '0:59.001']
+    assert pd.isna(format_lap_time(parsed)[2])
+    pd.testing.assert_series_equal(parse_lap_time(format_lap_time(parsed)), parsed)
+
+
+@pytest.mark.parametrize('cache', [False, True])
+@pytest.mark.parametrize('dataset', ['lap_times', 'qualifying', 'races'])
+def test_append_typed_rows_round_trips(data_dirpath, dataset, cache):
+    data = F1Dataset(data_dirpath, cache=cache)
+    original = data.table(dataset)
+    rows = original.loc[original['raceId'] == original['raceId'].max()].copy()
+    rows['raceId'] = original['raceId'].max() + 1
+    if dataset == 'qualifying':
+        rows.iloc[0, rows.columns.get_loc('q3')] = pd.NaT
+    data.append(dataset, rows)
+
+    for reloaded in (F1Dataset(data_dirpath, cache=False), F1Dataset(data_dirpath, cache=cache), data):
+        added = reloaded.table(dataset).iloc[len(original):].reset_index(drop=True)
+        expected = rows.reset_index(drop=True)
+        for column in expected.columns:
+            pd.testing.assert_series_equal(added[column], expected[column], check_dtype=False,
+                                           check_categorical=False, obj=column)
+
+
+def test_dtypes_come_from_the_schema(data_dirpath):
+    data = F1Dataset(data_dirpath, cache=False)
+    before = data.lap_times.dtypes
+    assert before['driverId'] == COLUMN_DTYPES['driverId']
+    rows = data.lap_times.iloc[:3].copy()
+    rows['raceId'] = 30000
+    rows['driverId'] = 1000
+    after = data.append('lap_times', rows).dtypes
+    pd.testing.assert_series_equal(after, before)
+    assert F1Dataset(data_dirpath).lap_times['driverId'].iloc[-1] == 1000
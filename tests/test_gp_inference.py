@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from gp_inference import NumpyGP
+from utils import lazy_import
+
+GPy = lazy_import('GPy')
+
+TOLERANCE = 1e-8
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    X = rng.uniform(0, 10, (40, 2))
+    Y = np.sin(X[:, :1]) + 0.1 * rng.standard_normal((40, 1))
+    return X, Y, rng.uniform(0, 10, (15, 2))
+
+
+def make_kernel():
+    return GPy.kern.RBF(2, ARD=True, lengthscale=[1.5, 3.]) + GPy.kern.Bias(2, variance=0.3)
+
+
+def make_sparse(X, Y, Z):
+    model = GPy.models.SparseGPRegression(X, Y, make_kernel(), Z=Z)
+    model.likelihood.variance = 0.05
+    return model
+
+
+def assert_same_predictions(model, reference, X):
+    for full_cov in (False, True):
+        for value, expected in zip(model.predict(X, full_cov=full_cov), reference.predict(X, full_cov=full_cov)):
+            np.testing.assert_allclose(value, expected, rtol=0, atol=TOLERANCE)
+
+
+def test_exact_model_matches_gpy(data):
+    X, Y, X_test = data
+    model = GPy.models.GPRegression(X, Y, make_kernel(), noise_var=0.05)
+    assert_same_predictions(NumpyGP(model), model, X_test)
+
+
+def test_sparse_model_matches_gpy(data):
+    X, Y, X_test = data
+    model = make_sparse(X, Y, X[::4].copy())
+    assert_same_predictions(NumpyGP(model), model, X_test)
+
+
+def test_coregionalised_model_matches_gpy(data):
+    X, Y, X_test = data
+    rng = np.random.default_rng(1)
+    kernel = GPy.kern.RBF(1, active_dims=[0]) * GPy.kern.Coregionalize(1, 3, rank=1, active_dims=[1])
+    kernel.parts[1].W[:] = rng.standard_normal((3, 1))
+    kernel.parts[1].kappa[:] = [0.5, 0.3, 0.2]
+    X = np.hstack([X[:, :1], rng.integers(0, 3, (len(X), 1))])
+    X_test = np.hstack([X_test[:, :1], rng.integers(0, 3, (len(X_test), 1))])
+    model = GPy.models.GPRegression(X, Y, kernel, noise_var=0.05)
+    assert_same_predictions(NumpyGP(model), model, X_test)
+
+
+def test_conditioning_an_exact_model_matches_fitting_on_all_the_data(data):
+    X, Y, X_test = data
+    model = GPy.models.GPRegression(X[:25], Y[:25], make_kernel(), noise_var=0.05)
+    reference = GPy.models.GPRegression(X, Y, make_kernel(), noise_var=0.05)
+    posterior = NumpyGP(model)
+
+    assert_same_predictions(posterior.condition(X[25:], Y[25:]), reference, X_test)
+    # one observation at a time, into the reserved factor and past its end
+    conditioned = posterior.reserve(5)
+    for x, y in zip(X[25:], Y[25:]):
+        conditioned = conditioned.condition(x, y)
+    assert_same_predictions(conditioned, reference, X_test)
+    # the posterior conditioned on is left as it was
+    assert_same_predictions(posterior, model, X_test)
+
+
+def test_conditioning_a_sparse_model_matches_fitting_on_all_the_data(data):
+    X, Y, X_test = data
+    Z = X[::4].copy()
+    posterior = NumpyGP(make_sparse(X[:25], Y[:25], Z))
+    assert_same_predictions(posterior.condition(X[25:], Y[25:]), make_sparse(X, Y, Z), X_test)
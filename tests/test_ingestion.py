@@ -0,0 +1,39 @@
+import os
+
+import pandas as pd
+
+from context import SimulationContext
+from dataprocessing import F1Dataset
+from features import FeatureStore
+from ingestion import RACE_DATASETS, ingest_new_races
+
+
+def test_ingesting_the_last_races_matches_loading_them(tiny_dirpath, data_dirpath):
+    races = pd.read_csv(os.path.join(tiny_dirpath, 'races.csv'))
+    dropped = races.sort_values(by=['date', 'raceId'])['raceId'].iloc[-2:].tolist()
+    for dataset in RACE_DATASETS:
+        path = os.path.join(data_dirpath, dataset + '.csv')
+        rows = pd.read_csv(path, dtype=str, keep_default_na=False)
+        rows.loc[~rows['raceId'].astype(int).isin(dropped)].to_csv(path, index=False)
+
+    data = F1Dataset(data_dirpath)
+    context = SimulationContext(data_dirpath, data=data)
+    features = context.features
+    # built before the races are added, so they are extended rather than rebuilt
+    tables = ('overtaking_laps', 'overtaking', 'pit_laps', 'pit_durations')
+    for table in tables:
+        getattr(features, table)
+    ingested = ingest_new_races(data, tiny_dirpath, context=context)
+    assert [race.race_id for race in ingested] == dropped
+
+    expected = F1Dataset(tiny_dirpath, cache=False)
+    for dataset in RACE_DATASETS:
+        for loaded in (data, F1Dataset(data_dirpath, cache=False)):
+            pd.testing.assert_frame_equal(loaded.table(dataset), expected.table(dataset), check_categorical=False,
+                                          obj=dataset)
+    expected_features = FeatureStore(expected)
+    for table in tables:
+        # pandas makes an index of consecutive IDs a RangeIndex, so a single
+        # race's IDs can come back int64
+        pd.testing.assert_frame_equal(getattr(features, table), getattr(expected_features, table),
+                                      check_index_type=False, check_categorical=False, obj=table)
@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+import pytest
+
+from model_store import ModelStore
+from utils import lazy_import
+
+GPy = lazy_import('GPy')
+
+SOURCES = {'lap_times': 'a', 'races': 'b'}
+
+
+def build(X, Y):
+    return GPy.models.GPRegression(X, Y, GPy.kern.RBF(1))
+
+
+def make_data(seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.uniform(0, 10, (20, 1))
+    return X, np.sin(X) + 0.1 * rng.standard_normal((20, 1))
+
+
+def test_fit_or_load_round_trips(tmp_path):
+    store = ModelStore(str(tmp_path))
+    data = make_data()
+    fitted = store.fit_or_load(('lap_time', 1, 2020), build, lambda: data, SOURCES)
+    assert (store.hits, store.misses) == (0, 1)
+
+    loaded = ModelStore(str(tmp_path)).fit_or_load(
+        ('lap_time', 1, 2020), build, lambda: pytest.fail('the data is rebuilt'), SOURCES)
+    np.testing.assert_array_equal(loaded.param_array, fitted.param_array)
+    np.testing.assert_array_equal(loaded.X, fitted.X)
+    assert store.fit_or_load(('lap_time', 2, 2020), build, lambda: None, SOURCES) is None
+
+
+def test_changed_sources_reuse_the_parameters_of_unchanged_data(tmp_path):
+    store = ModelStore(str(tmp_path))
+    fitted = store.fit_or_load(('lap_time', 1, 2020), build, make_data, SOURCES)
+    optimised = fitted.param_array.copy()
+
+    changed = {**SOURCES, 'lap_times': 'c'}
+    restored = store.fit_or_load(('lap_time', 1, 2020), build, make_data, changed, optimize=False)
+    np.testing.assert_array_equal(restored.param_array, optimised)
+    refit = store.fit_or_load(('lap_time', 1, 2020), build, lambda: make_data(1), {**SOURCES, 'lap_times': 'd'},
+                              optimize=False)
+    assert not np.array_equal(refit.param_array, optimised)  # unoptimised defaults
+    assert store.misses == 3
+
+
+def test_evicts_least_recently_used_entries(tmp_path):
+    store = ModelStore(str(tmp_path), max_entries=2)
+    for driver_id in range(3):
+        store.fit_or_load(('lap_time', driver_id, 2020), build, make_data, SOURCES, optimize=False)
+        os.utime(store._path(('lap_time', driver_id, 2020)), (driver_id, driver_id))
+    store.fit_or_load(('lap_time', 0, 2020), build, make_data, SOURCES)  # marks it recently used
+    store.evict()
+    assert [os.path.exists(store._path(('lap_time', driver_id, 2020))) for driver_id in range(3)] \
+        == [True, False, True]
+
+
+def test_carry_forward_restamps_unaffected_entries(tmp_path):
+    store = ModelStore(str(tmp_path))
+    for driver_id in range(3):
+        store.fit_or_load(('lap_time', driver_id, 2020), build, make_data, SOURCES, optimize=False)
+    after = {**SOURCES, 'lap_times': 'c'}
+    assert store.carry_forward(SOURCES, after, lambda key: key[1] == 1) == (2, 1)
+
+    hits = store.hits
+    store.fit_or_load(('lap_time', 0, 2020), build, lambda: pytest.fail('the data is rebuilt'), after)
+    assert store.hits == hits + 1
+    assert not os.path.exists(store._path(('lap_time', 1, 2020)))
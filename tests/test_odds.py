@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from batch_simulation import simulate_races
+from f1_racer import F1Racer
+from odds import DrawSource, estimate_odds
+
+
+@pytest.fixture
+def trajectory_racers(simulation):
+    race_id = simulation.race_table['raceId'].max()
+    racers, num_laps = simulation.make_racers(race_id, inference='numpy')
+    np.random.seed(0)
+    for racer in racers:
+        racer.draw_lap_time_trajectories(20)
+    return racers, num_laps
+
+
+@pytest.fixture
+def first_laps(monkeypatch):
+    """The lap times every racer's first lap is sampled with, per call to
+    `simulate_races`"""
+    laps = []
+    batched_lap_time = F1Racer.batched_lap_time
+
+    def recording_lap_time(racer, lap_number, *args):
+        mean, std = batched_lap_time(racer, lap_number, *args)
+        if lap_number == 0:
+            laps.append(mean.copy())
+        return mean, std
+
+    monkeypatch.setattr(F1Racer, 'batched_lap_time', recording_lap_time)
+    return laps
+
+
+def test_batches_resample_the_trajectories(trajectory_racers, first_laps):
+    racers, _ = trajectory_racers
+    # more races than trajectories drawn
+    batches = [DrawSource(1), DrawSource(2), DrawSource(1, mirrored=True)]
+    for source in batches:
+        simulate_races(racers, 1, 50, source)
+    first, second, mirrored = np.split(np.array(first_laps), len(batches))
+    assert not np.array_equal(first, second)
+    # an antithetic pair follows the same trajectories
+    np.testing.assert_array_equal(first, mirrored)
+
+
+def test_odds_of_trajectory_racers(trajectory_racers):
+    racers, num_laps = trajectory_racers
+    odds = estimate_odds(racers, num_laps, batch_size=50, max_sims=100, antithetic=True, seed=0)
+    assert odds.n_sims == 100
+    np.testing.assert_allclose(odds.win.sum(), 1)
@@ -0,0 +1,33 @@
+import numpy as np
+
+from context import SimulationContext
+from overtaking.overtaking_model import fit_overtaking_model, get_driver_id
+
+
+def test_get_driver_id(tiny_dirpath):
+    context = SimulationContext(tiny_dirpath)
+    drivers = context.data.drivers
+    assert get_driver_id(drivers['driverRef'].iloc[1], context) == drivers['driverId'].iloc[1]
+    assert get_driver_id('not_a_driver', context) is None
+
+
+def race_overtaking(laps):
+    """A driver's overtaking per race, aggregated from their laps as the
+    original script did"""
+    laps = laps.assign(num_overtakes=laps.groupby('raceId')['position_change'].transform(lambda x: x[x > 0].sum()),
+                       stuck_behind=laps.groupby('raceId')['stuck_behind_driver'].transform('sum'))
+    laps['success_perc'] = laps['num_overtakes'] / (laps['stuck_behind'] + laps['num_overtakes'])
+    return laps.groupby('raceId').first().reset_index()
+
+
+def test_overtaking_model_trains_on_every_race_with_its_inputs(tiny_dirpath):
+    context = SimulationContext(tiny_dirpath)
+    laps = context.features.overtaking_laps
+    for driver in laps['driverId'].unique()[:3]:
+        # the columns the model doesn't use are left out of the filter
+        expected = race_overtaking(laps.loc[laps['driverId'] == driver]) \
+            .drop(columns=['q2', 'q3', 'distance_to_leading_racer']).dropna()
+        model = fit_overtaking_model(driver, context=context)
+        np.testing.assert_array_equal(
+            model.X, expected[['qualtime', 'year', 'circuitId', 'constructorId']].to_numpy(dtype=float))
+        np.testing.assert_array_equal(model.Y, expected[['success_perc']].to_numpy(dtype=float))
@@ -0,0 +1,78 @@
+import numpy as np
+
+from batch_simulation import finishing_position_probabilities, simulate_races
+from gp_inference import NumpyGP, with_backend
+from pooling import DriverModel
+from race_state import RaceState
+from simulation import simulate_lap, simulate_race
+
+
+def assert_same_win_probabilities(racers, num_laps, n_races=300, n_sims=4000):
+    np.random.seed(0)
+    wins = np.zeros(len(racers))
+    for _ in range(n_races):
+        wins[simulate_race(racers, num_laps).order()[0]] += 1
+    orders, _ = simulate_races(racers, num_laps, n_sims, np.random.default_rng(0))
+    batched = finishing_position_probabilities(orders)[:, 0]
+
+    sequential = wins / n_races
+    # the standard error of the difference, floored for racers that never win
+    error = np.sqrt(np.maximum(batched * (1 - batched), 0.01) * (1 / n_races + 1 / n_sims))
+    assert np.all(np.abs(sequential - batched) < 4.5 * error), (sequential, batched)
+
+
+def test_batched_engine_matches_the_per_object_engine(simulation):
+    race_id = simulation.race_table['raceId'].max()
+    racers, num_laps = simulation.make_racers(race_id, pooled=True, inference='numpy')
+    assert_same_win_probabilities(racers, num_laps)
+
+
+def test_engines_agree_on_racers_with_trajectories(simulation):
+    race_id = simulation.race_table['raceId'].max()
+    racers, num_laps = simulation.make_racers(race_id, pooled=True, inference='numpy')
+    np.random.seed(3)
+    for racer in racers:
+        racer.draw_lap_time_trajectories(100)
+    assert_same_win_probabilities(racers, num_laps)
+
+    # races run one after another follow different trajectories
+    np.random.seed(4)
+    trajectories = {simulate_race(racers, 1).trajectory for _ in range(10)}
+    assert len(trajectories) > 1
+
+
+def test_repeated_races_draw_the_same_results_from_the_same_seed(simulation):
+    race_id = simulation.race_table['raceId'].max()
+    racers, num_laps = simulation.make_racers(race_id)
+    results = []
+    for _ in range(2):
+        np.random.seed(1)
+        first = simulate_race(racers, num_laps)
+        second = simulate_race(racers, num_laps)
+        results.append((first.current_time.copy(), second.current_time.copy()))
+    np.testing.assert_array_equal(results[0][0], results[1][0])
+    np.testing.assert_array_equal(results[0][1], results[1][1])
+
+
+def test_pooled_racers_draw_a_lap_of_overtakes_in_one_posterior_call(simulation, monkeypatch):
+    race_id = simulation.race_table['raceId'].max()
+    racers, num_laps = simulation.make_racers(race_id, pooled=True, inference='numpy')
+    models = [with_backend(racer.overtake_model, 'numpy') for racer in racers]
+    assert all(isinstance(model, DriverModel) for model in models)
+    pooled = models[0].model
+
+    calls = []
+    posterior_samples_f = NumpyGP.posterior_samples_f
+
+    def counting_posterior_samples_f(model, *args, **kwargs):
+        if model is pooled:
+            calls[-1] += 1
+        return posterior_samples_f(model, *args, **kwargs)
+
+    monkeypatch.setattr(NumpyGP, 'posterior_samples_f', counting_posterior_samples_f)
+    np.random.seed(2)
+    state = RaceState.from_racers(racers)
+    for lap in range(num_laps):
+        calls.append(0)
+        simulate_lap(racers, state, lap)
+    assert max(calls) == 1
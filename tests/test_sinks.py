@@ -0,0 +1,12 @@
+import pytest
+
+from sinks import MemorySink, ResultSink
+
+
+def test_sink_without_write_columns_cannot_be_made():
+    class IncompleteSink(ResultSink):
+        pass
+
+    with pytest.raises(TypeError):
+        IncompleteSink()
+    assert len(MemorySink()) == 0